@@ -2,19 +2,34 @@ import pandas as pd
 from pandas import DataFrame, Series
 import psycopg2
 from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine.base import Engine
 from typing import List
-import yfinance as yf
-from datetime import datetime
 import pandas_market_calendars as mcal
 import warnings
 import os
 from dotenv import load_dotenv
-import io
 import pytz
-import csv
-import time
+from constituents import CONSTITUENTS_DDL, ConstituentRefresher
+from corporate_actions import CORPORATE_ACTIONS_DDL
+from dead_tickers import DEAD_TICKERS_DDL, clear_tickers, get_skipped_tickers, record_failures
+from download_engine import DownloadReport, download_batches
+from features import FEATURES_DDL, configure_features, read_features_arrow, update_features
+from gaps import KNOWN_GAPS_DDL, plan_gap_fills
+from ingest import IngestWriter
+from journal import Journal
+from metrics import CountingCursor, metrics
+from ohlcv_cache import OHLCVCache
+from picks import DAILY_COUNTS_DDL, DAILY_COUNTS_STATE_DDL, SYNC_STATE_DDL, read_picks, refresh_daily_counts
+from planner import describe_plan, plan_downloads
+from purge import PURGED_TICKERS_DDL
+from panel import Panel
+from reader import arrow_to_frame, iter_stock_data, read_stock_data_arrow
+from sessions import get_session_index
+from storage import PostgresStorage, StorageBackend, count_picks
+from timescale import configure_timescale, read_resampled_arrow, refresh_aggregates
+from watermarks import WATERMARKS_DDL, bootstrap_watermarks, get_watermarks
 
 warnings.simplefilter(action='ignore')
 
@@ -22,76 +37,80 @@ warnings.simplefilter(action='ignore')
 BEGINNING_DATE = '2015-01-01' # Earliest date used for downloads
 
 # Global variables
+load_dotenv()
 today = pytz.UTC.localize(pd.Timestamp.now())
 today_str = today.strftime('%Y-%m-%d')
 nyse = mcal.get_calendar('NYSE') # NYSE calendar
+_ohlcv_cache = None # Created on first use, see get_ohlcv_cache()
+
+def get_sessions():
+    """
+    Returns the NYSE session index (memoized, see sessions.get_session_index), timing the lookup.
+    """
+    with metrics.timer('calendar'):
+        return get_session_index(nyse, BEGINNING_DATE)
 
 def last_trading_day(nyse):
     """
-    Returns the last completed trading date for NYSE
+    Returns the last completed trading date for NYSE (its market close, in UTC).
     """
-    today_utc_naive = datetime.utcnow()
-    
-    first_day_of_year = datetime(today_utc_naive.year, 1, 1)
-    valid_days = nyse.valid_days(start_date=first_day_of_year, end_date=today_utc_naive)
-    
-    schedule_today = nyse.schedule(start_date=valid_days[-1], end_date=valid_days[-1])
-    
-    market_close_today_utc = schedule_today.iloc[0]['market_close']
-    if pd.Timestamp(datetime.utcnow(), tz='UTC') > market_close_today_utc:
-        return market_close_today_utc
-    else:
-        schedule_prev_day = nyse.schedule(start_date=valid_days[-2], end_date=valid_days[-2])
-        market_close_prev_day_utc = schedule_prev_day.iloc[0]['market_close']
-        return market_close_prev_day_utc
+    return get_sessions().last_completed_close()
 
 LTD = last_trading_day(nyse)
 
+def refresh_clock():
+    """
+    Recomputes today's date and the last trading day, for processes that outlive a day (see daemon.py).
+    """
+    global today, today_str, LTD
+    today = pytz.UTC.localize(pd.Timestamp.now())
+    today_str = today.strftime('%Y-%m-%d')
+    LTD = last_trading_day(nyse)
+
 def next_trading_day(nyse, date_str):
     """ 
     Returns the next valid trading date for a given date.
     """
-    future_dates = pd.date_range(start=date_str, periods=10, freq='B')
-    trading_days = nyse.valid_days(start_date=future_dates[0], end_date=future_dates[-1])    
-    input_date_tz_aware = pd.Timestamp(date_str).tz_localize('UTC')    
-    next_day = trading_days[trading_days > input_date_tz_aware].min()    
-    return next_day
+    return pd.Timestamp(get_sessions().next_session(date_str)).tz_localize('UTC')
 
 def market_status(nyse):
     """ 
     Returns 'open' or 'closed' depending on the NYSE market status right now.
     """
-    now = datetime.utcnow() 
-    now = now.replace(tzinfo=pytz.utc)
+    return "open" if get_sessions().is_open() else "closed"
 
-    schedule = nyse.schedule(start_date=now.date(), end_date=now.date())
-    
-    if schedule.empty:
-        ms = "closed"
-    else:
-        is_open = mcal.date_range(schedule, frequency='1T')
-        market_open = is_open.min().to_pydatetime()
-        market_close = is_open.max().to_pydatetime()
-        
-        if market_open <= now <= market_close:
-            ms = "open"
-        else:
-            ms = "closed"
-    
-    return ms
+def _as_storage(conn) -> StorageBackend:
+    """
+    Wraps a DB connection in the postgres storage backend. Storage backends are returned as they are.
+    """
+    return conn if isinstance(conn, StorageBackend) else PostgresStorage(conn)
 
 
-def init_db():
+def get_db_settings():
     """
-    Initializes the Database and returns a connection object ready to work with.
+    Returns the connection parameters of the database configured in .env, as psycopg2.connect arguments.
     """
     load_dotenv()
+    return {'database': os.environ["DBNAME"], 'user': os.environ["DBUSER"], 'password': os.environ["DBPW"],
+            'host': os.environ["DBHOST"], 'port': os.environ["DBPORT"]}
+
+def create_pool(size):
+    """
+    Returns a thread-safe pool of up to `size` connections to the database, which must already be
+    initialized (see init_db). Connections are opened on demand and kept open for reuse.
+    """
+    return ThreadedConnectionPool(1, size, cursor_factory=CountingCursor, **get_db_settings())
 
-    dbhost = os.environ["DBHOST"]
-    dbuser = os.environ["DBUSER"]
-    dbpw = os.environ["DBPW"]
-    dbport = os.environ["DBPORT"]
-    dbname = os.environ["DBNAME"]
+def init_db():
+    """
+    Initializes the Database and returns a connection object ready to work with.
+    """
+    settings = get_db_settings()
+    dbhost = settings['host']
+    dbuser = settings['user']
+    dbpw = settings['password']
+    dbport = settings['port']
+    dbname = settings['database']
 
     conn = psycopg2.connect(database='postgres', user=dbuser, password=dbpw, host=dbhost, port=dbport)
     conn.autocommit = True 
@@ -110,7 +129,7 @@ def init_db():
 
     conn.close()
 
-    conn = psycopg2.connect(database=dbname, user=dbuser, password=dbpw, host=dbhost, port=dbport)
+    conn = psycopg2.connect(database=dbname, user=dbuser, password=dbpw, host=dbhost, port=dbport, cursor_factory=CountingCursor)
     conn.autocommit = True  
     try:
         with conn.cursor() as cursor:
@@ -146,6 +165,17 @@ def init_db():
                     action VARCHAR(10) NOT NULL
                 );
             """)
+            cursor.execute(WATERMARKS_DDL)
+            cursor.execute(DEAD_TICKERS_DDL)
+            cursor.execute(PURGED_TICKERS_DDL)
+            cursor.execute(KNOWN_GAPS_DDL)
+            cursor.execute(CORPORATE_ACTIONS_DDL)
+            cursor.execute(CONSTITUENTS_DDL)
+            cursor.execute(SYNC_STATE_DDL)
+            cursor.execute(DAILY_COUNTS_DDL)
+            cursor.execute(DAILY_COUNTS_STATE_DDL)
+            refresh_daily_counts(cursor)  # History written before the counts existed or outside of the sync.
+            cursor.execute(FEATURES_DDL)
             cursor.execute("""
                 SELECT * 
                 FROM timescaledb_information.hypertables 
@@ -161,13 +191,16 @@ def init_db():
                 CREATE INDEX IF NOT EXISTS idx_ticker ON stock_data (ticker);
                 CREATE INDEX IF NOT EXISTS idx_ticker_timestamp ON stock_data (ticker, timestamp);
             """)
+        configure_timescale(conn)
+        configure_features(conn)
+        bootstrap_watermarks(conn)
             
     except Exception as e:
         print(f"Error: {str(e)}")
         conn.close()
         quit(1)
     
-    engine = create_engine(f"postgresql+psycopg2://{dbuser}:{dbpw}@{dbhost}/{dbname}")
+    engine = create_engine(f"postgresql+psycopg2://{dbuser}:{dbpw}@{dbhost}/{dbname}", connect_args={'cursor_factory': CountingCursor})
     return conn, engine
 
 
@@ -182,72 +215,66 @@ def get_action_counts(conn, ticker):
     """ 
     Returns a list with a 2-item dictionary for 'Added' and 'Removed' counts. 
     This is to calculate a histogram of inclusion/exclusion of a certain stock.
+    For many tickers, use get_action_counts_by_ticker, which answers them all with one query.
+    """
+    counts = get_action_counts_by_ticker(conn, [ticker])
+    if counts is None:
+        return []
+    action_counts = {}
+    if ticker in counts.index:
+        action_counts = {action: int(count) for action, count in counts.loc[ticker].items() if count}
+    return [action_counts]
+
+
+def get_action_counts_by_ticker(conn, tickers=None):
+    """ 
+    Returns a dataframe indexed by ticker with the number of times each one was 'Added' to and
+    'Removed' from the picks, for the given tickers (all of them if None), in a single query.
     """
-    cur = conn.cursor()
-    
     query = """
     SELECT
-        action,
-        COUNT(*) as count
+        ticker,
+        COUNT(*) FILTER (WHERE action = 'Added') AS "Added",
+        COUNT(*) FILTER (WHERE action = 'Removed') AS "Removed"
     FROM
         mypicks_history
     WHERE
-        ticker = %s
+        %(all)s OR ticker = ANY(%(tickers)s)
     GROUP BY
-        action;
+        ticker
+    ORDER BY
+        ticker;
     """
     
     try:
-        cur.execute(query, (ticker,))
-        
-        results = cur.fetchall()
-        
-        action_counts = {}
-        for action, count in results:
-            action_counts[action] = count
-        
-        cur.close()
-        conn.close()
-        
-        return [action_counts]
+        with conn.cursor() as cur:
+            cur.execute(query, {'all': tickers is None, 'tickers': list(tickers or [])})
+            return pd.DataFrame(cur.fetchall(), columns=['ticker', 'Added', 'Removed']).set_index('ticker')
     except Exception as e:
         print(f"An error occurred: {e}")
-        cur.close()
-        return []
+        return None
 
 
 def get_stock_counts(conn):
     """ 
     Rate of Change (ROC) of the number of stocks in the list. Returns a dataframe with the date and the 
-    count for how many stocks were in the mypicks list.
-    """
-    query = """
-    WITH DateSeries AS (
-        SELECT generate_series(
-            (SELECT min(date) FROM mypicks_history),
-            (SELECT max(date) FROM mypicks_history),
-            interval '1 day'
-        ) AS date
-    )
-    SELECT
-        to_char(ds.date, 'YYYY-MM-DD') as date_str,
-        COUNT(m.ticker) AS stock_count
-    FROM
-        DateSeries ds
-    LEFT JOIN
-        mypicks m
-    ON
-        m.date_added <= ds.date AND (m.date_removed > ds.date OR m.date_removed IS NULL)
-    GROUP BY
-        ds.date
-    ORDER BY
-        ds.date;
+    count for how many stocks were in the mypicks list at the end of that day.
+    The counts are a running sum of the adds and removes in mypicks_history, materialized in the
+    mypicks_daily_counts table, which the picks sync keeps up to date (see picks.refresh_daily_counts),
+    so this is a plain read of one row per day that never writes or commits.
+    `conn` can also be a storage backend (see storage.py).
     """
+    if isinstance(conn, PostgresStorage):
+        conn = conn.conn
+    if isinstance(conn, StorageBackend):
+        return count_picks(conn.picks_history())
     
     try:
-        df = pd.read_sql_query(query, conn)
-        df['date'] = pd.to_datetime(df['date_str'])
-        df.drop(columns='date_str', inplace=True)
+        with conn.cursor() as cur:
+            cur.execute("SELECT date, stock_count FROM mypicks_daily_counts ORDER BY date;")
+            rows = cur.fetchall()
+        df = pd.DataFrame(rows, columns=['date', 'stock_count'])
+        df['date'] = pd.to_datetime(df['date'])
         df.set_index('date', inplace=True)
         return df
     except Exception as e:
@@ -258,54 +285,11 @@ def get_stock_counts(conn):
 def process_csv_and_update_db(conn):
     """ 
     Process the 'mypicks.csv' file and keep a record of changes in the DB.
+    The sync is a single set-based transaction, skipped if the file didn't change (see picks.sync_picks).
+    `conn` can also be a storage backend (see storage.py).
     """
-
-    def get_file_creation_time(filepath):
-        """
-        Returns the timestamp with the creation date of the file being passed.
-        """
-        timestamp = os.path.getctime(filepath)
-        return datetime.fromtimestamp(timestamp)
-
-    cur = conn.cursor()
-    file_creation_time = get_file_creation_time('mypicks.csv')
-
-    with open('mypicks.csv', newline='', encoding='utf-8') as csvfile:
-        csv_reader = csv.reader(csvfile)
-        headers = next(csv_reader)
-        tickers_from_csv = {row[0] for row in csv_reader if row[0] != 'Summary'}
-
-    cur.execute("SELECT ticker FROM mypicks WHERE date_removed IS NULL OR date_added > date_removed;")
-    tickers_from_db = {row[0] for row in cur.fetchall()}
-
-    new_tickers = tickers_from_csv - tickers_from_db
-    removed_tickers = tickers_from_db - tickers_from_csv
-
-    for ticker in new_tickers:
-        cur.execute(
-            """
-            INSERT INTO mypicks (ticker, date_added) VALUES (%s, %s)
-            ON CONFLICT (ticker) DO UPDATE SET date_added = EXCLUDED.date_added, date_removed = NULL;
-            """,
-            (ticker, file_creation_time)
-        )
-        cur.execute(
-            "INSERT INTO mypicks_history (ticker, action, date) VALUES (%s, 'Added', %s);",
-            (ticker, file_creation_time)
-        )
-    
-    for ticker in removed_tickers:
-        cur.execute(
-            "UPDATE mypicks SET date_removed=%s WHERE ticker=%s;",
-            (file_creation_time, ticker)
-        )
-        cur.execute(
-            "INSERT INTO mypicks_history (ticker, action, date) VALUES (%s, 'Removed', %s);",
-            (ticker, file_creation_time)
-        )
-    
-    cur.close()
-
+    with metrics.timer('picks_sync'):
+        _as_storage(conn).sync_picks('./mypicks.csv')
 
 
 def get_last_entry_date(ticker, conn):
@@ -327,10 +311,15 @@ def get_last_entry_date(ticker, conn):
     return None
 
 
-def get_tickers_list(conn, picks='./mypicks.csv', inclusion='./inclusion_list.txt', exclusion='./exclusion_list.txt'):
+def get_tickers_list(conn, picks='./mypicks.csv', inclusion='./inclusion_list.txt', exclusion='./exclusion_list.txt', cleanup=True):
     """ 
     Compiles the list of tickers we'll use. It assumes specific filenames for picks, and explicit inclusion and exclusion lists.
+    Data of excluded tickers is purged from the DB (see purge.purge_tickers). With cleanup=False they are
+    left out of the list but nothing is purged; what would be purged is printed instead.
+    `conn` can also be a storage backend (see storage.py).
     """
+    storage = _as_storage(conn)
+
     def read_file(file_path):
         """
         Reads a file into memory. If errors occur, display a message and continue.
@@ -354,113 +343,59 @@ def get_tickers_list(conn, picks='./mypicks.csv', inclusion='./inclusion_list.tx
 
     def get_exchanges_tickers():
         """
-        Get all the tickers we'll use. Downloads and stores major indexes stocks, so we don't have
-        to call them every time (we're being nice to Wikipedia).
+        Get all the tickers of the major indexes from the constituent snapshots (see constituents.py),
+        taking the first snapshot right away if there is none yet.
         """
-        #### Russell 1000
-        R1000_filename="Russell_1000_list.gzip"
-
-        try:
-            r1000_ticker_df = pd.read_parquet(R1000_filename)
-        except:
-            r1000_ticker_df = pd.read_html("https://en.wikipedia.org/wiki/Russell_1000_Index")[2]
-            r1000_ticker_df.to_parquet(R1000_filename, compression="gzip")
-
-        #### Dow Jones
-        DJI_filename="DJI_list.gzip"
-
-        try:
-            dji_ticker_df = pd.read_parquet(DJI_filename)
-        except:
-            dji_ticker_df = pd.read_html("https://en.wikipedia.org/wiki/Dow_Jones_Industrial_Average")[1]
-            dji_ticker_df.to_parquet(DJI_filename, compression="gzip")
-
-        #### NASDAQ 100
-        N100_filename = "NASDAQ_100_list.gzip"
-        try:
-            n100_ticker_df = pd.read_parquet(N100_filename)
-        except:
-            n100_ticker_df = pd.read_html("https://en.wikipedia.org/wiki/Nasdaq-100")[4]
-            n100_ticker_df.to_parquet(N100_filename, compression="gzip")
-
-        ticker_df = pd.concat([r1000_ticker_df['Ticker'], dji_ticker_df['Symbol'], n100_ticker_df['Ticker']], ignore_index=True)
-        ticker_df_list = list(set(ticker_df.to_list()))
-        return [s.replace('.', '-') for s in ticker_df_list]
+        return storage.universe()
 
     def get_mypicks(picks):
         """
         Reads a CSV file with a single list of tickers in a column, typically comes from StockRover. 
         It assumes a header row of "Ticker" and optionally a last like with "Summary". 
-        Customize it if you want to use a different format.
+        The parse is shared with the picks sync (see picks.read_picks).
         """
-        try:
-            extra = pd.read_csv(picks)['Ticker'] 
-            if extra[-1:].values[0] == 'Summary':
-                extra = extra[:-1]
-        except:
-            extra = pd.Series([])
-        return extra
+        parsed = read_picks(picks)
+        return parsed[0] if parsed else []
 
     def get_tickers_from_db(conn):
         """
         This function queries all tickers from the DB
         """
-        query = f"""
-            SELECT ticker
-            FROM stock_data;
-        """
-        df = pd.read_sql(query, conn)
-        return df.columns.to_list()
+        return storage.known_tickers()
     
-    def cleanup_excluded(conn, excluded_tickers):
-        """
-        Deletes the excluded tickers from the database.
-        """
-        e = list(set(excluded_tickers))
-        if not e:
-            return e
-
-        cur = conn.cursor()
-
-        # Step 1: Check which tickers exist in the database
-        ticker_str = ','.join(f"'{ticker}'" for ticker in e)
-        query = f"""
-            SELECT ticker
-            FROM stock_data
-            WHERE ticker IN ({ticker_str});
-        """
-        cur.execute(query)
-        existing_tickers = [row[0] for row in cur.fetchall()]
-
-        if not existing_tickers:
-            cur.close()
-            return  e # Exit early if there are no tickers to delete, but still returns the exclusion list
-
-        # Step 2: Delete the existing tickers and log the deletions
-        existing_ticker_str = ','.join(f"'{ticker}'" for ticker in existing_tickers)
-        ticker_list = [(ticker, False) for ticker in existing_tickers]
-
-        query = f"""
-            DELETE
-            FROM stock_data
-            WHERE ticker IN ({existing_ticker_str});
-        """
-        cur.execute(query)
-        cur.close()
-        return e
-
-
     # get_tickers_list function logic starts here
-    excl = cleanup_excluded(conn, read_file(exclusion))
+    with metrics.timer('purge'):
+        excl = storage.purge(read_file(exclusion), dry_run=not cleanup)
     all_tickers = (set(read_file(inclusion)) | set(get_exchanges_tickers()) | set(get_tickers_from_db(conn)) | set(get_mypicks(picks))) - set(excl + ['ticker'])
     return list(all_tickers)
 
 
-def get_stocks_from_db(engine: Engine, tickers: List[str], initial_date: str, end_date: str) -> DataFrame:
+def get_stocks_from_db(engine: Engine, tickers: List[str], initial_date: str, end_date: str, columnar: bool = False,
+                       cached: bool = False, as_panel: bool = False):
     """ 
     Returns a MultiIndex dataframe with stock information for all tickers requested in the list
     for the date range selected.
+    With columnar=True the rows are streamed with COPY straight into Arrow arrays (see reader.py),
+    which is much faster and lighter on memory for large pulls.
+    With cached=True they are served from the local Parquet cache (see get_ohlcv_cache), which only
+    goes to the DB for partitions it doesn't have yet and for periodic watermark checks.
+    With as_panel=True a panel.Panel is returned instead of a dataframe (always read columnar), which
+    extracts single tickers in constant time. Use its to_pandas() for the usual dataframe.
+    `engine` can also be a storage backend (see storage.py), which is always read columnar.
     """
+    if isinstance(engine, StorageBackend):
+        table = engine.read_arrow(tickers, initial_date, end_date)
+        return Panel.from_arrow(table) if as_panel else arrow_to_frame(table)
+    if cached or columnar or as_panel:
+        conn = engine.raw_connection()
+        try:
+            if cached:
+                table = get_ohlcv_cache().read_arrow(conn, tickers, initial_date, end_date)
+            else:
+                table = read_stock_data_arrow(conn, tickers, initial_date, end_date)
+        finally:
+            conn.close()
+        return Panel.from_arrow(table) if as_panel else arrow_to_frame(table)
 
     query = text("""
         SELECT timestamp, ticker, open, high, low, close, volume
@@ -475,136 +410,195 @@ def get_stocks_from_db(engine: Engine, tickers: List[str], initial_date: str, en
 
     return df
 
+def get_resampled_bars(engine: Engine, tickers: List[str], initial_date: str, end_date: str, timeframe: str = 'weekly') -> DataFrame:
+    """ 
+    Returns weekly or monthly bars (timeframe='weekly' or 'monthly') with the same MultiIndex layout as
+    get_stocks_from_db, read from the continuous aggregates that init_db maintains instead of
+    resampling daily bars in pandas. Each bar is indexed by the first day of its week or month.
+    """
+    conn = engine.raw_connection()
+    try:
+        return arrow_to_frame(read_resampled_arrow(conn, tickers, initial_date, end_date, timeframe))
+    finally:
+        conn.close()
+
+def get_features(engine: Engine, tickers: List[str], initial_date: str, end_date: str, features: List[str] = None) -> DataFrame:
+    """ 
+    Returns the precomputed features (see features.py) of the tickers between the two dates, with the
+    same (timestamp, ticker) MultiIndex as get_stocks_from_db and one column per feature (all of the
+    registered ones, or only `features`).
+    """
+    conn = engine.raw_connection()
+    try:
+        return arrow_to_frame(read_features_arrow(conn, tickers, initial_date, end_date, features))
+    finally:
+        conn.close()
+
+def iter_stocks_from_db(engine: Engine, tickers: List[str], initial_date: str, end_date: str, by: str = 'date', **kwargs):
+    """ 
+    Generator version of get_stocks_from_db(columnar=True) that yields one MultiIndex dataframe per
+    date range (by='date') or per batch of tickers (by='ticker'), for datasets larger than RAM.
+    See reader.iter_stock_data for the chunk size options.
+    """
+    conn = engine.raw_connection()
+    try:
+        yield from iter_stock_data(conn, tickers, initial_date, end_date, by=by, **kwargs)
+    finally:
+        conn.close()
+
+def get_ohlcv_cache():
+    """
+    Returns the process-wide OHLCV Parquet cache (configured with OHLCV_CACHE_DIR, OHLCV_CACHE_MAX_BYTES
+    and OHLCV_CACHE_TTL in .env).
+    """
+    global _ohlcv_cache
+    if _ohlcv_cache is None:
+        _ohlcv_cache = OHLCVCache()
+    return _ohlcv_cache
+
 def get_single_ticker_from_df(ticker: str, df: DataFrame) -> DataFrame:
     """ 
     Extracts a single ticker dataframe from a MultiIndex dataframe.
+    A Panel (see get_stocks_from_db) is also accepted, and answers in constant time.
     """
+    if isinstance(df, Panel):
+        return df.get_frame(ticker)
     if not isinstance(df.index, pd.MultiIndex) or ticker not in df.index.get_level_values('ticker').unique().tolist():
         return
     return df.xs(ticker, level='ticker')
 
 
-def calculate_downloads(conn, tickers):
+def calculate_downloads(conn, tickers, chunk_size=None, dry_run=False):
     """
-    Returns a list of dictionaries with date and the tickers to download starting on that date.
+    Returns the download plan: a list of dictionaries with the date and the tickers to download starting
+    on that date (see planner.plan_downloads for the cost model and the extra keys of each item).
+    It only reads the ticker_watermarks table, so its cost doesn't depend on the size of stock_data.
+    The plan also backfills the holes inside the stored history (see gaps.plan_gap_fills); those items
+    have an 'end' date. With dry_run=True the gap audit doesn't count the backfill attempts.
     """
+    skipped = set(get_skipped_tickers(conn)) & set(tickers)
+    if skipped:
+        print(f"Skipping {len(skipped)} tickers that failed recently (see the dead_tickers table).")
+        tickers = [t for t in tickers if t not in skipped]
+    if not tickers:
+        return []
+    sessions = get_sessions()
+    watermarks = get_watermarks(conn, tickers)
+    latest = pd.to_datetime(watermarks['last_ts']).reindex(pd.Index(tickers).unique())
+    plan = plan_downloads(latest, sessions, BEGINNING_DATE, chunk_size=chunk_size)
+    with metrics.timer('gap_audit'):
+        return plan + plan_gap_fills(conn, sessions, list(watermarks.index), chunk_size=chunk_size, record=not dry_run)
 
-    # Local functions
-    def get_latest_stock_data(conn, tickers):
-        """
-        Get the latest updated timestamps for all tickers in the DB.
-        """
-        if not tickers:
-            return pd.DataFrame(columns=['ticker', 'timestamp']).set_index('timestamp')
-
-        tickers_tuple = tuple(tickers)
-        query = f"""
-        WITH Latest AS (
-            SELECT ticker, MAX(timestamp) AS latest_timestamp
-            FROM stock_data
-            WHERE ticker IN %s
-            GROUP BY ticker
-        )
-        SELECT sd.ticker, sd.timestamp
-        FROM stock_data sd
-        JOIN Latest l ON sd.ticker = l.ticker AND sd.timestamp = l.latest_timestamp;
-        """
-        df = pd.read_sql_query(query, conn, params=(tickers_tuple,), index_col='timestamp')
-
-        for ticker in tickers:
-            if ticker not in df['ticker'].values:
-                new_row = pd.DataFrame({'ticker': [ticker], 'timestamp': [BEGINNING_DATE]}).set_index('timestamp')
-                df = df.append(new_row)
-
-        return df
-
-    def aggregate_dates_and_tickers(df):
-        """
-        Creates aggregates of stock tickers per date they were last updated.
-        """
-        df.index = df.index.astype(str)
-        grouped = df.groupby(df.index)
-        
-        result = []
-        
-        for date, group in grouped:
-            nd = next_trading_day(nyse, date)
-            if nd < LTD:
-                nds = nd.strftime('%Y-%m-%d')
-                tickers = group['ticker'].tolist()
-                result.append({"date": nds, "tickers": tickers})
-        return result
-    
-    # Main function logic.
-    df = get_latest_stock_data(conn, tickers)
-    download_lists = aggregate_dates_and_tickers(df)
 
-    return download_lists
+def replay_journal(conn, journal=None):
+    """
+    Writes into the DB the batches journaled by an interrupted run, without downloading them again.
+    Replays always merge, since some of those rows may have been committed right before the crash.
+    Run it before calculate_downloads so the plan only covers what is really missing.
+    """
+    journal = journal or Journal()
+    pending = journal.pending()
+    if not pending:
+        return 0
+    print(f"Replaying {pending} journaled batches from an interrupted run.")
+    writer = IngestWriter(conn, mode='merge', on_commit=lambda items: journal.truncate(i['key'] for i in items))
+    writer.start()
+    try:
+        for item, data in journal.segments():
+            writer.put(item, data)
+    finally:
+        writer.close()
+    print(f"{writer.rows_written} journaled rows written to the database.")
+    if writer.adjusted_since is not None:
+        refresh_aggregates(conn, writer.adjusted_since, max(action[1] for action in writer.actions))
+    return pending
 
 
-def update_db(conn, download_lists):
+def update_db(conn, download_lists, fetcher=None, workers=None, chunk_size=None):
     """ 
-    Download the tickers from YFinance according to the passed lists and updates the DB.
+    Download the tickers according to the passed lists and updates the DB.
+    Each date group is split into chunks of at most `chunk_size` tickers which are fetched in parallel
+    by `workers` threads (defaults come from DOWNLOAD_WORKERS and DOWNLOAD_CHUNK_SIZE in .env).
+    `fetcher` can replace the default yfinance provider (see download_engine.Fetcher).
+    Downloads are streamed to a writer thread that ingests them in large multi-ticker COPY batches
+    while the next chunks are still downloading.
+    Failing batches are bisected to isolate bad symbols, which are recorded in the dead_tickers table
+    so later runs skip them for a while.
+    Every downloaded batch is journaled on disk until its rows are committed (see replay_journal).
+    Splits and dividends are detected on the refetched overlap bars, and the stored history of the
+    affected tickers is adjusted in place (see corporate_actions.py).
     """
-    max_retries = 5
-    retry_delay = 5  # seconds
     ms = market_status(nyse)
-    for item in download_lists:
-        start_date = item['date']
-        tickers = item['tickers']
-        for attempt in range(max_retries):
-            try:
-                if (ms == 'closed'): 
-                    data = yf.download(tickers, start=start_date)
-                else:
-                    data = yf.download(tickers, start=start_date, end=today_str)
-                break
-            except Exception as e: # yf.download() is buggy, specially for 1000s of tickers, so it's better to do this.
-                print(f"Error downloading {tickers}: {e}")
-                if attempt < max_retries - 1:
-                    print(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                else:
-                    print(f"Failed to download {ticker} after {max_retries} attempts.")
-
-        # YFinance returns a MultiIndex dataframe if you download more than 1 ticker, 
-        # so we need to account for that (annoying).
-        if isinstance(data.columns, pd.MultiIndex):
-            grouped = data.groupby(level=1, axis=1)
-            for ticker, ticker_data in grouped:
-                ticker_data.columns = ticker_data.columns.droplevel(1)
-                ticker_data['ticker'] = ticker 
-                ticker_data.dropna(inplace=True)  
-                ticker_data['Volume'] = ticker_data['Volume'].astype('int64') 
-                buffer = io.StringIO()
-                ticker_data[['ticker', 'Open', 'High', 'Low', 'Close', 'Volume']].to_csv(buffer, header=False, index=True)
-                buffer.seek(0)  
-                cur = conn.cursor()
-                cur.copy_from(buffer, 'stock_data', columns=('timestamp', 'ticker', 'open', 'high', 'low', 'close', 'volume'), sep=',')
-                conn.commit()
-                cur.close()
-        else:
-            ticker = tickers[0]
-            data['ticker'] = ticker 
-            data.dropna(inplace=True) 
-            data['Volume'] = data['Volume'].astype('int64') 
-            buffer = io.StringIO()
-            data[['ticker', 'Open', 'High', 'Low', 'Close', 'Volume']].to_csv(buffer, header=False, index=True)
-            buffer.seek(0)
-            cur = conn.cursor()
-            cur.copy_from(buffer, 'stock_data', columns=('timestamp', 'ticker', 'open', 'high', 'low', 'close', 'volume'), sep=',')
-            conn.commit()
-            cur.close()
-    
+    end = None if ms == 'closed' else today_str
+    report = DownloadReport()
+    journal = Journal()
+    writer = IngestWriter(conn, on_commit=lambda items: journal.truncate(i['key'] for i in items))
+    writer.start()
+    # Gap backfills go last, so the history they land in has already been adjusted for new splits and dividends.
+    phases = [[i for i in download_lists if 'end' not in i], [i for i in download_lists if 'end' in i]]
+    try:
+        for phase in phases:
+            for item, data in download_batches(phase, fetcher=fetcher, workers=workers, chunk_size=chunk_size, end=end, report=report):
+                with metrics.timer('journal'):
+                    journal.write(item, data)
+                with metrics.timer('writer_backpressure'):
+                    writer.put(item, data)
+                metrics.incr('batches_downloaded')
+    finally:
+        writer.close()
+    print(f"{writer.rows_written} rows written to the database.")
+    if writer.adjusted_since is not None:
+        refresh_aggregates(conn, writer.adjusted_since, max(action[1] for action in writer.actions))
+    clear_tickers(conn, report.succeeded)
+    # Empty answers to gap backfills are holes in the provider's data, not dead tickers.
+    tail_tickers = {t for item in download_lists if 'end' not in item for t in item['tickers']}
+    record_failures(conn, {t: reason for t, reason in report.failed.items() if t in tail_tickers})
+
     process_csv_and_update_db(conn)
     return
 
 
-def get_close_data(conn):
+def update_storage(storage, tickers, fetcher=None, workers=None, chunk_size=None, dry_run=False):
+    """ 
+    Equivalent of calculate_downloads + update_db for an embedded storage backend (see storage.py):
+    plans the provider calls from the stored watermarks and appends the new bars to the store.
+    Gap backfills, split and dividend repairs and the dead ticker list need the DB and are skipped.
+    With dry_run=True the plan is printed and nothing is downloaded. Returns the rows written.
+    """
+    watermarks = storage.get_watermarks(tickers)
+    latest = pd.to_datetime(watermarks['last_ts']).reindex(pd.Index(tickers).unique())
+    with metrics.timer('plan'):
+        plan = plan_downloads(latest, get_sessions(), BEGINNING_DATE, chunk_size=chunk_size)
+    if dry_run or not plan:
+        print(describe_plan(plan))
+        return 0
+    end = None if market_status(nyse) == 'closed' else today_str
+    rows = 0
+    for item, data in download_batches(plan, fetcher=fetcher, workers=workers, chunk_size=chunk_size, end=end):
+        with metrics.timer('copy'):
+            rows += storage.write_batch(data, item['tickers'])
+    metrics.incr('rows_written', rows)
+    print(f"{rows} rows written to {storage}.")
+    return rows
+
+def get_close_data(conn, cached: bool = False):
     """ 
     Returns a dataframe with all the 'close' data for all tickers in the DB. 
-    Very useful for analytics later on.
+    Very useful for analytics later on. For repeated use, prefer the memory-mapped close matrix
+    (see refresh_close_matrix), which doesn't reload or pivot anything.
+    With cached=True the data is served from the local Parquet cache (see get_ohlcv_cache).
+    `conn` can also be a storage backend (see storage.py).
     """
+    if isinstance(conn, StorageBackend):
+        table = conn.read_arrow(conn.known_tickers(), BEGINNING_DATE, today_str, columns=['timestamp', 'ticker', 'close'])
+        close_data = table.to_pandas(date_as_object=False)
+        return close_data.pivot(index='timestamp', columns='ticker', values='close')
+    if cached:
+        cache = get_ohlcv_cache()
+        table = cache.read_arrow(conn, cache.known_tickers(conn), BEGINNING_DATE, today_str)
+        close_data = table.select(['timestamp', 'ticker', 'close']).to_pandas(date_as_object=False)
+        return close_data.pivot(index='timestamp', columns='ticker', values='close')
+
     query = """
         SELECT timestamp, ticker, close
         FROM stock_data
@@ -615,3 +609,20 @@ def get_close_data(conn):
     
     return close_df
 
+
+def refresh_close_matrix(conn):
+    """ 
+    Appends the new sessions and tickers to the persistent, memory-mapped close matrix.
+    Open it with close_matrix.CloseMatrix() for zero-copy access to the same data as get_close_data.
+    `conn` can also be a storage backend (see storage.py).
+    """
+    with metrics.timer('close_matrix'):
+        _as_storage(conn).update_close_matrix(get_sessions())
+
+def refresh_features(conn):
+    """ 
+    Computes the registered features (see features.py) for the sessions added since the last run,
+    from the close matrix, so refresh_close_matrix must run first.
+    """
+    with metrics.timer('features'):
+        return update_features(conn)
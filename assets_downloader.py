@@ -1,26 +1,154 @@
+import argparse
+
 from assets_db import *
+from daemon import CYCLE_CONNECTIONS, Scheduler, get_daemon_settings
+from metrics import Profiler, get_metrics_settings, metrics, write_run_report
+from planner import describe_plan
+from storage import get_storage_settings, open_storage
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Keeps the local OHLCV database up-to-date.')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the download plan with estimated request and row counts, then exit without downloading.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the run with cProfile and tracemalloc (same as PROFILE=1).')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and update after every market close (SIGHUP or SIGUSR1 updates right away).')
+    args = parser.parse_args()
+    if args.daemon and args.plan:
+        parser.error('--plan and --daemon are mutually exclusive.')
+    return args
+
 
 ####### MAIN Fuction ########
 def main():
+    args = parse_args()
+    if args.daemon:
+        return run_daemon(args)
+    profiler = Profiler(args.profile or get_metrics_settings()[2])
+    with profiler:
+        if get_storage_settings()[0] == 'postgres':
+            run(args)
+        else:
+            run_embedded(args)
+    write_run_report(profiler)
+
+
+def run_daemon(args):
+    """
+    Daemon mode: the process stays up between updates, so imports, the session calendar, the
+    pooled DB connections (or the open store) and the index universe stay warm. The pool holds
+    the connections of one update: its own and the constituent refresher's.
+    """
+    close_delay = get_daemon_settings()
+    profile = args.profile or get_metrics_settings()[2]
+    pool, storage = None, None
+    if get_storage_settings()[0] == 'postgres':
+        print('Initializing the database.')
+        close_db(*init_db()) # The pool takes over from here.
+        pool = create_pool(CYCLE_CONNECTIONS)
+    else:
+        storage = open_storage()
+
+    def release(conn):
+        pool.putconn(conn, close=bool(conn.closed)) # Broken connections are replaced.
+
+    def cycle():
+        refresh_clock()
+        metrics.reset()
+        profiler = Profiler(profile)
+        with profiler:
+            if storage is not None:
+                run_embedded(args, storage)
+            else:
+                conn = pool.getconn()
+                conn.autocommit = True
+                try:
+                    update(conn, args, pool.getconn, release)
+                finally:
+                    release(conn)
+        write_run_report(profiler)
+
+    try:
+        Scheduler(cycle, get_sessions, close_delay).run()
+    finally:
+        if pool is not None:
+            pool.closeall()
+
+
+def run_embedded(args, storage=None):
+    storage = storage or open_storage()
+    print(f'Updating {storage}.')
+    print('Obtaining list of tickers and dates.')
+    with metrics.timer('tickers_list'):
+        tickers = get_tickers_list(storage, picks='./mypicks.csv', inclusion='./inclusion_list.txt', exclusion='./exclusion_list.txt', cleanup=not args.plan)
+    print(f'{len(tickers)} total tickers found. Checking which ones need updating...')
+    with metrics.timer('update_db'):
+        update_storage(storage, tickers, dry_run=args.plan)
+    if not args.plan:
+        process_csv_and_update_db(storage)
+        print('Updating the close matrix.')
+        refresh_close_matrix(storage)
+
+
+def run(args):
     print('Initializing the database.')
-    conn, engine = init_db()
+    with metrics.timer('init_db'):
+        conn, engine = init_db()
+    update(conn, args, engine.raw_connection)
+    close_db(conn, engine)
+
+
+def update(conn, args, connect, release=None):
+    """
+    One update of the database on `conn`. The constituent refresher gets its own connection from
+    `connect`, given back with `release` (see constituents.ConstituentRefresher).
+    """
+    if args.plan:
+        pending = Journal().pending()
+        if pending:
+            print(f'{pending} journaled batches from an interrupted run will be replayed before downloading.')
+    else:
+        with metrics.timer('replay_journal'):
+            replay_journal(conn)
     print('Obtaining list of tickers and dates.')
-    tickers = get_tickers_list(conn, picks='./mypicks.csv', inclusion='./inclusion_list.txt', exclusion='./exclusion_list.txt')
+    with metrics.timer('tickers_list'):
+        tickers = get_tickers_list(conn, picks='./mypicks.csv', inclusion='./inclusion_list.txt', exclusion='./exclusion_list.txt', cleanup=not args.plan)
+    if not args.plan:
+        refresher = ConstituentRefresher(connect, release=release) # Refreshes stale index snapshots while we download.
+        refresher.start()
     if tickers != []:
         print(f'{len(tickers)} total tickers found. Checking which ones need updating...')
-        download_lists = calculate_downloads(conn, tickers) # Returns a list of sets ordered per date.
-        if (download_lists != []):
+        with metrics.timer('plan'):
+            download_lists = calculate_downloads(conn, tickers, dry_run=args.plan) # Returns the list of provider calls, ordered per date.
+        if args.plan:
+            print(describe_plan(download_lists))
+        elif (download_lists != []):
             print('Downloading tickers and updating the database.')
-            update_db(conn, download_lists)
+            with metrics.timer('update_db'):
+                update_db(conn, download_lists)
             print('Database update complete.')
         else:
             print('Nothing to download. The database is up-to-date.')
     else:
         print('Nothing to download. The database is up-to-date.')
 
-    close_db(conn, engine)
+    if not args.plan:
+        with metrics.timer('constituents_wait'):
+            refresher.join()
+        new_members = []
+        if refresher.added: # Index changes found by the refresher get their history right away.
+            new_members = sorted(set(get_tickers_list(conn, picks='./mypicks.csv', inclusion='./inclusion_list.txt', exclusion='./exclusion_list.txt', cleanup=False)) - set(tickers))
+        if new_members:
+            print(f'Backfilling {len(new_members)} tickers that just joined an index.')
+            update_db(conn, calculate_downloads(conn, new_members))
+        print('Updating the close matrix.')
+        refresh_close_matrix(conn)
+        print('Updating the features.')
+        refresh_features(conn)
 
 
 # Program Main
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
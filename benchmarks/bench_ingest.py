@@ -0,0 +1,90 @@
+"""
+Compares rows/sec of the CSV and binary COPY encoders on a synthetic yf.download-shaped frame.
+With --db it also times the COPY into a temporary copy of stock_data (needs a working .env).
+
+    python -m benchmarks.bench_ingest --tickers 1000 --days 2500 [--db]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from ingest import ENCODERS, OHLCV_FIELDS, copy_payloads
+
+
+def make_wide_frame(n_tickers, n_days, seed=0, dates=None):
+    """
+    Returns a random yf.download-shaped frame with a (field, ticker) MultiIndex on the columns.
+    `dates` (n_days of them) replaces the default business days from 2015-01-02.
+    """
+    rng = np.random.default_rng(seed)
+    if dates is None:
+        dates = pd.bdate_range('2015-01-02', periods=n_days, name='Date')
+    else:
+        dates = pd.DatetimeIndex(dates, name='Date')
+    tickers = [f'T{i:04d}' for i in range(n_tickers)]
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (n_days, n_tickers)), axis=0))
+    blocks = {
+        'Open': close * (1 + rng.normal(0, 0.002, close.shape)),
+        'High': close * 1.01,
+        'Low': close * 0.99,
+        'Close': close,
+        'Volume': rng.integers(1e5, 1e7, close.shape).astype('float64'),
+    }
+    data = pd.concat({f: pd.DataFrame(blocks[f], index=dates, columns=tickers) for f in OHLCV_FIELDS}, axis=1)
+    return data, tickers
+
+
+def bench_encode(data, tickers, fmt, repeat=3):
+    """
+    Returns (rows, best seconds) for encoding the frame with the given COPY format.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, rows = ENCODERS[fmt](data, tickers)
+        best = min(best, time.perf_counter() - start)
+    return rows, best
+
+
+def bench_copy(conn, data, tickers, fmt):
+    """
+    Returns (rows, seconds) for encoding and copying the frame into a temporary table.
+    """
+    with conn.cursor() as cur:
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS bench_stock_data (LIKE stock_data INCLUDING DEFAULTS);")
+        cur.execute("TRUNCATE bench_stock_data;")
+        start = time.perf_counter()
+        payload, rows = ENCODERS[fmt](data, tickers)
+        copy_payloads(cur, [payload], fmt, table='bench_stock_data')
+        elapsed = time.perf_counter() - start
+    conn.commit()
+    return rows, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickers', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=500)
+    parser.add_argument('--db', action='store_true', help='Also time the COPY into the database.')
+    args = parser.parse_args()
+
+    data, tickers = make_wide_frame(args.tickers, args.days)
+    print(f'{args.tickers} tickers x {args.days} days')
+    for fmt in ENCODERS:
+        rows, seconds = bench_encode(data, tickers, fmt)
+        print(f'encode {fmt:>6}: {rows / seconds:>12,.0f} rows/sec ({seconds:.3f}s)')
+
+    if args.db:
+        from assets_db import init_db, close_db
+        conn, engine = init_db()
+        conn.autocommit = False
+        for fmt in ENCODERS:
+            rows, seconds = bench_copy(conn, data, tickers, fmt)
+            print(f'copy   {fmt:>6}: {rows / seconds:>12,.0f} rows/sec ({seconds:.3f}s)')
+        close_db(conn, engine)
+
+
+if __name__ == '__main__':
+    main()
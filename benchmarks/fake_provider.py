@@ -0,0 +1,57 @@
+"""
+Offline stand-in for Yahoo! Finance that serves a synthetic market (see synthetic.py) with tunable
+latency and failure rate, so the download path can be measured without touching the network.
+"""
+import random
+import threading
+import time
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from download_engine import Fetcher
+from ingest import OHLCV_FIELDS
+
+
+class FakeProvider(Fetcher):
+    """
+    Serves slices of `market`. Every call sleeps `latency` seconds (plus up to `jitter` times that,
+    at random) and fails with probability `failure_rate`. `download` takes the same arguments as
+    yf.download and returns the same shapes, so it can also be patched in place of it.
+    """
+    def __init__(self, market: DataFrame, latency: float = 0.05, jitter: float = 0.5,
+                 failure_rate: float = 0.0, seed: int = 0):
+        self.market = market
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.dates = market.index.values.astype('datetime64[D]')
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def download(self, tickers: Union[str, List[str]], start: Optional[str] = None, end: Optional[str] = None,
+                 **kwargs) -> DataFrame:
+        if isinstance(tickers, str):
+            tickers = tickers.replace(',', ' ').split()
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * (1 + self.jitter * self._random.random())
+            fail = self._random.random() < self.failure_rate
+            self.failures += fail
+        time.sleep(delay)
+        if fail:
+            raise ConnectionError('Simulated provider failure.')
+
+        lo = 0 if start is None else int(np.searchsorted(self.dates, np.datetime64(start, 'D'), side='left'))
+        hi = len(self.dates) if end is None else int(np.searchsorted(self.dates, np.datetime64(end, 'D'), side='left'))
+        # Like yf.download: a (field, ticker) MultiIndex with a column per requested ticker (all NaN
+        # for unknown ones), or flat columns for a single ticker.
+        data = self.market.iloc[lo:hi].reindex(columns=pd.MultiIndex.from_product([OHLCV_FIELDS, tickers]))
+        return data.droplevel(1, axis=1) if len(tickers) == 1 else data
+
+    def fetch(self, tickers: List[str], start: str, end: Optional[str] = None) -> DataFrame:
+        return self.download(tickers, start=start, end=end, threads=False, progress=False)
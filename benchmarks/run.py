@@ -0,0 +1,177 @@
+"""
+Times the main entry points of assets_db on a synthetic market (see synthetic.py) served by a fake
+provider (see fake_provider.py), in a dedicated local TimescaleDB database, and compares the
+results with a stored baseline. The database is emptied and seeded on every run, with the last
+--stale sessions and some gaps missing so the update path has work to do.
+
+    python -m benchmarks.run --universe 1k --years 2 [--save-baseline]
+
+Exits with status 1 if a benchmark is more than --threshold slower than the baseline.
+Needs DBHOST, DBUSER, DBPW and DBPORT in .env. DBNAME is replaced with --dbname.
+"""
+import argparse
+import json
+import os
+import time
+
+from psycopg2.extras import execute_values
+
+# Constants
+DEFAULT_DBNAME = 'assets_bench'
+DEFAULT_THRESHOLD = 0.2          # Relative slowdown flagged as a regression
+MIN_REGRESSION_SECONDS = 0.05    # Slowdowns smaller than this are noise
+SEED_CHUNK_TICKERS = 1000        # Tickers per COPY when seeding the database
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--universe', choices=['1k', '5k', '20k'], default='1k')
+    parser.add_argument('--years', type=float, default=2)
+    parser.add_argument('--stale', type=int, default=3, help='Sessions missing at the end of every ticker.')
+    parser.add_argument('--gap-rate', type=float, default=0.001, help='Gaps per ticker and session.')
+    parser.add_argument('--nan-rate', type=float, default=0.0005, help='Fraction of bars without prices.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per provider call.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of provider calls that fail.')
+    parser.add_argument('--sample', type=int, default=100, help='Tickers read by get_stocks_from_db.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each read benchmark (the best one counts).')
+    parser.add_argument('--dbname', default=DEFAULT_DBNAME)
+    parser.add_argument('--baseline', help='Baseline file (benchmarks/baselines/<universe>_<years>y.json by default).')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    return parser.parse_args()
+
+
+def seed_db(conn, data, tickers):
+    """
+    Empties the benchmark database and loads the frame into stock_data, with its watermarks.
+    """
+    from ingest import copy_payloads, encode_binary, summarize_batch
+    from watermarks import upsert_watermarks
+
+    with conn.cursor() as cur:
+        cur.execute("""
+            TRUNCATE stock_data, ticker_watermarks, known_gaps, dead_tickers, purged_tickers,
+                     corporate_actions, mypicks, mypicks_history, mypicks_daily_counts, sync_state;
+        """)
+        for i in range(0, len(tickers), SEED_CHUNK_TICKERS):
+            chunk = tickers[i:i + SEED_CHUNK_TICKERS]
+            part = data.loc[:, (slice(None), chunk)]
+            payload, _ = encode_binary(part, chunk)
+            copy_payloads(cur, [payload], 'binary')
+            upsert_watermarks(cur, [(t,) + s for t, s in summarize_batch(part, chunk).items()])
+    conn.commit()
+
+
+def seed_picks(conn, picks, history):
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE mypicks, mypicks_history, mypicks_daily_counts;")
+        execute_values(cur, "INSERT INTO mypicks (ticker, date_added, date_removed) VALUES %s;", picks)
+        execute_values(cur, "INSERT INTO mypicks_history (ticker, action, date) VALUES %s;", history)
+    conn.commit()
+
+
+def timed(name, fn, repeat=1):
+    """
+    Runs fn `repeat` times and returns (its last result, the best run's seconds, counters and stage timers).
+    """
+    from metrics import metrics
+
+    best = None
+    for _ in range(repeat):
+        metrics.reset()
+        start = time.perf_counter()
+        result = fn()
+        seconds = time.perf_counter() - start
+        snapshot = metrics.snapshot()
+        if best is None or seconds < best['seconds']:
+            best = {'seconds': round(seconds, 4), 'counters': snapshot['counters'],
+                    'stages': {stage: timer['seconds'] for stage, timer in snapshot['timers'].items()}}
+    print(f"{name:>28}: {best['seconds']:>9.3f}s")
+    return result, best
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the benchmarks more than `threshold` (relative) and MIN_REGRESSION_SECONDS slower than the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name, {}).get('seconds')
+        if before is None:
+            continue
+        after = result['seconds']
+        if after > before * (1 + threshold) and after - before > MIN_REGRESSION_SECONDS:
+            regressions.append((name, before, after))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    # Point everything at the benchmark database and cache before assets_db reads .env, so a run
+    # can never write synthetic rows into the real database or replay them from the real journal.
+    os.environ['DBNAME'] = args.dbname
+    os.environ['CACHE_DIR'] = os.path.join(os.environ.get('CACHE_DIR', './.cache'), 'bench')
+    import assets_db as db
+    from benchmarks.fake_provider import FakeProvider
+    from benchmarks.synthetic import UNIVERSES, make_market, make_picks_history, market_dates, punch_gaps
+
+    meta = {key: getattr(args, key) for key in ('universe', 'years', 'stale', 'gap_rate', 'nan_rate', 'latency',
+                                                'failure_rate', 'sample')}
+    dates = market_dates(db.get_sessions(), args.years)
+    market, tickers = make_market(UNIVERSES[args.universe], dates, nan_rate=args.nan_rate)
+    print(f"{len(tickers)} tickers x {len(dates)} sessions, {len(tickers) * len(dates):,} bars.")
+
+    conn, engine = db.init_db()
+    start = time.perf_counter()
+    seed_db(conn, punch_gaps(market.iloc[:len(dates) - args.stale], args.gap_rate), tickers)
+    print(f"Database seeded in {time.perf_counter() - start:.1f}s.")
+
+    results = {}
+    plan, results['calculate_downloads'] = timed('calculate_downloads', lambda: db.calculate_downloads(conn, tickers))
+    provider = FakeProvider(market, latency=args.latency, failure_rate=args.failure_rate)
+    _, results['update_db'] = timed('update_db', lambda: db.update_db(conn, plan, fetcher=provider))
+    results['update_db'].update({'provider_calls': provider.calls, 'provider_failures': provider.failures})
+
+    sample = tickers[:args.sample]
+    first, last = str(dates[0]), str(dates[-1])
+    _, results['get_stocks_from_db'] = timed(
+        'get_stocks_from_db', lambda: db.get_stocks_from_db(engine, sample, first, last), args.repeat)
+    _, results['get_stocks_from_db_columnar'] = timed(
+        'get_stocks_from_db_columnar', lambda: db.get_stocks_from_db(engine, sample, first, last, columnar=True), args.repeat)
+    _, results['get_close_data'] = timed('get_close_data', lambda: db.get_close_data(conn), args.repeat)
+    seed_picks(conn, *make_picks_history(tickers, dates))
+    _, results['get_stock_counts'] = timed('get_stock_counts', lambda: db.get_stock_counts(conn), args.repeat)
+    db.close_db(conn, engine)
+
+    report = {'meta': meta, 'results': results}
+    os.makedirs(os.environ['CACHE_DIR'], exist_ok=True)
+    output = os.path.join(os.environ['CACHE_DIR'], f'results_{args.universe}.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}.")
+
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, f"{args.universe}_{args.years:g}y.json")
+    regressions = []
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline['meta'] != meta:
+            print(f"The baseline in {baseline_path} was taken with other settings, not comparing.")
+        else:
+            regressions = compare(results, baseline['results'], args.threshold)
+            for name, before, after in regressions:
+                print(f"REGRESSION {name}: {before:.3f}s -> {after:.3f}s ({after / before - 1:+.0%})")
+            if not regressions:
+                print(f"No regressions against {baseline_path}.")
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {baseline_path}.")
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Synthetic market for the benchmarks: random-walk OHLCV for universes of any size on the NYSE
+sessions, with missing bars (gaps) and scattered NaN prices, plus a random picks history.
+"""
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from benchmarks.bench_ingest import make_wide_frame
+from ingest import OHLCV_FIELDS
+
+# Constants
+UNIVERSES = {'1k': 1000, '5k': 5000, '20k': 20000}
+SESSIONS_PER_YEAR = 252
+MAX_GAP_SESSIONS = 5  # Longest run of missing bars punched by punch_gaps
+
+
+def market_dates(sessions, years: float) -> np.ndarray:
+    """
+    Returns the last `years` of completed sessions from a sessions.SessionIndex.
+    """
+    last = sessions.last_completed()
+    return sessions.sessions[max(0, last + 1 - int(years * SESSIONS_PER_YEAR)):last + 1]
+
+
+def make_market(n_tickers: int, dates, nan_rate: float = 0.0005, seed: int = 0) -> Tuple[DataFrame, List[str]]:
+    """
+    Returns a yf.download-shaped frame with `n_tickers` random walks over `dates`, and its tickers.
+    A `nan_rate` fraction of the bars have a NaN close, like the bars Yahoo! returns without prices.
+    Those are never written, so they end up as holes the provider can't fill either.
+    """
+    data, tickers = make_wide_frame(n_tickers, len(dates), seed=seed, dates=dates)
+    if nan_rate:
+        rng = np.random.default_rng(seed + 1)
+        close = data['Close'].to_numpy(copy=True)
+        close[rng.random(close.shape) < nan_rate] = np.nan
+        data['Close'] = close
+    return data, tickers
+
+
+def punch_gaps(data: DataFrame, gap_rate: float = 0.001, seed: int = 0) -> DataFrame:
+    """
+    Returns a copy of `data` with runs of 1 to MAX_GAP_SESSIONS missing bars, `gap_rate` runs per
+    ticker and session on average. Seeding the DB with it leaves gaps the provider can backfill.
+    """
+    rng = np.random.default_rng(seed + 2)
+    n_days, n_tickers = data['Close'].shape
+    missing = np.zeros((n_days, n_tickers), dtype=bool)
+    counts = rng.poisson(gap_rate * n_days, n_tickers)
+    columns = np.repeat(np.arange(n_tickers), counts)
+    starts = rng.integers(0, n_days, len(columns))
+    lengths = rng.integers(1, MAX_GAP_SESSIONS + 1, len(columns))
+    for column, start, length in zip(columns, starts, lengths):
+        missing[start:start + length, column] = True
+    # The fields are laid out one after the other, so the mask repeats once per field.
+    return data.mask(np.tile(missing, (1, len(OHLCV_FIELDS))))
+
+
+def make_picks_history(tickers: List[str], dates, n_picks: int = 500, max_changes: int = 6, seed: int = 0):
+    """
+    Returns random (mypicks rows, mypicks_history rows) for `n_picks` of the tickers, each added
+    and removed up to `max_changes` times on the given dates. The mypicks rows are
+    (ticker, date_added, date_removed) and the history rows (ticker, action, date).
+    """
+    rng = np.random.default_rng(seed + 3)
+    dates = pd.DatetimeIndex(dates)
+    picks, history = [], []
+    for ticker in rng.choice(tickers, min(n_picks, len(tickers)), replace=False):
+        changes = np.sort(rng.choice(len(dates), rng.integers(1, max_changes + 1), replace=False))
+        actions = ['Added' if i % 2 == 0 else 'Removed' for i in range(len(changes))]
+        history += [(str(ticker), action, dates[i].to_pydatetime()) for action, i in zip(actions, changes)]
+        added = dates[changes[::2][-1]].to_pydatetime()
+        removed = dates[changes[1::2][-1]].to_pydatetime() if len(changes) > 1 else None
+        picks.append((str(ticker), added, removed))
+    return picks, history
@@ -0,0 +1,225 @@
+import glob
+import json
+import os
+from typing import Callable, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pandas import DataFrame
+
+from reader import copy_to_arrow
+from sessions import DEFAULT_CACHE_DIR
+from watermarks import get_watermarks
+
+# Constants
+DEFAULT_DTYPE = 'float64'
+DTYPES = ('float32', 'float64')
+INDEX_FILE = 'index.json'
+MIN_COLUMNS = 256  # Initial column capacity; it doubles whenever it runs out
+
+
+def get_close_matrix_dir(directory: Optional[str] = None) -> str:
+    """
+    Directory of the close matrix: the argument, CLOSE_MATRIX_DIR, or close_matrix/ under CACHE_DIR.
+    """
+    return directory or os.environ.get('CLOSE_MATRIX_DIR') or \
+        os.path.join(os.environ.get('CACHE_DIR', DEFAULT_CACHE_DIR), 'close_matrix')
+
+
+class CloseMatrix:
+    """
+    Read-only view of the persistent close-price matrix: a memory-mapped (sessions x tickers) NumPy
+    array plus its ticker -> column index. Rows are the exchange sessions starting at the first
+    session of the history, so a date always maps to the same row. Missing bars are NaN.
+    Opening it copies nothing, so many worker processes can share the same pages of the file.
+    """
+    __slots__ = ('directory', 'dates', 'tickers', 'columns', '_data')
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = get_close_matrix_dir(directory)
+        with open(os.path.join(self.directory, INDEX_FILE)) as f:
+            index = json.load(f)
+        mapped = np.load(os.path.join(self.directory, index['data_file']), mmap_mode='r')
+        self.dates = np.array(index['sessions'][:index['n_rows']], dtype='datetime64[D]')
+        self.tickers = index['tickers']
+        self.columns = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self._data = mapped[:index['n_rows'], :len(self.tickers)]
+
+    @property
+    def values(self) -> np.ndarray:
+        """
+        The whole (dates x tickers) matrix as a zero-copy view.
+        """
+        return self._data
+
+    def _rows(self, start=None, end=None) -> slice:
+        lo = 0 if start is None else int(np.searchsorted(self.dates, np.datetime64(start, 'D'), side='left'))
+        hi = len(self.dates) if end is None else int(np.searchsorted(self.dates, np.datetime64(end, 'D'), side='right'))
+        return slice(lo, hi)
+
+    def column(self, ticker: str, start=None, end=None) -> np.ndarray:
+        """
+        Close prices of one ticker as a zero-copy (strided) view.
+        """
+        return self._data[self._rows(start, end), self.columns[ticker]]
+
+    def slice(self, start=None, end=None, tickers: Optional[List[str]] = None) -> np.ndarray:
+        """
+        Close prices between two dates (inclusive) for all tickers (a zero-copy view) or for a subset
+        of them (only that block is read from disk).
+        """
+        rows = self._rows(start, end)
+        if tickers is None:
+            return self._data[rows]
+        return self._data[rows][:, [self.columns[t] for t in tickers]]
+
+    def to_frame(self, start=None, end=None, tickers: Optional[List[str]] = None) -> DataFrame:
+        """
+        Same layout as get_close_data: dates as the index and one column per ticker.
+        """
+        rows = self._rows(start, end)
+        return pd.DataFrame(self.slice(start, end, tickers), index=pd.DatetimeIndex(self.dates[rows], name='timestamp'),
+                            columns=pd.Index(tickers or self.tickers, name='ticker'))
+
+
+def _read_closes(conn, tickers: List[str], start, end) -> pa.Table:
+    return copy_to_arrow(conn, """
+        SELECT timestamp, ticker, close
+        FROM stock_data
+        WHERE ticker = ANY(%s) AND timestamp BETWEEN %s AND %s
+    """, (list(tickers), start, end), {'timestamp': pa.date32(), 'ticker': pa.string(), 'close': pa.float64()})
+
+
+def update_close_matrix(conn, sessions, directory: Optional[str] = None, dtype: Optional[str] = None,
+                        watermarks: Optional[DataFrame] = None, read_closes: Optional[Callable] = None):
+    """
+    Brings the close matrix up to date with stock_data, using the per-ticker watermarks to append
+    only new sessions and new tickers. A ticker whose history changed in any other way (backfills,
+    price adjustments, purges) gets its column rewritten. `sessions` is the SessionIndex that defines the rows.
+    The index file is replaced atomically at the end, so readers always see a consistent shape.
+    New bars are written in place, into cells readers still see as missing; when any stored close
+    changes, the whole matrix is written to a new versioned file instead, so a reader never sees
+    a column halfway through a rewrite.
+    Other stores pass their `watermarks` and a `read_closes(tickers, start, end)` function instead of `conn`.
+    """
+    directory = get_close_matrix_dir(directory)
+    dtype = dtype or os.environ.get('CLOSE_MATRIX_DTYPE', DEFAULT_DTYPE)
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown CLOSE_MATRIX_DTYPE '{dtype}'. Use one of: {', '.join(DTYPES)}.")
+    os.makedirs(directory, exist_ok=True)
+
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index['dtype'] != dtype or index['sessions'][0] != str(sessions.sessions[0]):
+            raise ValueError('layout changed')
+    except (FileNotFoundError, ValueError, KeyError):
+        index = {'dtype': dtype, 'data_file': None, 'version': 0, 'sessions': [], 'n_rows': 0,
+                 'tickers': [], 'synced': {}}
+    index['sessions'] = sessions.sessions.astype(str).tolist()
+    session_days = sessions.sessions
+
+    if watermarks is None:
+        watermarks = get_watermarks(conn)
+    if read_closes is None:
+        read_closes = lambda tickers, start, end: _read_closes(conn, tickers, start, end)
+    columns = {ticker: i for i, ticker in enumerate(index['tickers'])}
+    synced = index['synced']
+    append, rewrite, cleared = {}, [], []
+    for ticker, wm in watermarks.iterrows():
+        current = [str(wm['first_ts']), str(wm['last_ts']), int(wm['row_count']), int(wm['revision'])]
+        previous = synced.get(ticker)
+        if previous == current:
+            continue
+        if previous and previous[0] == current[0] and previous[3:] == current[3:] and previous[1] < current[1]:
+            append[ticker] = previous
+        else:
+            rewrite.append(ticker)
+        synced[ticker] = current
+    for ticker in [t for t in synced if t not in watermarks.index]:
+        cleared.append(ticker)
+        del synced[ticker]
+
+    # Appended bars only fill cells readers see as NaN, so they are written in place. Changing stored
+    # closes in place would let a reader see a half-rewritten column, so rewrites go to a new file.
+    appended = []
+    if append:
+        since = pd.Timestamp(min(p[1] for p in append.values())) + pd.Timedelta(days=1)
+        table = read_closes(list(append), since, watermarks['last_ts'].max())
+        for ticker, previous in append.items():
+            rows = table.filter(pc.and_(pc.equal(table['ticker'], ticker),
+                                        pc.greater(table['timestamp'], pa.scalar(pd.Timestamp(previous[1]).date()))))
+            if previous[2] + rows.num_rows == synced[ticker][2]:
+                appended.append(rows)
+            else:
+                rewrite.append(ticker)
+    changed = [t for t in rewrite + cleared if t in columns]
+
+    new_tickers = [t for t in rewrite if t not in columns]
+    for ticker in new_tickers:
+        columns[ticker] = len(columns)
+    index['tickers'] = list(columns)
+    last_ts = watermarks['last_ts'].max() if len(watermarks) else None
+    n_rows = max(index['n_rows'], int(np.searchsorted(session_days, np.datetime64(last_ts, 'D'), side='right')) if last_ts else 0)
+    data = _ensure_capacity(directory, index, len(session_days), len(columns), fresh=bool(changed))
+
+    for rows in appended:
+        _write_rows(data, session_days, columns, rows)
+    for ticker in changed:
+        data[:, columns[ticker]] = np.nan
+    if rewrite:
+        _write_rows(data, session_days, columns, read_closes(rewrite, str(session_days[0]), last_ts))
+    data.flush()
+
+    index['n_rows'] = n_rows
+    path = os.path.join(directory, INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+    for stale in glob.glob(os.path.join(directory, 'close_*.npy')):
+        if os.path.basename(stale) != index['data_file']:
+            os.remove(stale)  # Readers that still map it keep their pages until they close.
+    print(f"Close matrix updated: {len(new_tickers)} new tickers, {len(append)} appended, "
+          f"{len(rewrite) - len(new_tickers)} rewritten, {n_rows} sessions.")
+
+
+def _ensure_capacity(directory: str, index: dict, rows: int, cols: int, fresh: bool = False) -> np.memmap:
+    """
+    Opens the data file for writing, moving it to a bigger file (with doubled column capacity)
+    when the matrix doesn't fit anymore. With fresh=True the data is always copied to a new file,
+    which readers only see once the index points at it.
+    """
+    current = None
+    if index['data_file']:
+        current = np.lib.format.open_memmap(os.path.join(directory, index['data_file']), mode='r+')
+        if current.shape[0] >= rows and current.shape[1] >= cols and not fresh:
+            return current
+
+    capacity = max(MIN_COLUMNS, cols)
+    if current is not None:
+        capacity = max(capacity, current.shape[1] if current.shape[1] >= cols else 2 * current.shape[1])
+    index['version'] += 1
+    index['data_file'] = f"close_{index['dtype']}_{index['version']}.npy"
+    data = np.lib.format.open_memmap(os.path.join(directory, index['data_file']), mode='w+',
+                                     dtype=index['dtype'], shape=(rows, capacity))
+    data[:] = np.nan
+    if current is not None:
+        r, c = min(rows, current.shape[0]), current.shape[1]
+        data[:r, :c] = current[:r, :c]
+    return data
+
+
+def _write_rows(data: np.ndarray, session_days: np.ndarray, columns: dict, table: pa.Table):
+    """
+    Scatters (timestamp, ticker, close) rows into the matrix in one vectorized assignment.
+    """
+    if table.num_rows == 0:
+        return
+    days = table['timestamp'].to_numpy().astype('datetime64[D]')
+    rows = np.searchsorted(session_days, days)
+    valid = (rows < len(session_days)) & (session_days[np.minimum(rows, len(session_days) - 1)] == days)
+    cols = pd.Index(list(columns)).get_indexer(table['ticker'].to_numpy(zero_copy_only=False))
+    valid &= cols >= 0
+    data[rows[valid], cols[valid]] = table['close'].to_numpy()[valid]
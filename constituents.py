@@ -0,0 +1,234 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+from psycopg2.extras import execute_values
+
+# Constants
+DEFAULT_SOURCE = 'wikipedia'
+DEFAULT_TTL_HOURS = 24 * 7  # Age of a snapshot before the index is fetched again
+
+# index name: (Wikipedia page, position of the constituents table, ticker column)
+INDEXES = {
+    'Russell_1000': ('https://en.wikipedia.org/wiki/Russell_1000_Index', 2, 'Ticker'),
+    'DJI': ('https://en.wikipedia.org/wiki/Dow_Jones_Industrial_Average', 1, 'Symbol'),
+    'NASDAQ_100': ('https://en.wikipedia.org/wiki/Nasdaq-100', 4, 'Ticker'),
+}
+
+# Versioned index memberships: one snapshot per index every time its constituents change, the
+# adds and removes between snapshots, and the current members, which make up the ticker universe.
+CONSTITUENTS_DDL = """
+    CREATE TABLE IF NOT EXISTS index_snapshots (
+        index_name TEXT NOT NULL,
+        snapshot_date DATE NOT NULL,
+        tickers TEXT[] NOT NULL,
+        fetched_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (index_name, snapshot_date)
+    );
+    CREATE TABLE IF NOT EXISTS index_changes (
+        index_name TEXT NOT NULL,
+        snapshot_date DATE NOT NULL,
+        ticker TEXT NOT NULL,
+        action VARCHAR(10) NOT NULL,
+        PRIMARY KEY (index_name, snapshot_date, ticker)
+    );
+    CREATE TABLE IF NOT EXISTS index_members (
+        index_name TEXT NOT NULL,
+        ticker TEXT NOT NULL,
+        since DATE NOT NULL DEFAULT CURRENT_DATE,
+        PRIMARY KEY (index_name, ticker)
+    );
+"""
+
+_universe = None  # Memoized union of all index members, see get_universe()
+_universe_lock = threading.Lock()
+
+
+class ConstituentSource:
+    """
+    Provider of index constituents. Implement `fetch` to plug in another source.
+    """
+    def fetch(self, index: str) -> List[str]:
+        """
+        Returns the tickers of `index` (one of INDEXES), in yfinance format.
+        """
+        raise NotImplementedError
+
+
+def tickers_from_tables(tables: List[pd.DataFrame], index: str) -> List[str]:
+    """
+    Picks the constituents table of `index` out of the tables of its page: the one at the expected
+    position if it has the ticker column, otherwise the first one that has it. Symbols that contain
+    a dot (like BRK.A) have the dot converted to a dash so yfinance works fine.
+    """
+    _, position, column = INDEXES[index]
+    candidates = tables[position:position + 1] + tables
+    for table in candidates:
+        if column in table.columns:
+            return sorted({str(t).strip().replace('.', '-') for t in table[column].dropna()})
+    raise ValueError(f"No table with a '{column}' column found for {index}.")
+
+
+class WikipediaSource(ConstituentSource):
+    """
+    Reads the constituents from the Wikipedia page of every index.
+    """
+    def fetch(self, index: str) -> List[str]:
+        return tickers_from_tables(pd.read_html(INDEXES[index][0]), index)
+
+
+class HTMLFileSource(ConstituentSource):
+    """
+    Reads saved copies of the index pages from `<directory>/<index>.html`, for tests and offline runs.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def fetch(self, index: str) -> List[str]:
+        return tickers_from_tables(pd.read_html(os.path.join(self.directory, f'{index}.html')), index)
+
+
+def get_constituent_settings():
+    """
+    Returns the (source, ttl) tuple from the environment, falling back to the defaults.
+    CONSTITUENTS_SOURCE is either 'wikipedia' or a directory of saved pages (see HTMLFileSource).
+    """
+    spec = os.environ.get('CONSTITUENTS_SOURCE', DEFAULT_SOURCE)
+    source = WikipediaSource() if spec == DEFAULT_SOURCE else HTMLFileSource(spec)
+    ttl = timedelta(hours=float(os.environ.get('CONSTITUENTS_TTL_HOURS', DEFAULT_TTL_HOURS)))
+    return source, ttl
+
+
+def get_universe(conn) -> List[str]:
+    """
+    Returns every ticker that currently belongs to one of the indexes. The result is memoized for
+    the life of the process and only read again after a refresh stored a snapshot.
+    """
+    global _universe
+    with _universe_lock:
+        if _universe is None:
+            with conn.cursor() as cur:
+                cur.execute("SELECT DISTINCT ticker FROM index_members;")
+                _universe = [row[0] for row in cur.fetchall()]
+        return list(_universe)
+
+
+def _invalidate_universe():
+    global _universe
+    with _universe_lock:
+        _universe = None
+
+
+def refresh_constituents(conn, source: Optional[ConstituentSource] = None, ttl: Optional[timedelta] = None,
+                         force: bool = False) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Fetches the indexes whose last snapshot is older than `ttl` (all of them with force=True) and
+    stores a new snapshot of those whose membership changed. Returns {index: {'add': [...], 'remove': [...]}}
+    for the indexes that changed. The first snapshot of an index is a baseline and records no changes.
+    An index that can't be fetched keeps its previous snapshot.
+    """
+    env_source, env_ttl = get_constituent_settings()
+    source = source or env_source
+    ttl = env_ttl if ttl is None else ttl
+    with conn.cursor() as cur:
+        cur.execute("SELECT index_name, MAX(fetched_at) FROM index_snapshots GROUP BY index_name;")
+        fetched = dict(cur.fetchall())
+    now = datetime.now()
+    stale = [index for index in INDEXES if force or index not in fetched or now - fetched[index] > ttl]
+
+    changes, stored = {}, False
+    for index in stale:
+        try:
+            tickers = source.fetch(index)
+        except Exception as e:
+            print(f"Could not refresh the {index} constituents: {e}")
+            continue
+        if tickers:
+            diff = _store_snapshot(conn, index, tickers)
+            stored = True
+            if diff['add'] or diff['remove']:
+                changes[index] = diff
+                print(f"{index}: {len(diff['add'])} tickers added, {len(diff['remove'])} removed.")
+    if stored:
+        _invalidate_universe()
+    return changes
+
+
+def _store_snapshot(conn, index: str, tickers: List[str]) -> Dict[str, List[str]]:
+    """
+    Diffs `tickers` against the current members of `index` and, in one transaction, records a
+    new snapshot with its adds and removes, or just marks the last snapshot as checked.
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT ticker FROM index_members WHERE index_name = %s;", (index,))
+            current = {row[0] for row in cur.fetchall()}
+            added, removed = sorted(set(tickers) - current), sorted(current - set(tickers))
+            if not added and not removed:
+                cur.execute("""
+                    UPDATE index_snapshots SET fetched_at = CURRENT_TIMESTAMP
+                    WHERE index_name = %s AND snapshot_date = (
+                        SELECT MAX(snapshot_date) FROM index_snapshots WHERE index_name = %s);
+                """, (index, index))
+            else:
+                cur.execute("""
+                    INSERT INTO index_snapshots (index_name, snapshot_date, tickers)
+                    VALUES (%s, CURRENT_DATE, %s)
+                    ON CONFLICT (index_name, snapshot_date) DO UPDATE SET
+                        tickers = EXCLUDED.tickers,
+                        fetched_at = CURRENT_TIMESTAMP;
+                """, (index, list(tickers)))
+                cur.execute("DELETE FROM index_members WHERE index_name = %s AND ticker = ANY(%s);", (index, removed))
+                if added:
+                    execute_values(cur, """
+                        INSERT INTO index_members (index_name, ticker) VALUES %s ON CONFLICT DO NOTHING;
+                    """, [(index, ticker) for ticker in added])
+                if current:
+                    execute_values(cur, """
+                        INSERT INTO index_changes (index_name, snapshot_date, ticker, action)
+                        VALUES %s
+                        ON CONFLICT (index_name, snapshot_date, ticker) DO UPDATE SET action = EXCLUDED.action;
+                    """, [(index, ticker, 'add') for ticker in added] + [(index, ticker, 'remove') for ticker in removed],
+                        template='(%s, CURRENT_DATE, %s, %s)')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = autocommit
+    if not current:
+        return {'add': [], 'remove': []}  # Baseline snapshot
+    return {'add': added, 'remove': removed}
+
+
+class ConstituentRefresher(threading.Thread):
+    """
+    Runs refresh_constituents in the background on its own connection (from `connect`, e.g.
+    engine.raw_connection), so a run works with the stored universe while stale indexes are fetched.
+    The connection is given back with `release` (e.g. a pool's putconn), or closed if there is none.
+    Once joined, `added` holds the tickers that joined an index.
+    """
+    def __init__(self, connect: Callable, source: Optional[ConstituentSource] = None, release: Optional[Callable] = None):
+        super().__init__(name='constituent-refresher', daemon=True)
+        self.connect = connect
+        self.source = source
+        self.release = release
+        self.added = []
+
+    def run(self):
+        try:
+            conn = self.connect()
+            try:
+                changes = refresh_constituents(conn, self.source)
+            finally:
+                if self.release is not None:
+                    self.release(conn)
+                else:
+                    conn.close()
+            self.added = sorted({t for diff in changes.values() for t in diff['add']})
+        except Exception as e:
+            print(f"Error refreshing index constituents: {e}")
@@ -0,0 +1,139 @@
+import os
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from psycopg2.extras import execute_values
+
+# Constants
+OVERLAP_BARS = 2            # Stored bars refetched with every update, to compare them with the provider
+DEFAULT_TOLERANCE = 1e-4    # Relative price change below which a refetched bar counts as unchanged
+VOLUME_TOLERANCE = 0.05     # How close the volume ratio must be to the inverse price ratio to count as a split
+
+# Price adjustments applied to stored history. price_factor multiplies open/high/low/close and
+# volume_factor the volume of every bar of the ticker up to as_of (its last bar before the action).
+CORPORATE_ACTIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS corporate_actions (
+        ticker TEXT NOT NULL,
+        as_of DATE NOT NULL,
+        kind TEXT NOT NULL,
+        price_factor DOUBLE PRECISION NOT NULL,
+        volume_factor DOUBLE PRECISION NOT NULL,
+        rows_adjusted BIGINT NOT NULL,
+        detected_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (ticker, as_of)
+    );
+"""
+
+
+def get_action_tolerance():
+    """
+    Returns the relative price tolerance from the environment, falling back to the default.
+    """
+    return float(os.environ.get('CORPORATE_ACTION_TOLERANCE', DEFAULT_TOLERANCE))
+
+
+def overlap_bars(data: DataFrame, watermarks: Dict[str, str]) -> DataFrame:
+    """
+    Returns the refetched bars at or before each ticker's watermark (at most OVERLAP_BARS per ticker),
+    as rows of (ticker, timestamp, close, volume), from a (field, ticker) MultiIndex dataframe.
+    """
+    dates = data.index.values.astype('datetime64[D]')
+    closes, volumes = data['Close'], data['Volume']
+    frames = []
+    for ticker, watermark in watermarks.items():
+        if ticker not in closes.columns:
+            continue
+        stop = int(np.searchsorted(dates, np.datetime64(watermark, 'D'), side='right'))
+        window = slice(max(0, stop - OVERLAP_BARS), stop)
+        frames.append(pd.DataFrame({'ticker': ticker, 'timestamp': dates[window],
+                                    'close': closes[ticker].values[window], 'volume': volumes[ticker].values[window]}))
+    if not frames:
+        return pd.DataFrame(columns=['ticker', 'timestamp', 'close', 'volume'])
+    return pd.concat(frames, ignore_index=True).dropna()
+
+
+def detect_actions(cur, overlap: DataFrame, tolerance: float = None) -> List[tuple]:
+    """
+    Compares the refetched bars with the stored ones, in one query. A ticker whose refetched bars
+    all moved by the same factor had its history re-adjusted by the provider (a split or a dividend).
+    A change in the last bar alone is a late revision of that bar, not an adjustment, and is ignored.
+    Returns (ticker, as_of, kind, price_factor, volume_factor) tuples.
+    """
+    if overlap.empty:
+        return []
+    tolerance = get_action_tolerance() if tolerance is None else tolerance
+    cur.execute("""
+        SELECT d.ticker, d.timestamp, d.close, d.volume
+        FROM unnest(%s::text[], %s::date[]) AS o(ticker, timestamp)
+        JOIN stock_data d ON d.ticker = o.ticker AND d.timestamp = o.timestamp;
+    """, (overlap['ticker'].tolist(), overlap['timestamp'].astype(str).tolist()))
+    stored = pd.DataFrame(cur.fetchall(), columns=['ticker', 'timestamp', 'stored_close', 'stored_volume'])
+    if stored.empty:
+        return []
+    stored['timestamp'] = stored['timestamp'].astype('datetime64[ns]')
+    bars = overlap.astype({'timestamp': 'datetime64[ns]'}).merge(stored, on=['ticker', 'timestamp'])
+    bars = bars[bars['stored_close'] > 0]
+    bars['price_ratio'] = bars['close'] / bars['stored_close']
+    bars['volume_ratio'] = bars['volume'] / bars['stored_volume'].where(bars['stored_volume'] > 0)
+
+    actions = []
+    for ticker, group in bars.groupby('ticker', sort=False):
+        ratios = group['price_ratio'].values
+        if len(group) < OVERLAP_BARS or np.all(np.abs(ratios - 1) <= tolerance):
+            continue
+        if np.ptp(ratios) > tolerance * ratios.mean():
+            continue  # Bars moved differently: a revision, not an adjustment.
+        price_factor = float(ratios.mean())
+        volume_ratios = group['volume_ratio'].values
+        # Splits rescale the volume by the inverse factor; dividends leave it alone.
+        is_split = np.all(np.abs(volume_ratios * price_factor - 1) <= VOLUME_TOLERANCE) and \
+            np.all(np.abs(volume_ratios - 1) > VOLUME_TOLERANCE)
+        actions.append((ticker, group['timestamp'].max().date(), 'split' if is_split else 'dividend',
+                        price_factor, float(1 / price_factor) if is_split else 1.0))
+    return actions
+
+
+def apply_actions(cur, actions: List[tuple]) -> Tuple[int, Optional[date]]:
+    """
+    Rescales the stored history of every ticker in `actions` with one set-based UPDATE, records the
+    actions and bumps the tickers' watermark revision so caches of their history are invalidated.
+    Returns the number of rows adjusted and the date of the earliest one (None if there were none),
+    which bound the window of aggregates to refresh (see timescale.refresh_aggregates).
+    Compressed chunks (only enabled on TimescaleDB 2.11 or later, see timescale.configure_timescale)
+    are updated in place: every chunk touched has the ticker's segment decompressed, and the
+    compression policy recompresses it on its next run. The cost grows with the number of chunks in
+    the ticker's history, once per detected action, not with the size of the other tickers.
+    """
+    if not actions:
+        return 0, None
+    values = [(ticker, as_of, price_factor, volume_factor) for ticker, as_of, _, price_factor, volume_factor in actions]
+    counts = execute_values(cur, """
+        WITH adjusted AS (
+            UPDATE stock_data d SET
+                open = d.open * a.price_factor,
+                high = d.high * a.price_factor,
+                low = d.low * a.price_factor,
+                close = d.close * a.price_factor,
+                volume = ROUND(d.volume * a.volume_factor)::bigint
+            FROM (VALUES %s) AS a(ticker, as_of, price_factor, volume_factor)
+            WHERE d.ticker = a.ticker AND d.timestamp <= a.as_of
+            RETURNING d.ticker, d.timestamp
+        )
+        SELECT ticker, COUNT(*), MIN(timestamp) FROM adjusted GROUP BY ticker;
+    """, values, template='(%s, %s::date, %s::double precision, %s::double precision)', fetch=True)
+    adjusted = {ticker: count for ticker, count, _ in counts}
+    execute_values(cur, """
+        INSERT INTO corporate_actions (ticker, as_of, kind, price_factor, volume_factor, rows_adjusted)
+        VALUES %s
+        ON CONFLICT (ticker, as_of) DO UPDATE SET
+            price_factor = corporate_actions.price_factor * EXCLUDED.price_factor,
+            volume_factor = corporate_actions.volume_factor * EXCLUDED.volume_factor,
+            rows_adjusted = EXCLUDED.rows_adjusted,
+            detected_at = CURRENT_TIMESTAMP;
+    """, [action + (int(adjusted.get(action[0], 0)),) for action in actions])
+    cur.execute("UPDATE ticker_watermarks SET revision = revision + 1 WHERE ticker = ANY(%s);",
+                ([action[0] for action in actions],))
+    return int(sum(adjusted.values())), min((since for _, _, since in counts), default=None)
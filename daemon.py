@@ -0,0 +1,90 @@
+import os
+import signal
+import threading
+from datetime import timedelta
+from typing import Callable
+
+import pandas as pd
+
+# Constants
+DEFAULT_CLOSE_DELAY_MINUTES = 30  # Wait after the close so the provider has published the final bars
+CYCLE_CONNECTIONS = 2             # Pooled DB connections an update uses at once: its own and the constituent refresher's
+MAX_SLEEP = 300                   # seconds; sleeps are split so clock jumps (e.g. a suspended host) are noticed
+
+
+def get_daemon_settings():
+    """
+    Returns the delay after the close from the environment, falling back to the default.
+    """
+    return timedelta(minutes=float(os.environ.get('DAEMON_CLOSE_DELAY_MINUTES', DEFAULT_CLOSE_DELAY_MINUTES)))
+
+
+class Scheduler:
+    """
+    Runs `cycle` right away and then `close_delay` after every market close, sleeping in between.
+    `sessions` returns the SessionIndex used to find the next close. A failing cycle is reported
+    and the next one runs as scheduled.
+
+    SIGTERM and SIGINT stop the scheduler once the running cycle is over (a second one interrupts it;
+    the journal replays whatever was downloaded). SIGHUP and SIGUSR1 run a cycle right away.
+    """
+    def __init__(self, cycle: Callable[[], None], sessions: Callable, close_delay: timedelta):
+        self.cycle = cycle
+        self.sessions = sessions
+        self.close_delay = pd.Timedelta(close_delay)
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for name in ('SIGHUP', 'SIGUSR1'):
+            if hasattr(signal, name):  # Not available on Windows.
+                signal.signal(getattr(signal, name), self._on_refresh)
+
+    def _on_stop(self, signum, frame):
+        if self._stop.is_set():
+            raise KeyboardInterrupt
+        print(f"Received {signal.Signals(signum).name}, stopping after the current update.")
+        self._stop.set()
+        self._wake.set()
+
+    def _on_refresh(self, signum, frame):
+        print(f"Received {signal.Signals(signum).name}, updating now.")
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def next_run(self, now=None) -> pd.Timestamp:
+        """
+        The first market close (plus the delay) whose run time is after `now` (UTC, defaults to the current time).
+        """
+        now = pd.Timestamp.now(tz='UTC') if now is None else pd.Timestamp(now)
+        return self.sessions().next_close(now - self.close_delay) + self.close_delay
+
+    def _sleep_until(self, when: pd.Timestamp):
+        """
+        Sleeps until `when`, a refresh signal or a stop, whichever comes first.
+        """
+        while not self._wake.is_set():
+            remaining = (when - pd.Timestamp.now(tz='UTC')).total_seconds()
+            if remaining <= 0:
+                break
+            self._wake.wait(min(remaining, MAX_SLEEP))
+        self._wake.clear()
+
+    def run(self):
+        self.install_signal_handlers()
+        while not self._stop.is_set():
+            try:
+                self.cycle()
+            except Exception as e:
+                print(f"Update failed: {e}")
+            if self._stop.is_set():
+                break
+            when = self.next_run()
+            print(f"Next update at {when.tz_convert('America/New_York'):%Y-%m-%d %H:%M %Z}.")
+            self._sleep_until(when)
+        print('Scheduler stopped.')
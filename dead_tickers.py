@@ -0,0 +1,85 @@
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List
+
+from psycopg2.extras import execute_values
+
+# Constants
+DEFAULT_COOL_OFF_DAYS = 7   # First skip period, doubled on every further failure
+MAX_COOL_OFF_DAYS = 90
+DEFAULT_THRESHOLD = 2       # Consecutive failed runs before a ticker is skipped
+
+# Tickers that keep failing or come back empty (delisted, renamed...). Runs skip them until retry_after.
+DEAD_TICKERS_DDL = """
+    CREATE TABLE IF NOT EXISTS dead_tickers (
+        ticker TEXT PRIMARY KEY,
+        reason TEXT NOT NULL,
+        failures INTEGER NOT NULL,
+        first_failed TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_failed TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        retry_after TIMESTAMP NOT NULL
+    );
+"""
+
+
+def get_dead_ticker_settings():
+    """
+    Returns the (cool_off_days, threshold) tuple from the environment, falling back to the defaults.
+    """
+    cool_off = int(os.environ.get('DEAD_TICKER_COOL_OFF_DAYS', DEFAULT_COOL_OFF_DAYS))
+    threshold = int(os.environ.get('DEAD_TICKER_THRESHOLD', DEFAULT_THRESHOLD))
+    return max(0, cool_off), max(1, threshold)
+
+
+def record_failures(conn, failed: Dict[str, str]):
+    """
+    Records one more failed run for each ticker ({ticker: reason}). Once a ticker reaches the
+    threshold it is skipped for a cool-off period that doubles with every further failure.
+    """
+    if not failed:
+        return
+    cool_off, threshold = get_dead_ticker_settings()
+    now = datetime.utcnow()
+    with conn.cursor() as cur:
+        cur.execute("SELECT ticker, failures FROM dead_tickers WHERE ticker = ANY(%s);", (list(failed),))
+        previous = dict(cur.fetchall())
+        rows = []
+        for ticker, reason in failed.items():
+            failures = previous.get(ticker, 0) + 1
+            if failures >= threshold:
+                days = min(MAX_COOL_OFF_DAYS, cool_off * 2 ** (failures - threshold))
+                retry_after = now + timedelta(days=days)
+            else:
+                retry_after = now
+            rows.append((ticker, reason, failures, now, now, retry_after))
+        execute_values(cur, """
+            INSERT INTO dead_tickers (ticker, reason, failures, first_failed, last_failed, retry_after)
+            VALUES %s
+            ON CONFLICT (ticker) DO UPDATE SET
+                reason = EXCLUDED.reason,
+                failures = EXCLUDED.failures,
+                last_failed = EXCLUDED.last_failed,
+                retry_after = EXCLUDED.retry_after;
+        """, rows)
+    skipped = sum(1 for row in rows if row[5] > now)
+    print(f"{len(rows)} tickers failed to download, {skipped} of them will be skipped for a while.")
+
+
+def clear_tickers(conn, tickers: Iterable[str]):
+    """
+    Forgets past failures of tickers that downloaded fine again.
+    """
+    tickers = list(tickers)
+    if not tickers:
+        return
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM dead_tickers WHERE ticker = ANY(%s);", (tickers,))
+
+
+def get_skipped_tickers(conn) -> List[str]:
+    """
+    Returns the tickers still in their cool-off period.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT ticker FROM dead_tickers WHERE retry_after > %s;", (datetime.utcnow(),))
+        return [row[0] for row in cur.fetchall()]
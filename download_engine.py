@@ -0,0 +1,193 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from pandas import DataFrame
+import yfinance as yf
+
+from metrics import metrics
+
+# Constants
+DEFAULT_WORKERS = 4       # Parallel downloads in flight
+DEFAULT_CHUNK_SIZE = 100  # Max tickers per provider call
+MAX_RETRIES = 3           # Attempts per batch before bisecting it
+RETRY_BASE_DELAY = 2      # seconds, doubled on every attempt
+RETRY_MAX_DELAY = 60      # seconds
+
+
+class Fetcher:
+    """
+    Interface for OHLCV providers. `fetch` must return a dataframe shaped like the output of
+    `yf.download`: a DatetimeIndex and either flat Open/High/Low/Close/Volume columns (single ticker)
+    or a (field, ticker) MultiIndex on the columns.
+    Implement this to plug a different provider (or a local fake one) into the download engine.
+    """
+    def fetch(self, tickers: List[str], start: str, end: Optional[str] = None) -> DataFrame:
+        raise NotImplementedError
+
+
+class YFinanceFetcher(Fetcher):
+    """
+    Default provider backed by Yahoo! Finance. Internal yfinance threading is disabled because
+    parallelism is handled by the engine's worker pool.
+    """
+    def fetch(self, tickers: List[str], start: str, end: Optional[str] = None) -> DataFrame:
+        return yf.download(tickers, start=start, end=end, threads=False, progress=False)
+
+
+def get_download_settings():
+    """
+    Returns the (workers, chunk_size) tuple from the environment, falling back to the defaults.
+    """
+    workers = int(os.environ.get('DOWNLOAD_WORKERS', DEFAULT_WORKERS))
+    chunk_size = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+    return max(1, workers), max(1, chunk_size)
+
+
+def chunk_tickers(tickers: List[str], chunk_size: int) -> List[List[str]]:
+    """
+    Splits a list of tickers into size-bounded chunks.
+    """
+    return [tickers[i:i + chunk_size] for i in range(0, len(tickers), chunk_size)]
+
+
+def split_download_lists(download_lists: List[Dict], chunk_size: int) -> List[Dict]:
+    """
+    Expands the date groups produced by `calculate_downloads` into chunks of at most `chunk_size` tickers.
+    Every other key of the group is carried over to its chunks.
+    """
+    chunks = []
+    for item in download_lists:
+        for tickers in chunk_tickers(item['tickers'], chunk_size):
+            chunk = dict(item)
+            chunk['tickers'] = tickers
+            chunks.append(chunk)
+    return chunks
+
+
+class DownloadReport:
+    """
+    Outcome of a download run, filled in by the worker threads: the tickers that returned data and
+    the ones that failed, mapped to the reason ('error' when the provider kept failing on that symbol,
+    'empty' when it answered with no rows while other tickers of the same call had data).
+    """
+    def __init__(self):
+        self.succeeded = set()
+        self.failed = {}
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def add(self, succeeded=(), failed=None, retries=0):
+        with self._lock:
+            self.succeeded.update(succeeded)
+            self.failed.update(failed or {})
+            self.retries += retries
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter for the given (0-based) retry attempt.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def fetch_with_retries(fetcher: Fetcher, tickers: List[str], start: str, end: Optional[str] = None,
+                       report: Optional[DownloadReport] = None) -> Optional[DataFrame]:
+    """
+    Calls the fetcher, retrying on errors with exponential backoff and jitter. Returns None if all attempts fail.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            with metrics.timer('download'):
+                return fetcher.fetch(tickers, start, end)
+        except Exception as e: # yf.download() is buggy, specially for 1000s of tickers, so it's better to do this.
+            metrics.incr('download_errors')
+            print(f"Error downloading {len(tickers)} tickers from {start}: {e}")
+            if attempt < MAX_RETRIES - 1:
+                delay = backoff_delay(attempt)
+                print(f"Retrying in {delay:.1f} seconds...")
+                metrics.incr('retries')
+                if report is not None:
+                    report.add(retries=1)
+                time.sleep(delay)
+    return None
+
+
+def _as_multiindex(data: DataFrame, tickers: List[str]) -> DataFrame:
+    """
+    Returns the provider output with a (field, ticker) MultiIndex on the columns, even for a single ticker.
+    """
+    if isinstance(data.columns, pd.MultiIndex):
+        return data
+    return pd.concat({tickers[0]: data}, axis=1).swaplevel(0, 1, axis=1)
+
+
+def fetch_isolating_failures(fetcher: Fetcher, tickers: List[str], start: str, end: Optional[str] = None,
+                             report: Optional[DownloadReport] = None) -> Optional[DataFrame]:
+    """
+    Fetches a batch, and when it keeps failing bisects it to isolate the bad symbols instead of
+    dropping (or re-downloading) the whole batch. Returns the data of every ticker that could be
+    fetched, or None if nothing could. Successes and failures are recorded in `report`.
+    """
+    report = report or DownloadReport()
+    data = fetch_with_retries(fetcher, tickers, start, end, report)
+    if data is None:
+        if len(tickers) == 1:
+            print(f"Failed to download {tickers[0]} after {MAX_RETRIES} attempts.")
+            report.add(failed={tickers[0]: 'error'})
+            return None
+        middle = len(tickers) // 2
+        print(f"Bisecting a failing batch of {len(tickers)} tickers from {start}.")
+        halves = [fetch_isolating_failures(fetcher, half, start, end, report) for half in (tickers[:middle], tickers[middle:])]
+        halves = [h for h in halves if h is not None]
+        return pd.concat(halves, axis=1) if halves else None
+
+    data = _as_multiindex(data, tickers)
+    if data.empty:
+        return None
+    closes = data['Close'] if 'Close' in data.columns.get_level_values(0) else pd.DataFrame(index=data.index)
+    with_rows = set(closes.columns[closes.notna().any()])
+    # An all-NaN ticker only means something if others in the same call did get rows.
+    empty = {t: 'empty' for t in tickers if t not in with_rows} if with_rows else {}
+    report.add(succeeded=with_rows, failed=empty)
+    return data
+
+
+def download_batches(download_lists: List[Dict], fetcher: Optional[Fetcher] = None, workers: Optional[int] = None,
+                     chunk_size: Optional[int] = None, end: Optional[str] = None,
+                     report: Optional[DownloadReport] = None) -> Iterator[Tuple[Dict, DataFrame]]:
+    """
+    Splits every date group into chunks and downloads them in parallel with a pool of `workers` threads.
+    Yields (chunk, data) tuples in completion order, with a (field, ticker) MultiIndex on the columns.
+    Failing chunks are bisected to isolate bad symbols; the outcome per ticker is recorded in `report`.
+    An item with its own 'end' date (exclusive, like gap backfills) is fetched up to it instead of `end`.
+    At most `workers` chunks are in flight or waiting to be consumed, so a slow consumer throttles
+    the downloads instead of piling results up in memory.
+    """
+    fetcher = fetcher or YFinanceFetcher()
+    env_workers, env_chunk_size = get_download_settings()
+    workers = workers or env_workers
+    chunk_size = chunk_size or env_chunk_size
+
+    pending_chunks = iter(split_download_lists(download_lists, chunk_size))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit_next(futures):
+            chunk = next(pending_chunks, None)
+            if chunk is not None:
+                futures[pool.submit(fetch_isolating_failures, fetcher, chunk['tickers'], chunk['date'], chunk.get('end', end), report)] = chunk
+
+        futures = {}
+        for _ in range(workers):
+            submit_next(futures)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = futures.pop(future)
+                data = future.result()
+                if data is not None and not data.empty:
+                    yield chunk, data
+                submit_next(futures)
@@ -0,0 +1,304 @@
+import io
+import os
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from pandas import DataFrame
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from close_matrix import CloseMatrix
+from reader import copy_to_arrow
+from timescale import get_timescale_settings
+from watermarks import get_watermarks
+
+# Constants
+DEFAULT_BLOCK_SESSIONS = 250  # Sessions computed and COPYed at a time (plus the lookback of the widest window)
+SESSIONS_PER_YEAR = 252       # Annualizes the volatilities
+
+# Derived features of every (date, ticker) bar, one column per registered feature (see register).
+# feature_state holds the watermarks each ticker's features were computed from, like the close matrix index.
+FEATURES_DDL = """
+    CREATE TABLE IF NOT EXISTS features (
+        timestamp DATE NOT NULL,
+        ticker TEXT NOT NULL,
+        UNIQUE (timestamp, ticker)
+    );
+    CREATE TABLE IF NOT EXISTS feature_state (
+        ticker TEXT PRIMARY KEY,
+        first_ts DATE NOT NULL,
+        last_ts DATE NOT NULL,
+        row_count BIGINT NOT NULL,
+        revision INTEGER NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+
+class Feature(NamedTuple):
+    window: int                                # Earlier sessions each value depends on
+    compute: Callable[[DataFrame], DataFrame]
+    cross_sectional: bool = False              # Depends on the other tickers of the same session
+
+
+FEATURES: Dict[str, Feature] = {}
+
+
+def register(name: str, window: int, cross_sectional: bool = False):
+    """
+    Decorator that adds a feature to the registry. The function gets a (sessions x tickers) frame of
+    closes, laid out like CloseMatrix.to_frame with NaN for missing bars, and returns a frame of the
+    same shape whose row i depends only on rows i - window to i. Unless the feature is
+    `cross_sectional` (like ranks), column j must also depend only on column j, so it can be computed
+    for just the tickers being updated. A newly registered feature gets its column, and the whole
+    table is rebuilt, on the next update.
+    """
+    def decorator(fn):
+        FEATURES[name] = Feature(window, fn, cross_sectional)
+        return fn
+    return decorator
+
+
+def _log_returns(close: DataFrame) -> DataFrame:
+    return np.log(close).diff()
+
+
+@register('ret_1d', 1)
+def ret_1d(close):
+    return close.pct_change(1, fill_method=None)
+
+
+@register('ret_5d', 5)
+def ret_5d(close):
+    return close.pct_change(5, fill_method=None)
+
+
+@register('ret_21d', 21)
+def ret_21d(close):
+    return close.pct_change(21, fill_method=None)
+
+
+@register('sma_20', 19)
+def sma_20(close):
+    return close.rolling(20).mean()
+
+
+@register('sma_50', 49)
+def sma_50(close):
+    return close.rolling(50).mean()
+
+
+@register('sma_200', 199)
+def sma_200(close):
+    return close.rolling(200).mean()
+
+
+@register('vol_20d', 20)
+def vol_20d(close):
+    return _log_returns(close).rolling(20).std() * np.sqrt(SESSIONS_PER_YEAR)
+
+
+@register('vol_60d', 60)
+def vol_60d(close):
+    return _log_returns(close).rolling(60).std() * np.sqrt(SESSIONS_PER_YEAR)
+
+
+@register('rank_ret_1d', 1, cross_sectional=True)
+def rank_ret_1d(close):
+    return ret_1d(close).rank(axis=1, pct=True)
+
+
+@register('rank_ret_21d', 21, cross_sectional=True)
+def rank_ret_21d(close):
+    return ret_21d(close).rank(axis=1, pct=True)
+
+
+def configure_features(conn):
+    """
+    Turns the features table into a hypertable with the same chunk interval as stock_data.
+    `conn` must be in autocommit mode. Safe to run again.
+    """
+    chunk_interval, _ = get_timescale_settings()
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = 'features';
+        """)
+        if not cursor.fetchone():
+            cursor.execute("SELECT create_hypertable('features', 'timestamp', chunk_time_interval => %s::interval);",
+                           (chunk_interval,))
+            print("Hypertable features created successfully.")
+
+
+def _add_columns(cur, names: List[str]) -> bool:
+    """
+    Adds a column for every registered feature the table doesn't have yet. Returns True if any was added.
+    """
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns WHERE table_name = 'features';
+    """)
+    existing = {row[0] for row in cur.fetchall()}
+    missing = [name for name in names if name not in existing]
+    for name in missing:
+        cur.execute(sql.SQL("ALTER TABLE features ADD COLUMN {} DOUBLE PRECISION;").format(sql.Identifier(name)))
+    return bool(missing)
+
+
+def _get_state(cur) -> Dict[str, list]:
+    cur.execute("SELECT ticker, first_ts, last_ts, row_count, revision FROM feature_state;")
+    return {t: [str(f), str(l), int(n), int(r)] for t, f, l, n, r in cur.fetchall()}
+
+
+def _encode_block(dates: np.ndarray, tickers: np.ndarray, values: Dict[str, np.ndarray]) -> io.BytesIO:
+    """
+    Encodes feature rows as CSV for COPY. NaN and infinite values become NULL.
+    """
+    columns = {'timestamp': pa.array(dates, type=pa.date32()), 'ticker': pa.array(tickers, type=pa.string())}
+    for name, array in values.items():
+        columns[name] = pa.array(array, mask=~np.isfinite(array), type=pa.float64())
+    buffer = io.BytesIO()
+    pacsv.write_csv(pa.table(columns), buffer, pacsv.WriteOptions(include_header=False))
+    buffer.seek(0)
+    return buffer
+
+
+def _write_pass(cur, copy, matrix: CloseMatrix, starts: Dict[int, int], ends: Dict[int, int], block_sessions: int) -> int:
+    """
+    Computes the features of the matrix columns in `starts`, for their rows from starts[column] up to
+    ends[column] (exclusive), `block_sessions` rows at a time, and COPYs them. Per-ticker features
+    only read those columns (plus the lookback of their window). Cross-sectional features read every
+    column, but only for the rows of the block. Returns the number of rows written.
+    """
+    columns = np.fromiter(starts, dtype=np.int64)
+    first_rows = np.fromiter(starts.values(), dtype=np.int64)
+    end_rows = np.fromiter(ends.values(), dtype=np.int64)
+    tickers = np.array(matrix.tickers, dtype=object)
+    lookback = max([f.window for f in FEATURES.values() if not f.cross_sectional], default=0)
+    values = matrix.values
+    rows = 0
+    for lo in range(int(first_rows.min()), int(end_rows.max()), block_sessions):
+        hi = min(lo + block_sessions, int(end_rows.max()))
+        offset = max(0, lo - lookback)
+        close = pd.DataFrame(np.asarray(values[offset:hi][:, columns], dtype='float64'))
+        positions = np.arange(lo, hi)[:, None]
+        mask = (positions >= first_rows) & (positions < end_rows) & ~np.isnan(close.to_numpy()[lo - offset:])
+        r, c = np.nonzero(mask)
+        if not len(r):
+            continue
+        computed, universe = {}, {}
+        for name, feature in FEATURES.items():
+            if feature.cross_sectional:
+                start = max(0, lo - feature.window)
+                if start not in universe:
+                    universe[start] = pd.DataFrame(np.asarray(values[start:hi], dtype='float64'))
+                result = feature.compute(universe[start]).to_numpy()[lo - start:, columns]
+            else:
+                result = feature.compute(close).to_numpy()[lo - offset:]
+            computed[name] = result[r, c]
+        cur.copy_expert(copy, _encode_block(matrix.dates[lo + r], tickers[columns[c]], computed))
+        rows += len(r)
+    return rows
+
+
+def update_features(conn, matrix: Optional[CloseMatrix] = None, block_sessions: Optional[int] = None) -> int:
+    """
+    Brings the features table up to date with the close matrix, which must have been refreshed first
+    (see assets_db.refresh_close_matrix). Like the matrix, it compares the watermarks with the ones the
+    features were computed from: tickers that only gained sessions get features for the new bars only,
+    computed from the last `window` sessions before them (the rolling-window state, read straight
+    from the matrix), and tickers whose history changed in any other way (backfills, split and
+    dividend repairs) get all their rows rewritten in a separate pass over their own columns.
+    Only cross-sectional features (ranks) read the whole universe, and only on the sessions being
+    written; the ranks of other tickers on rewritten dates are left as they were. Everything is
+    written with COPY in one transaction. Returns the number of rows written.
+    """
+    matrix = matrix or CloseMatrix()
+    block_sessions = block_sessions or int(os.environ.get('FEATURES_BLOCK_SESSIONS', DEFAULT_BLOCK_SESSIONS))
+    names = list(FEATURES)
+    watermarks = get_watermarks(conn)
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            if _add_columns(cur, names):
+                print('New features registered, rebuilding the features table.')
+                cur.execute("TRUNCATE features, feature_state;")
+            state = _get_state(cur)
+
+            # First row to (re)compute and last row with data, per matrix column, for the tickers
+            # that only gained sessions and for the ones computed from the start of their history.
+            appended, full, ends, rewrite, synced = {}, {}, {}, [], []
+            values = matrix.values
+            for ticker, wm in watermarks.iterrows():
+                column = matrix.columns.get(ticker)
+                if column is None:
+                    continue
+                current = [str(wm['first_ts']), str(wm['last_ts']), int(wm['row_count']), int(wm['revision'])]
+                previous = state.get(ticker)
+                if previous == current:
+                    continue
+                ends[column] = int(np.searchsorted(matrix.dates, np.datetime64(current[1], 'D'), side='right'))
+                if previous and previous[0] == current[0] and previous[3] == current[3] and previous[1] < current[1]:
+                    start = int(np.searchsorted(matrix.dates, np.datetime64(previous[1], 'D'), side='right'))
+                    if previous[2] + np.count_nonzero(~np.isnan(values[start:ends[column], column])) == current[2]:
+                        appended[column] = start
+                if column not in appended:
+                    full[column] = int(np.searchsorted(matrix.dates, np.datetime64(current[0], 'D'), side='left'))
+                    if previous:
+                        rewrite.append(ticker)
+                synced.append((ticker,) + tuple(current))
+            removed = [t for t in state if t not in watermarks.index]
+            if rewrite or removed:
+                cur.execute("DELETE FROM features WHERE ticker = ANY(%s);", (rewrite + removed,))
+                cur.execute("DELETE FROM feature_state WHERE ticker = ANY(%s);", (rewrite + removed,))
+
+            rows = 0
+            copy = sql.SQL("COPY features (timestamp, ticker, {}) FROM STDIN WITH (FORMAT csv)").format(
+                sql.SQL(', ').join(map(sql.Identifier, names)))
+            for starts in (appended, full):
+                if starts:
+                    rows += _write_pass(cur, copy, matrix, starts, {c: ends[c] for c in starts}, block_sessions)
+            if synced:
+                execute_values(cur, """
+                    INSERT INTO feature_state (ticker, first_ts, last_ts, row_count, revision)
+                    VALUES %s
+                    ON CONFLICT (ticker) DO UPDATE SET
+                        first_ts = EXCLUDED.first_ts,
+                        last_ts = EXCLUDED.last_ts,
+                        row_count = EXCLUDED.row_count,
+                        revision = EXCLUDED.revision,
+                        updated_at = CURRENT_TIMESTAMP;
+                """, synced)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = autocommit
+    if synced or removed:
+        print(f"Features updated for {len(synced)} tickers ({len(rewrite)} rewritten), {rows} rows written.")
+    return rows
+
+
+def read_features_arrow(conn, tickers: List[str], initial_date, end_date, names: Optional[List[str]] = None) -> pa.Table:
+    """
+    Returns the features of `tickers` between the two dates (inclusive) as an Arrow table ordered by
+    timestamp and ticker, with every registered feature or only `names`.
+    """
+    names = list(names or FEATURES)
+    unknown = [name for name in names if name not in FEATURES]
+    if unknown:
+        raise ValueError(f"Unknown features: {', '.join(unknown)}. Use any of: {', '.join(FEATURES)}.")
+    types = {'timestamp': pa.date32(), 'ticker': pa.string()}
+    types.update({name: pa.float64() for name in names})
+    query = sql.SQL("""
+        SELECT timestamp, ticker, {}
+        FROM features
+        WHERE ticker = ANY(%s) AND
+              timestamp BETWEEN %s AND %s
+        ORDER BY timestamp, ticker
+    """).format(sql.SQL(', ').join(map(sql.Identifier, names)))
+    return copy_to_arrow(conn, query, (list(tickers), initial_date, end_date), types)
@@ -0,0 +1,140 @@
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pandas import DataFrame
+from psycopg2.extras import execute_values
+
+from download_engine import chunk_tickers, get_download_settings
+from reader import copy_to_arrow
+from watermarks import get_watermarks
+
+# Constants
+DEFAULT_MAX_ATTEMPTS = 2  # Backfills of the same gap before it is accepted as a hole in the provider's data
+
+# Missing ranges found by the gap auditor, with the number of backfills already attempted.
+KNOWN_GAPS_DDL = """
+    CREATE TABLE IF NOT EXISTS known_gaps (
+        ticker TEXT NOT NULL,
+        start_date DATE NOT NULL,
+        end_date DATE NOT NULL,
+        attempts INTEGER NOT NULL,
+        audited_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (ticker, start_date, end_date)
+    );
+"""
+GAP_COLUMNS = ['ticker', 'start', 'end', 'sessions']
+
+
+def get_gap_settings():
+    """
+    Returns the maximum number of backfill attempts per gap from the environment, falling back to the default.
+    """
+    return max(1, int(os.environ.get('GAP_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)))
+
+
+def find_gaps(conn, sessions, tickers: Optional[List[str]] = None) -> DataFrame:
+    """
+    Returns the sessions missing inside each ticker's stored history as minimal contiguous ranges,
+    one row per range with the ticker, its first and last missing session and its length.
+    Tickers whose row count matches the number of sessions between their first and last date are
+    complete, so only the others have their dates read. Those are laid out as a (tickers x sessions)
+    presence matrix, and the ranges are the edges of the runs of missing sessions.
+    """
+    days = sessions.sessions
+    watermarks = get_watermarks(conn, tickers)
+    if watermarks.empty:
+        return pd.DataFrame(columns=GAP_COLUMNS)
+    first = np.searchsorted(days, watermarks['first_ts'].values.astype('datetime64[D]'), side='left')
+    last = np.searchsorted(days, watermarks['last_ts'].values.astype('datetime64[D]'), side='right')
+    incomplete = watermarks['row_count'].values < last - first
+    candidates = watermarks.index[incomplete]
+    if candidates.empty:
+        return pd.DataFrame(columns=GAP_COLUMNS)
+    first, last = first[incomplete], last[incomplete]
+
+    table = copy_to_arrow(conn, """
+        SELECT ticker, timestamp
+        FROM stock_data
+        WHERE ticker = ANY(%s)
+    """, (list(candidates),), {'ticker': pa.string(), 'timestamp': pa.date32()})
+    stored = table['timestamp'].to_numpy().astype('datetime64[D]')
+    rows = candidates.get_indexer(table['ticker'].to_numpy(zero_copy_only=False))
+    cols = np.searchsorted(days, stored)
+    valid = (rows >= 0) & (cols < len(days)) & (days[np.minimum(cols, len(days) - 1)] == stored)
+
+    columns = np.arange(len(days))
+    missing = (columns >= first[:, None]) & (columns < last[:, None])
+    missing[rows[valid], cols[valid]] = False
+
+    edges = np.diff(np.pad(missing.view(np.int8), ((0, 0), (1, 1))), axis=1)
+    starts_row, starts_col = np.nonzero(edges == 1)
+    _, ends_col = np.nonzero(edges == -1)  # Exclusive; nonzero scans row by row, so both lists pair up.
+    return pd.DataFrame({
+        'ticker': candidates[starts_row],
+        'start': days[starts_col],
+        'end': days[ends_col - 1],
+        'sessions': ends_col - starts_col,
+    })
+
+
+def plan_gap_fills(conn, sessions, tickers: Optional[List[str]] = None, chunk_size: Optional[int] = None,
+                   max_attempts: Optional[int] = None, record: bool = True) -> List[Dict]:
+    """
+    Audits the stored history (see find_gaps) and returns download plan items that backfill the gaps.
+    Tickers missing exactly the same range share the same items, which have an exclusive 'end' date
+    and only cover missing sessions, so nothing already stored is fetched again.
+    A gap still there after `max_attempts` backfills is a hole in the provider's data too (halts,
+    bars with no prices) and is left alone. With record=True the attempts are counted in known_gaps.
+    """
+    max_attempts = max_attempts or get_gap_settings()
+    chunk_size = chunk_size or get_download_settings()[1]
+    gaps = find_gaps(conn, sessions, tickers)
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT ticker, start_date, end_date, attempts FROM known_gaps;")
+        known = {(t, pd.Timestamp(s), pd.Timestamp(e)): a for t, s, e, a in cur.fetchall()}
+    gaps['attempts'] = [known.get(key, 0) for key in zip(gaps['ticker'], gaps['start'], gaps['end'])]
+    to_fill = gaps[gaps['attempts'] < max_attempts]
+    if record:
+        _record_attempts(conn, gaps, tickers, to_fill.index)
+
+    plan = []
+    for (start, end), group in to_fill.groupby(['start', 'end'], sort=True):
+        for chunk in chunk_tickers(group['ticker'].tolist(), chunk_size):
+            plan.append({"date": start.strftime('%Y-%m-%d'), "end": (end + pd.Timedelta(days=1)).strftime('%Y-%m-%d'), "tickers": chunk,
+                         "rows": int(len(chunk) * group['sessions'].iloc[0])})
+    if plan:
+        print(f"Backfilling {len(to_fill)} gaps ({int(to_fill['sessions'].sum())} sessions) in {len(plan)} requests."
+              + (f" {len(gaps) - len(to_fill)} gaps are left as known holes." if len(gaps) > len(to_fill) else ""))
+    return plan
+
+
+def _record_attempts(conn, gaps: DataFrame, tickers: Optional[List[str]], attempted):
+    """
+    Replaces the known gaps of the audited tickers with the ones just found, counting one more
+    attempt for those about to be backfilled. Gaps that were filled disappear from the table.
+    """
+    rows = [(t, s.date(), e.date(), int(a) + (i in attempted))
+            for i, t, s, e, a in zip(gaps.index, gaps['ticker'], gaps['start'], gaps['end'], gaps['attempts'])]
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            if tickers is None:
+                cur.execute("DELETE FROM known_gaps;")
+            else:
+                cur.execute("DELETE FROM known_gaps WHERE ticker = ANY(%s);", (list(tickers),))
+            if rows:
+                execute_values(cur, """
+                    INSERT INTO known_gaps (ticker, start_date, end_date, attempts)
+                    VALUES %s;
+                """, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = autocommit
@@ -0,0 +1,355 @@
+import io
+import os
+import queue
+import threading
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from corporate_actions import apply_actions, detect_actions, overlap_bars
+from metrics import metrics
+from watermarks import upsert_watermarks, upsert_watermarks_from_staging
+
+# Constants
+DEFAULT_BATCH_ROWS = 200000  # Rows accumulated before a COPY + commit
+DEFAULT_QUEUE_SIZE = 4       # Downloaded batches waiting for the writer
+OHLCV_FIELDS = ['Open', 'High', 'Low', 'Close', 'Volume']
+STOCK_DATA_COLUMNS = ('timestamp', 'ticker', 'open', 'high', 'low', 'close', 'volume')
+DEFAULT_FORMAT = 'csv'       # COPY format: 'csv' or 'binary'
+DEFAULT_MODE = 'append'      # 'append' (plain COPY) or 'merge' (COPY into staging, then upsert)
+INGEST_MODES = ('append', 'merge')
+STAGING_TABLE = 'stock_data_staging'
+PG_EPOCH = np.datetime64('2000-01-01', 'D')
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + (0).to_bytes(4, 'big') + (0).to_bytes(4, 'big')
+BINARY_TRAILER = (-1).to_bytes(2, 'big', signed=True)
+
+
+def get_ingest_settings():
+    """
+    Returns the (batch_rows, queue_size, fmt, mode) tuple from the environment, falling back to the defaults.
+    """
+    batch_rows = int(os.environ.get('INGEST_BATCH_ROWS', DEFAULT_BATCH_ROWS))
+    queue_size = int(os.environ.get('INGEST_QUEUE_SIZE', DEFAULT_QUEUE_SIZE))
+    fmt = os.environ.get('INGEST_FORMAT', DEFAULT_FORMAT).lower()
+    if fmt not in ENCODERS:
+        raise ValueError(f"Unknown INGEST_FORMAT '{fmt}'. Use one of: {', '.join(ENCODERS)}.")
+    mode = os.environ.get('INGEST_MODE', DEFAULT_MODE).lower()
+    if mode not in INGEST_MODES:
+        raise ValueError(f"Unknown INGEST_MODE '{mode}'. Use one of: {', '.join(INGEST_MODES)}.")
+    return max(1, batch_rows), max(1, queue_size), fmt, mode
+
+
+def to_long_format(data: DataFrame, tickers: List[str]) -> DataFrame:
+    """
+    Turns a yf.download-shaped dataframe into a long frame with one row per (timestamp, ticker),
+    ready to be written into stock_data. Rows with missing values are dropped.
+    """
+    # YFinance returns a MultiIndex dataframe if you download more than 1 ticker,
+    # so we need to account for that (annoying).
+    if isinstance(data.columns, pd.MultiIndex):
+        long_df = data[OHLCV_FIELDS].stack(level=1)
+        long_df.index.names = ['timestamp', 'ticker']
+        long_df = long_df.reset_index()
+    else:
+        long_df = data[OHLCV_FIELDS].copy()
+        long_df.index.name = 'timestamp'
+        long_df = long_df.reset_index()
+        long_df['ticker'] = tickers[0]
+    long_df.dropna(inplace=True)
+    long_df['Volume'] = long_df['Volume'].astype('int64')
+    long_df['timestamp'] = pd.to_datetime(long_df['timestamp']).dt.strftime('%Y-%m-%d')
+    return long_df[['timestamp', 'ticker'] + OHLCV_FIELDS]
+
+
+def trim_overlap(data: DataFrame, tickers: List[str], watermarks: Optional[Dict[str, str]]) -> DataFrame:
+    """
+    Blanks out the bars at or before each ticker's watermark, so rows refetched only because the planner
+    coalesced date groups or asked for overlap bars are not written again. `watermarks` maps tickers to their last stored date.
+    """
+    if not watermarks:
+        return data
+    dates = data.index.values.astype('datetime64[D]')
+    if isinstance(data.columns, pd.MultiIndex):
+        limits = np.array([watermarks.get(t, 'NaT') for t in data.columns.get_level_values(1)], dtype='datetime64[D]')
+        return data.mask(dates[:, None] <= limits[None, :])
+    limit = np.datetime64(watermarks.get(tickers[0], 'NaT'), 'D')
+    return data if np.isnat(limit) else data[dates > limit]
+
+
+def encode_csv(data: DataFrame, tickers: List[str]):
+    """
+    Encodes a yf.download-shaped dataframe as CSV text for COPY. Returns (payload, row_count).
+    """
+    long_df = to_long_format(data, tickers)
+    return long_df.to_csv(header=False, index=False), len(long_df)
+
+
+def _wide_arrays(data: DataFrame, tickers: List[str]):
+    """
+    Returns (dates, ticker_names, {field: 2D array}) for a yf.download-shaped dataframe,
+    with arrays shaped (dates, tickers).
+    """
+    if isinstance(data.columns, pd.MultiIndex):
+        names = data['Close'].columns
+        fields = {f: data[f].reindex(columns=names).to_numpy(dtype='float64') for f in OHLCV_FIELDS}
+    else:
+        names = pd.Index(tickers[:1])
+        fields = {f: data[[f]].to_numpy(dtype='float64') for f in OHLCV_FIELDS}
+    return data.index.values.astype('datetime64[D]'), names, fields
+
+
+def encode_binary(data: DataFrame, tickers: List[str]):
+    """
+    Encodes a yf.download-shaped dataframe straight into PostgreSQL binary COPY tuples, without
+    the file header and trailer. Returns (payload, row_count).
+    The whole (dates x tickers) block is encoded with NumPy in one pass per distinct ticker length,
+    since each tuple is a fixed-size record once the length of the TEXT field is known.
+    """
+    dates, names, fields = _wide_arrays(data, tickers)
+    valid = np.ones(fields['Close'].shape, dtype=bool)
+    for values in fields.values():
+        valid &= ~np.isnan(values)
+    days = (dates - PG_EPOCH).astype('int32')
+
+    encoded = [name.encode('utf-8') for name in names]
+    lengths = np.array([len(e) for e in encoded])
+    parts = []
+    rows = 0
+    for length in np.unique(lengths):
+        cols = np.flatnonzero(lengths == length)
+        mask = valid[:, cols]
+        n = int(mask.sum())
+        if n == 0:
+            continue
+        date_idx, col_idx = np.nonzero(mask)
+        record = np.empty(n, dtype=_binary_record_dtype(length))
+        record['nfields'] = len(STOCK_DATA_COLUMNS)
+        record['date_len'] = 4
+        record['date'] = days[date_idx]
+        record['ticker_len'] = length
+        record['ticker'] = np.array([encoded[c] for c in cols], dtype=f'S{length}')[col_idx]
+        for field in OHLCV_FIELDS:
+            record[f'{field}_len'] = 8
+            values = fields[field][:, cols][date_idx, col_idx]
+            record[field] = values.astype('int64') if field == 'Volume' else values
+        parts.append(record.tobytes())
+        rows += n
+    return b''.join(parts), rows
+
+
+def summarize_batch(data: DataFrame, tickers: List[str]) -> Dict[str, tuple]:
+    """
+    Returns {ticker: (first_date, last_date, row_count)} for the rows of a yf.download-shaped dataframe
+    that will be written (those without missing values).
+    """
+    dates, names, fields = _wide_arrays(data, tickers)
+    valid = np.ones(fields['Close'].shape, dtype=bool)
+    for values in fields.values():
+        valid &= ~np.isnan(values)
+    counts = valid.sum(axis=0)
+    first = dates[valid.argmax(axis=0)]
+    last = dates[len(dates) - 1 - valid[::-1].argmax(axis=0)]
+    return {str(names[i]): (first[i].item(), last[i].item(), int(counts[i])) for i in np.flatnonzero(counts)}
+
+
+def _binary_record_dtype(ticker_length: int):
+    """
+    Big-endian layout of one stock_data tuple in binary COPY format.
+    """
+    layout = [('nfields', '>i2'), ('date_len', '>i4'), ('date', '>i4'),
+              ('ticker_len', '>i4'), ('ticker', f'S{ticker_length}')]
+    for field in OHLCV_FIELDS:
+        layout += [(f'{field}_len', '>i4'), (field, '>i8' if field == 'Volume' else '>f8')]
+    return np.dtype(layout)
+
+
+def copy_payloads(cur, parts: list, fmt: str = 'csv', table: str = 'stock_data'):
+    """
+    Writes encoded payloads into `table` with a single COPY.
+    """
+    columns = ', '.join(STOCK_DATA_COLUMNS)
+    if fmt == 'binary':
+        buffer = io.BytesIO(BINARY_HEADER + b''.join(parts) + BINARY_TRAILER)
+        cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT binary)", buffer)
+    else:
+        buffer = io.StringIO(''.join(parts))
+        cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def merge_payloads(cur, parts: list, fmt: str = 'csv'):
+    """
+    COPYs the payloads into a session-local staging table and merges them into stock_data with a
+    single set-based upsert. Rows that already exist are updated only if a value changed.
+    Temporary tables are not WAL-logged, and ON COMMIT DELETE ROWS empties it for the next batch.
+    The ticker watermarks are updated from the staging table before the merge.
+    """
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (LIKE stock_data INCLUDING DEFAULTS)
+        ON COMMIT DELETE ROWS;
+    """)
+    copy_payloads(cur, parts, fmt, table=STAGING_TABLE)
+    upsert_watermarks_from_staging(cur, STAGING_TABLE)
+    cur.execute(f"""
+        INSERT INTO stock_data ({', '.join(STOCK_DATA_COLUMNS)})
+        SELECT DISTINCT ON (timestamp, ticker) {', '.join(STOCK_DATA_COLUMNS)}
+        FROM {STAGING_TABLE}
+        ORDER BY timestamp, ticker
+        ON CONFLICT (timestamp, ticker) DO UPDATE SET
+            open = EXCLUDED.open,
+            high = EXCLUDED.high,
+            low = EXCLUDED.low,
+            close = EXCLUDED.close,
+            volume = EXCLUDED.volume
+        WHERE (stock_data.open, stock_data.high, stock_data.low, stock_data.close, stock_data.volume)
+              IS DISTINCT FROM (EXCLUDED.open, EXCLUDED.high, EXCLUDED.low, EXCLUDED.close, EXCLUDED.volume);
+    """)
+
+
+ENCODERS = {'csv': encode_csv, 'binary': encode_binary}
+
+
+class IngestWriter(threading.Thread):
+    """
+    Background writer for stock_data. Downloaded batches are handed over through a bounded queue
+    (`put` blocks when the writer falls behind) and accumulated into multi-ticker COPY batches of
+    about `batch_rows` rows, with one commit per batch. `fmt` selects the COPY format ('csv' or 'binary').
+    `mode` is either 'append', a plain COPY that aborts the batch on duplicate rows, or 'merge', which
+    upserts through a staging table so overlapping or re-run windows are harmless.
+    The ticker watermarks are maintained in the same transaction as the rows. Items with watermarks
+    carry refetched overlap bars, which are checked for splits and dividends before being dropped;
+    the adjustments applied are collected in `actions`.
+    `on_commit`, if given, is called with the plan items whose rows have just been committed.
+    The writer owns `conn` until `close` is called, so nobody else should use it in the meantime.
+    """
+    def __init__(self, conn, batch_rows: Optional[int] = None, queue_size: Optional[int] = None,
+                 fmt: Optional[str] = None, mode: Optional[str] = None, on_commit: Optional[Callable] = None):
+        super().__init__(name='ingest-writer', daemon=True)
+        env_batch_rows, env_queue_size, env_fmt, env_mode = get_ingest_settings()
+        self.conn = conn
+        self.batch_rows = batch_rows or env_batch_rows
+        self.fmt = fmt or env_fmt
+        self.mode = mode or env_mode
+        self.encode = ENCODERS[self.fmt]
+        self.on_commit = on_commit
+        self.queue = queue.Queue(maxsize=queue_size or env_queue_size)
+        self.error = None
+        self.rows_written = 0
+        self.actions = []
+        self.adjusted_since = None  # Earliest stored bar rescaled by the actions
+        self._autocommit = conn.autocommit
+        self._parts = []
+        self._summaries = {}
+        self._items = []
+        self._pending_rows = 0
+
+    def put(self, item: Dict, data: DataFrame):
+        """
+        Queues a downloaded batch for ingestion. Raises the writer's error if it has died.
+        """
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put((item, data), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        """
+        Flushes whatever is pending, stops the thread and gives the connection back.
+        """
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        self.conn.autocommit = self._autocommit
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        self.conn.autocommit = False
+        stopped = False
+        try:
+            while True:
+                entry = self.queue.get()
+                if entry is None:
+                    stopped = True
+                    break
+                item, data = entry
+                if item.get('watermarks'):
+                    with metrics.timer('corporate_actions'):
+                        self._repair_actions(data, item['watermarks'])
+                with metrics.timer('encode'):
+                    data = trim_overlap(data, item['tickers'], item.get('watermarks'))
+                    payload, rows = self.encode(data, item['tickers'])
+                self._items.append(item)
+                if rows == 0:
+                    continue
+                self._parts.append(payload)
+                self._pending_rows += rows
+                if self.mode == 'append':
+                    self._add_summaries(summarize_batch(data, item['tickers']))
+                if self._pending_rows >= self.batch_rows:
+                    self.flush()
+            self.flush()
+        except Exception as e:
+            print(f"Error writing to the database: {e}")
+            self.conn.rollback()
+            self.error = e
+            # Keep draining so producers blocked on a full queue can notice the error.
+            while not stopped and self.queue.get() is not None:
+                pass
+
+    def flush(self):
+        """
+        Writes all pending payloads with a single COPY and commits.
+        """
+        if self._parts:
+            self._write()
+        if self.on_commit is not None and self._items:
+            self.on_commit(self._items)
+        self._items = []
+
+    def _write(self):
+        with metrics.timer('copy'):
+            with self.conn.cursor() as cur:
+                if self.mode == 'merge':
+                    merge_payloads(cur, self._parts, self.fmt)
+                else:
+                    copy_payloads(cur, self._parts, self.fmt)
+                    upsert_watermarks(cur, [(t,) + s for t, s in self._summaries.items()])
+        with metrics.timer('commit'):
+            self.conn.commit()
+        metrics.incr('bytes_copied', sum(len(part) for part in self._parts))
+        metrics.incr('rows_written', self._pending_rows)
+        self.rows_written += self._pending_rows
+        self._parts = []
+        self._summaries = {}
+        self._pending_rows = 0
+
+    def _repair_actions(self, data: DataFrame, watermarks: Dict[str, str]):
+        """
+        Compares the refetched overlap bars with the stored ones and, if the provider re-adjusted a
+        ticker's prices, rescales its stored history in the current transaction.
+        """
+        if not isinstance(data.columns, pd.MultiIndex):
+            return
+        with self.conn.cursor() as cur:
+            actions = detect_actions(cur, overlap_bars(data, watermarks))
+            if actions:
+                rows, since = apply_actions(cur, actions)
+                for ticker, as_of, kind, price_factor, _ in actions:
+                    print(f"{ticker}: {kind} detected after {as_of} (price factor {price_factor:.6g}), history adjusted.")
+                print(f"{rows} stored rows adjusted.")
+                self.actions.extend(actions)
+                if since is not None:
+                    self.adjusted_since = min(self.adjusted_since or since, since)
+
+    def _add_summaries(self, summaries: Dict[str, tuple]):
+        for ticker, (first, last, count) in summaries.items():
+            if ticker in self._summaries:
+                f, l, c = self._summaries[ticker]
+                first, last, count = min(f, first), max(l, last), c + count
+            self._summaries[ticker] = (first, last, count)
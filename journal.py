@@ -0,0 +1,85 @@
+import glob
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+from sessions import DEFAULT_CACHE_DIR
+
+# Constants
+SEGMENT_SUFFIX = '.parquet'
+ITEM_METADATA_KEY = b'plan_item'
+
+
+def item_key(item: Dict) -> str:
+    """
+    Deterministic key of a plan item, derived from its date range and tickers.
+    """
+    raw = json.dumps([item['date'], item.get('end'), sorted(item['tickers'])])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+class Journal:
+    """
+    Crash-safe on-disk journal of downloaded batches. Every batch is written as a zstd-compressed
+    Parquet segment named after its plan item key, with the plan item stored in the file metadata.
+    Segments are removed once their rows have been committed, so whatever is left after a crash
+    is exactly what still needs to reach the database, and it can be replayed without downloading again.
+    """
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.environ.get('JOURNAL_DIR') or \
+            os.path.join(os.environ.get('CACHE_DIR', DEFAULT_CACHE_DIR), 'journal')
+        os.makedirs(self.directory, exist_ok=True)
+        for stale in glob.glob(os.path.join(self.directory, '*' + SEGMENT_SUFFIX + '.tmp')):
+            os.remove(stale)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SEGMENT_SUFFIX)
+
+    def write(self, item: Dict, data: DataFrame) -> str:
+        """
+        Journals a downloaded batch and returns its key (also stored in item['key']).
+        The segment is written to a temporary file and renamed, so a crash never leaves a partial one.
+        """
+        key = item.setdefault('key', item_key(item))
+        table = pa.Table.from_pandas(data)
+        metadata = dict(table.schema.metadata or {})
+        metadata[ITEM_METADATA_KEY] = json.dumps(item).encode('utf-8')
+        table = table.replace_schema_metadata(metadata)
+        tmp_path = self._path(key) + '.tmp'
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, self._path(key))
+        return key
+
+    def segments(self) -> Iterator[Tuple[Dict, DataFrame]]:
+        """
+        Yields the (plan item, data) of every journaled batch. Unreadable segments are reported and skipped.
+        """
+        for path in sorted(glob.glob(os.path.join(self.directory, '*' + SEGMENT_SUFFIX))):
+            try:
+                table = pq.read_table(path)
+                item = json.loads(table.schema.metadata[ITEM_METADATA_KEY])
+            except Exception as e:
+                print(f"Skipping unreadable journal segment {path}: {e}")
+                continue
+            yield item, table.to_pandas()
+
+    def pending(self) -> int:
+        """
+        Number of segments waiting to be committed.
+        """
+        return len(glob.glob(os.path.join(self.directory, '*' + SEGMENT_SUFFIX)))
+
+    def truncate(self, keys: Iterable[str]):
+        """
+        Removes the segments whose rows have been committed.
+        """
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
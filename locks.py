@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Holds an exclusive advisory lock on `path` (created if needed) for the duration of the block,
+    waiting while another process holds it. Yields True once locked, or False where advisory locks
+    aren't available (Windows), in which case nothing is locked.
+    """
+    if fcntl is None:
+        yield False
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,188 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from psycopg2.extensions import cursor as _cursor
+
+from sessions import DEFAULT_CACHE_DIR
+
+# Constants
+PROMETHEUS_PREFIX = 'assetdownloader'
+TOP_ALLOCATIONS = 20  # Allocation sites listed in the report when tracemalloc is on
+
+
+class Metrics:
+    """
+    Thread-safe, process-wide timers and counters for the hot paths of a run. Timers keep the count,
+    total and maximum of their observations (e.g. one per downloaded batch), counters just add up.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.timers = {}
+            self.counters = {}
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            count, total, longest = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Times the enclosed block as one observation of `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict:
+        """
+        Returns the current values as a JSON-ready dictionary, with derived throughputs.
+        """
+        with self._lock:
+            timers = {name: {'count': c, 'seconds': round(t, 6), 'max_seconds': round(m, 6)}
+                      for name, (c, t, m) in self.timers.items()}
+            counters = dict(self.counters)
+            elapsed = time.time() - self.started
+        report = {'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                  'elapsed_seconds': round(elapsed, 3), 'timers': timers, 'counters': counters}
+        rows, copy_time = counters.get('rows_written', 0), timers.get('copy', {}).get('seconds', 0)
+        if copy_time:
+            report['rows_per_second_copy'] = round(rows / copy_time, 1)
+        if elapsed:
+            report['rows_per_second_run'] = round(rows / elapsed, 1)
+        return report
+
+
+metrics = Metrics()
+
+
+class CountingCursor(_cursor):
+    """
+    psycopg2 cursor that counts every round trip to the server in metrics ('db_round_trips').
+    Pass it as cursor_factory when connecting.
+    """
+    def execute(self, query, vars=None):
+        metrics.incr('db_round_trips')
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        metrics.incr('db_round_trips')
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.incr('db_round_trips')
+        return super().copy_expert(sql, file, size)
+
+
+def get_metrics_settings():
+    """
+    Returns the (report_path, textfile_path, profile) tuple from the environment. The JSON report goes
+    to RUN_REPORT (run_report.json under CACHE_DIR by default), the Prometheus textfile to
+    PROMETHEUS_TEXTFILE (not written if empty), and PROFILE=1 turns the profilers on.
+    """
+    report = os.environ.get('RUN_REPORT') or \
+        os.path.join(os.environ.get('CACHE_DIR', DEFAULT_CACHE_DIR), 'run_report.json')
+    textfile = os.environ.get('PROMETHEUS_TEXTFILE', '')
+    profile = os.environ.get('PROFILE', '').lower() in ('1', 'true', 'yes')
+    return report, textfile, profile
+
+
+class Profiler:
+    """
+    Optional cProfile + tracemalloc session around a whole run. When enabled, the cProfile stats
+    are dumped next to the run report (<report>.pstats, readable with pstats or snakeviz) and the
+    top allocation sites are added to the report.
+    """
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.profile = None
+        self.allocations = []
+
+    def __enter__(self):
+        if self.enabled:
+            tracemalloc.start()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self.profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            metrics.incr('peak_traced_bytes', peak)
+            self.allocations = [{'site': str(stat.traceback[0]), 'bytes': stat.size, 'blocks': stat.count}
+                                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+        return False
+
+    def dump(self, report_path: str):
+        if self.profile is not None:
+            self.profile.dump_stats(report_path + '.pstats')
+            pstats.Stats(self.profile).sort_stats('cumulative').print_stats(15)
+
+
+def _write_atomically(path: str, text: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)  # The textfile collector must never see a half-written file.
+
+
+def to_prometheus(report: Dict) -> str:
+    """
+    Renders a run report in the Prometheus text exposition format.
+    """
+    p = PROMETHEUS_PREFIX
+    lines = []
+    for metric, field in (('stage_seconds', 'seconds'), ('stage_count', 'count'), ('stage_max_seconds', 'max_seconds')):
+        lines.append(f'# TYPE {p}_{metric} gauge')  # Samples of a metric must follow its TYPE line.
+        for stage, timer in sorted(report['timers'].items()):
+            lines.append(f'{p}_{metric}{{stage="{stage}"}} {timer[field]}')
+    for name, value in sorted(report['counters'].items()):
+        lines.append(f'# TYPE {p}_{name} gauge')
+        lines.append(f'{p}_{name} {value}')
+    lines.append(f'# TYPE {p}_run_seconds gauge')
+    lines.append(f'{p}_run_seconds {report["elapsed_seconds"]}')
+    lines.append(f'# TYPE {p}_last_run_timestamp_seconds gauge')
+    lines.append(f'{p}_last_run_timestamp_seconds {time.time():.0f}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_run_report(profiler: Optional[Profiler] = None, report_path: Optional[str] = None,
+                     textfile: Optional[str] = None) -> Dict:
+    """
+    Writes the JSON run report and, if configured, the Prometheus textfile. Returns the report.
+    """
+    env_report, env_textfile, _ = get_metrics_settings()
+    report_path = report_path or env_report
+    textfile = env_textfile if textfile is None else textfile
+    report = metrics.snapshot()
+    if profiler is not None and profiler.allocations:
+        report['top_allocations'] = profiler.allocations
+    _write_atomically(report_path, json.dumps(report, indent=2))
+    if textfile:
+        _write_atomically(textfile, to_prometheus(report))
+    if profiler is not None:
+        profiler.dump(report_path)
+    print(f"Run report written to {report_path}.")
+    return report
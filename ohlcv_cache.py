@@ -0,0 +1,239 @@
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+from locks import file_lock
+from reader import STOCK_DATA_TYPES, arrow_to_frame, read_stock_data_arrow
+from sessions import DEFAULT_CACHE_DIR
+from watermarks import get_known_tickers, get_watermarks
+
+# Constants
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # Size cap of the cache before cold partitions are evicted
+DEFAULT_TTL = 3600                 # seconds between watermark checks of a cached ticker
+LOCK_FILE = 'manifest.lock'
+MANIFEST = 'manifest.json'
+PARTITION_SCHEMA = pa.schema([(name, STOCK_DATA_TYPES[name]) for name in STOCK_DATA_TYPES if name != 'ticker'])
+
+
+class OHLCVCache:
+    """
+    Local read-through cache of stock_data: one Parquet file per ticker and year under
+    `<directory>/<ticker>/<year>.parquet`, read with memory mapping.
+
+    Partitions are fetched from the DB the first time they are needed. Afterwards the ticker's
+    watermark (last_ts, row_count) is compared with the DB at most every `ttl` seconds: new bars are
+    appended to the cached partitions, and if the counts no longer add up or the revision changed
+    (history was adjusted, backfilled or purged) the ticker's partitions are dropped and fetched again on the next read.
+    Reads of tickers checked within the TTL never touch the DB, and neither does the list of known
+    tickers (see known_tickers), which is refreshed on the same TTL.
+    When the cache grows over `max_bytes`, the least recently read partitions are evicted.
+    Several processes can share the directory: manifest updates are serialized with a lock file,
+    and the manifest is reloaded under the lock whenever another process has replaced it.
+    """
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None, ttl: Optional[int] = None):
+        self.directory = directory or os.environ.get('OHLCV_CACHE_DIR') or \
+            os.path.join(os.environ.get('CACHE_DIR', DEFAULT_CACHE_DIR), 'ohlcv')
+        self.max_bytes = max_bytes or int(os.environ.get('OHLCV_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        self.ttl = int(os.environ.get('OHLCV_CACHE_TTL', DEFAULT_TTL)) if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._loaded = None
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    # Manifest: {"tickers": {ticker: {"last_ts", "first_ts", "row_count", "revision", "checked"}},
+    #            "partitions": {"ticker/year": {"bytes", "accessed"}}, "known": {"tickers": [...], "checked"}}
+    def _stat(self):
+        try:
+            st = os.stat(os.path.join(self.directory, MANIFEST))
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        except FileNotFoundError:
+            return None
+
+    def _load_manifest(self) -> Dict:
+        self._loaded = self._stat()
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'tickers': {}, 'partitions': {}}
+
+    def _save_manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(path + '.tmp', path)
+        self._loaded = self._stat()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Serializes manifest updates across threads and processes, starting from the latest manifest on disk.
+        """
+        with self._lock, file_lock(os.path.join(self.directory, LOCK_FILE)):
+            if self._stat() != self._loaded:
+                self.manifest = self._load_manifest()
+            yield
+
+    def _path(self, ticker: str, year: int) -> str:
+        return os.path.join(self.directory, ticker, f'{year}.parquet')
+
+    def _write_partition(self, ticker: str, year: int, table: pa.Table):
+        path = self._path(ticker, year)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table.select(PARTITION_SCHEMA.names).cast(PARTITION_SCHEMA), path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.manifest['partitions'][f'{ticker}/{year}'] = {'bytes': os.path.getsize(path), 'accessed': time.time()}
+
+    def _drop_ticker(self, ticker: str):
+        shutil.rmtree(os.path.join(self.directory, ticker), ignore_errors=True)
+        self.manifest['tickers'].pop(ticker, None)
+        for key in [k for k in self.manifest['partitions'] if k.split('/')[0] == ticker]:
+            del self.manifest['partitions'][key]
+
+    def sync(self, conn, tickers: List[str], force: bool = False):
+        """
+        Brings the cached watermarks of `tickers` up to date with the DB, appending new bars to the
+        partitions already on disk. Tickers checked within the TTL are skipped unless `force` is set.
+        """
+        now = time.time()
+        entries = self.manifest['tickers']
+        stale = [t for t in tickers if force or t not in entries or now - entries[t]['checked'] > self.ttl]
+        if not stale:
+            return
+        watermarks = get_watermarks(conn, stale)
+
+        appendable = {}
+        for ticker in stale:
+            cached = entries.get(ticker)
+            if ticker not in watermarks.index:
+                self._drop_ticker(ticker)
+                continue
+            wm = watermarks.loc[ticker]
+            current = {'first_ts': str(wm['first_ts']), 'last_ts': str(wm['last_ts']),
+                       'row_count': int(wm['row_count']), 'revision': int(wm['revision']), 'checked': now}
+            same_history = cached and cached['first_ts'] == current['first_ts'] and \
+                cached.get('revision', 0) == current['revision']
+            if same_history and cached['last_ts'] < current['last_ts']:
+                appendable[ticker] = (cached, current)
+            elif cached and (not same_history or (cached['last_ts'], cached['row_count']) != \
+                    (current['last_ts'], current['row_count'])):
+                self._drop_ticker(ticker)
+            entries[ticker] = current
+
+        if appendable:
+            since = min(cached['last_ts'] for cached, _ in appendable.values())
+            until = max(current['last_ts'] for _, current in appendable.values())
+            new_rows = read_stock_data_arrow(conn, list(appendable), pd.Timestamp(since) + pd.Timedelta(days=1), until)
+            for ticker, (cached, current) in appendable.items():
+                rows = new_rows.filter(pc.and_(pc.equal(new_rows['ticker'], ticker),
+                                               pc.greater(new_rows['timestamp'], pa.scalar(pd.Timestamp(cached['last_ts']).date()))))
+                if cached['row_count'] + rows.num_rows != current['row_count']:
+                    self._drop_ticker(ticker)  # History changed underneath, refetch lazily.
+                    entries[ticker] = current
+                    continue
+                self._append(ticker, rows)
+        self._save_manifest()
+
+    def _append(self, ticker: str, rows: pa.Table):
+        years = pc.year(rows['timestamp'])
+        for year in pc.unique(years).to_pylist():
+            if f'{ticker}/{year}' not in self.manifest['partitions']:
+                continue  # Not cached yet; it will be fetched whole when first read.
+            part = rows.filter(pc.equal(years, year))
+            existing = pq.read_table(self._path(ticker, year))
+            self._write_partition(ticker, year, pa.concat_tables([existing, part.select(PARTITION_SCHEMA.names).cast(PARTITION_SCHEMA)]))
+
+    def _fill(self, conn, missing: Dict[int, List[str]]):
+        """
+        Fetches the missing (year -> tickers) partitions from the DB, one query per year.
+        """
+        for year, tickers in missing.items():
+            table = read_stock_data_arrow(conn, tickers, f'{year}-01-01', f'{year}-12-31')
+            for ticker in tickers:
+                self._write_partition(ticker, year, table.filter(pc.equal(table['ticker'], ticker)))
+
+    def read_arrow(self, conn, tickers: List[str], initial_date, end_date) -> pa.Table:
+        """
+        Returns the rows of `tickers` between the two dates (inclusive) as an Arrow table, like
+        reader.read_stock_data_arrow but served from the cache.
+        """
+        start, end = pd.Timestamp(initial_date), pd.Timestamp(end_date)
+        with self._locked():
+            self.sync(conn, tickers)
+            entries, partitions = self.manifest['tickers'], self.manifest['partitions']
+            wanted, missing = [], {}
+            for ticker in tickers:
+                if ticker not in entries:
+                    continue
+                first = max(start.year, int(entries[ticker]['first_ts'][:4]))
+                last = min(end.year, int(entries[ticker]['last_ts'][:4]))
+                for year in range(first, last + 1):
+                    wanted.append((ticker, year))
+                    if f'{ticker}/{year}' not in partitions:
+                        missing.setdefault(year, []).append(ticker)
+            if missing:
+                self._fill(conn, missing)
+
+            tables = []
+            now = time.time()
+            for ticker, year in wanted:
+                table = pq.read_table(self._path(ticker, year), memory_map=True)
+                partitions[f'{ticker}/{year}']['accessed'] = now
+                tables.append(table.add_column(1, 'ticker', pa.array([ticker] * table.num_rows, pa.string())))
+            self._evict(keep={f'{t}/{y}' for t, y in wanted})
+            self._save_manifest()
+
+        if not tables:
+            return pa.Table.from_pydict({name: pa.array([], type) for name, type in STOCK_DATA_TYPES.items()})
+        table = pa.concat_tables(tables)
+        in_range = pc.and_(pc.greater_equal(table['timestamp'], pa.scalar(start.date())),
+                           pc.less_equal(table['timestamp'], pa.scalar(end.date())))
+        return table.filter(in_range).sort_by([('timestamp', 'ascending'), ('ticker', 'ascending')])
+
+    def known_tickers(self, conn) -> List[str]:
+        """
+        Returns every ticker with data in stock_data, like watermarks.get_known_tickers, but asks the
+        DB at most every `ttl` seconds.
+        """
+        with self._locked():
+            known = self.manifest.get('known')
+            if known is None or time.time() - known['checked'] > self.ttl:
+                known = {'tickers': get_known_tickers(conn), 'checked': time.time()}
+                self.manifest['known'] = known
+                self._save_manifest()
+            return list(known['tickers'])
+
+    def read(self, conn, tickers: List[str], initial_date, end_date) -> DataFrame:
+        """
+        Same result as get_stocks_from_db, served from the cache.
+        """
+        return arrow_to_frame(self.read_arrow(conn, tickers, initial_date, end_date))
+
+    def _evict(self, keep=()):
+        """
+        Removes the least recently read partitions until the cache fits in `max_bytes`.
+        Evicted partitions are fetched again from the DB if they are ever needed.
+        """
+        partitions = self.manifest['partitions']
+        total = sum(p['bytes'] for p in partitions.values())
+        for key in sorted(partitions, key=lambda k: partitions[k]['accessed']):
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            ticker, year = key.split('/')
+            try:
+                os.remove(self._path(ticker, int(year)))
+            except FileNotFoundError:
+                pass
+            total -= partitions.pop(key)['bytes']
@@ -0,0 +1,91 @@
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pandas import DataFrame
+
+# Constants
+FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+
+class Panel:
+    """
+    Compact OHLCV panel for many tickers. Every field is one contiguous NumPy array sorted by
+    (ticker, timestamp), and a precomputed ticker -> (start, stop) table gives each ticker's block,
+    so extracting one ticker is a constant-time, zero-copy slice instead of a scan of the index.
+    """
+    __slots__ = ('timestamps', 'tickers', 'offsets') + FIELDS
+
+    def __init__(self, timestamps: np.ndarray, tickers: np.ndarray, fields: Dict[str, np.ndarray]):
+        """
+        Builds the panel from row-aligned arrays in any order; they are sorted by (ticker, timestamp).
+        """
+        timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+        tickers = np.asarray(tickers, dtype=object)
+        codes, names = pd.factorize(tickers, sort=True)
+        order = np.lexsort((timestamps, codes))
+        codes = codes[order]
+        self.timestamps = np.ascontiguousarray(timestamps[order])
+        for field in FIELDS:
+            setattr(self, field, np.ascontiguousarray(np.asarray(fields[field])[order]))
+        bounds = np.searchsorted(codes, np.arange(len(names) + 1))
+        self.tickers = list(names)
+        self.offsets = {ticker: (int(bounds[i]), int(bounds[i + 1])) for i, ticker in enumerate(self.tickers)}
+
+    @classmethod
+    def from_arrow(cls, table: pa.Table) -> 'Panel':
+        """
+        Builds a panel from an Arrow table of stock_data rows (see reader.read_stock_data_arrow).
+        """
+        return cls(table['timestamp'].to_numpy().astype('datetime64[ns]'),
+                   table['ticker'].to_numpy(zero_copy_only=False),
+                   {field: table[field].to_numpy() for field in FIELDS})
+
+    @classmethod
+    def from_frame(cls, df: DataFrame) -> 'Panel':
+        """
+        Builds a panel from a (timestamp, ticker) MultiIndex dataframe, as returned by get_stocks_from_db.
+        """
+        return cls(df.index.get_level_values('timestamp').values,
+                   df.index.get_level_values('ticker').values,
+                   {field: df[field].to_numpy() for field in FIELDS})
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.offsets
+
+    def get(self, ticker: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Returns {'timestamp': ..., 'open': ..., ...} views for one ticker, or None if it isn't in the panel.
+        """
+        bounds = self.offsets.get(ticker)
+        if bounds is None:
+            return None
+        start, stop = bounds
+        block = {'timestamp': self.timestamps[start:stop]}
+        for field in FIELDS:
+            block[field] = getattr(self, field)[start:stop]
+        return block
+
+    def get_frame(self, ticker: str) -> Optional[DataFrame]:
+        """
+        One ticker as a timestamp-indexed dataframe, like get_single_ticker_from_df.
+        """
+        block = self.get(ticker)
+        if block is None:
+            return None
+        index = pd.DatetimeIndex(block.pop('timestamp'), name='timestamp')
+        return pd.DataFrame(block, index=index, copy=False)
+
+    def to_pandas(self) -> DataFrame:
+        """
+        The whole panel as the (timestamp, ticker) MultiIndex dataframe returned by get_stocks_from_db.
+        """
+        tickers = np.repeat(np.array(self.tickers, dtype=object),
+                            [stop - start for start, stop in self.offsets.values()])
+        df = pd.DataFrame({field: getattr(self, field) for field in FIELDS},
+                          index=pd.MultiIndex.from_arrays([self.timestamps, tickers], names=['timestamp', 'ticker']))
+        return df.sort_index()
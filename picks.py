@@ -0,0 +1,176 @@
+import csv
+import hashlib
+import io
+import os
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+# Content hash of every synced file, so an unchanged file is not diffed again.
+SYNC_STATE_DDL = """
+    CREATE TABLE IF NOT EXISTS sync_state (
+        name TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        synced_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# Number of picks held at the end of every day, with the adds and removes of that day.
+# Maintained incrementally from mypicks_history, see refresh_daily_counts().
+DAILY_COUNTS_DDL = """
+    CREATE TABLE IF NOT EXISTS mypicks_daily_counts (
+        date DATE PRIMARY KEY,
+        stock_count INTEGER NOT NULL,
+        added INTEGER NOT NULL,
+        removed INTEGER NOT NULL
+    );
+"""
+
+# Last mypicks_history id counted into mypicks_daily_counts (a single row).
+DAILY_COUNTS_STATE_DDL = """
+    CREATE TABLE IF NOT EXISTS mypicks_daily_counts_state (
+        singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+        last_history_id BIGINT NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+_parsed = {}  # absolute path -> ((mtime, size), parsed picks), see read_picks()
+
+
+def read_picks(path: str) -> Optional[Tuple[List[str], str, datetime]]:
+    """
+    Parses a picks CSV file (typically a StockRover export): a 'Ticker' column (the first column if
+    there is none) and optionally a last 'Summary' line. Returns (tickers, content hash, file time),
+    or None if the file doesn't exist. The result is memoized until the file changes, so every
+    consumer in a run shares one read and one parse, however the path is spelled.
+    """
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _parsed.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        content = f.read()
+    reader = csv.reader(io.StringIO(content.decode('utf-8-sig')))
+    header = next(reader, [])
+    column = header.index('Ticker') if 'Ticker' in header else 0
+    tickers = []
+    for row in reader:
+        if len(row) > column and row[column].strip() and row[column] != 'Summary':
+            tickers.append(row[column].strip())
+    picks = (list(dict.fromkeys(tickers)), hashlib.sha256(content).hexdigest(), datetime.fromtimestamp(stat.st_ctime))
+    _parsed[path] = (signature, picks)
+    return picks
+
+
+def sync_picks(conn, path: str = './mypicks.csv'):
+    """
+    Keeps the mypicks table and its history in line with the picks file. The diff against the DB
+    and every insert and update run as a single set-based statement, so the whole sync is one round
+    trip and one transaction whatever the size of the file. Changes are dated with the file time.
+    The statement compares the file's content hash with the last sync first, and does nothing
+    if it matches, so an unchanged file costs one statement too.
+    """
+    picks = read_picks(path)
+    if picks is None:
+        print(f"The file {path} does not exist. Skipping the picks sync.")
+        return
+    tickers, content_hash, file_time = picks
+    name = os.path.basename(path)
+    with conn.cursor() as cur:
+        cur.execute("""
+            WITH changed AS (
+                SELECT 1 WHERE NOT EXISTS (
+                    SELECT 1 FROM sync_state WHERE name = %(name)s AND content_hash = %(hash)s)
+            ), csv AS (
+                SELECT DISTINCT unnest(%(tickers)s::text[]) AS ticker FROM changed
+            ), current AS (
+                SELECT ticker FROM mypicks WHERE date_removed IS NULL OR date_added > date_removed
+            ), added AS (
+                INSERT INTO mypicks (ticker, date_added)
+                SELECT ticker, %(date)s FROM csv WHERE ticker NOT IN (SELECT ticker FROM current)
+                ON CONFLICT (ticker) DO UPDATE SET date_added = EXCLUDED.date_added, date_removed = NULL
+                RETURNING ticker
+            ), removed AS (
+                UPDATE mypicks SET date_removed = %(date)s
+                WHERE EXISTS (SELECT 1 FROM changed) AND
+                      ticker IN (SELECT ticker FROM current) AND ticker NOT IN (SELECT ticker FROM csv)
+                RETURNING ticker
+            ), history AS (
+                INSERT INTO mypicks_history (ticker, action, date)
+                SELECT ticker, 'Added', %(date)s FROM added
+                UNION ALL
+                SELECT ticker, 'Removed', %(date)s FROM removed
+                RETURNING action
+            ), state AS (
+                INSERT INTO sync_state (name, content_hash) SELECT %(name)s, %(hash)s FROM changed
+                ON CONFLICT (name) DO UPDATE SET content_hash = EXCLUDED.content_hash, synced_at = CURRENT_TIMESTAMP
+            )
+            SELECT COUNT(*) FILTER (WHERE action = 'Added'), COUNT(*) FILTER (WHERE action = 'Removed')
+            FROM history;
+        """, {'tickers': tickers, 'date': file_time, 'name': name, 'hash': content_hash})
+        added, removed = cur.fetchone()
+        if added or removed:
+            refresh_daily_counts(cur)
+    if not conn.autocommit:
+        conn.commit()
+    if added or removed:
+        print(f"Picks synced from {name}: {added} added, {removed} removed.")
+
+
+def refresh_daily_counts(cur, full: bool = False):
+    """
+    Brings mypicks_daily_counts up to date with mypicks_history in one statement. Every Added is a +1
+    and every Removed a -1 event, and the count of each day is the running sum of the events (a
+    window function over one row per day), so the cost grows with the number of days, not with
+    days x picks. Only the days from the last one stored, or from the earliest day of the history
+    rows added since the last refresh if that is before (picks files can be dated in the past), are
+    recomputed, starting from the count of the day before. The last history id counted is kept in
+    mypicks_daily_counts_state. Use full=True to rebuild the table after editing the history by hand.
+    """
+    if full:
+        cur.execute("TRUNCATE mypicks_daily_counts, mypicks_daily_counts_state;")
+    cur.execute("""
+        WITH counted AS (
+            SELECT COALESCE((SELECT last_history_id FROM mypicks_daily_counts_state), 0) AS last_id
+        ), bounds AS (
+            SELECT COALESCE(LEAST((SELECT MAX(date) FROM mypicks_daily_counts),
+                                  (SELECT MIN(h.date)::date FROM mypicks_history h, counted WHERE h.id > counted.last_id)),
+                            MIN(date)::date) AS since,
+                   MAX(date)::date AS until,
+                   MAX(id) AS last_id
+            FROM mypicks_history
+        ), base AS (
+            SELECT COALESCE((
+                SELECT c.stock_count FROM mypicks_daily_counts c, bounds
+                WHERE c.date < bounds.since ORDER BY c.date DESC LIMIT 1), 0) AS stock_count
+        ), events AS (
+            SELECT h.date::date AS day,
+                   COUNT(*) FILTER (WHERE h.action = 'Added') AS added,
+                   COUNT(*) FILTER (WHERE h.action = 'Removed') AS removed
+            FROM mypicks_history h, bounds
+            WHERE h.date >= bounds.since
+            GROUP BY 1
+        ), saved AS (
+            INSERT INTO mypicks_daily_counts_state (last_history_id)
+            SELECT last_id FROM bounds WHERE last_id IS NOT NULL
+            ON CONFLICT (singleton) DO UPDATE SET last_history_id = EXCLUDED.last_history_id, updated_at = CURRENT_TIMESTAMP
+        )
+        INSERT INTO mypicks_daily_counts (date, stock_count, added, removed)
+        SELECT days.day::date,
+               base.stock_count + SUM(COALESCE(e.added, 0) - COALESCE(e.removed, 0)) OVER (ORDER BY days.day),
+               COALESCE(e.added, 0), COALESCE(e.removed, 0)
+        FROM bounds
+        CROSS JOIN base
+        CROSS JOIN generate_series(bounds.since, bounds.until, interval '1 day') AS days(day)
+        LEFT JOIN events e ON e.day = days.day::date
+        ON CONFLICT (date) DO UPDATE SET
+            stock_count = EXCLUDED.stock_count,
+            added = EXCLUDED.added,
+            removed = EXCLUDED.removed;
+    """)
@@ -0,0 +1,112 @@
+import math
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from corporate_actions import OVERLAP_BARS
+from download_engine import get_download_settings
+
+# Constants
+DEFAULT_CALL_COST = 1000         # Overhead of one provider call, expressed in downloaded rows
+DEFAULT_MAX_CALL_ROWS = 250000   # Upper bound of rows (tickers x sessions) requested in one call
+
+
+def get_plan_settings():
+    """
+    Returns the (call_cost, max_call_rows) tuple from the environment, falling back to the defaults.
+    """
+    call_cost = int(os.environ.get('PLAN_CALL_COST', DEFAULT_CALL_COST))
+    max_call_rows = int(os.environ.get('PLAN_MAX_CALL_ROWS', DEFAULT_MAX_CALL_ROWS))
+    return max(0, call_cost), max(1, max_call_rows)
+
+
+def plan_downloads(latest: pd.Series, sessions, beginning_date: str, chunk_size: Optional[int] = None,
+                   call_cost: Optional[int] = None, max_call_rows: Optional[int] = None,
+                   last_session=None) -> List[Dict]:
+    """
+    Builds the list of provider calls needed to bring every ticker up to the last completed session.
+
+    `latest` maps each ticker to its last stored date (NaT for tickers not in the DB yet).
+    Tickers are grouped by the session they must start from. Neighbouring groups are then coalesced
+    whenever refetching the overlapping bars costs less than the calls it saves (each call is worth
+    `call_cost` rows), and groups are split into calls of at most `chunk_size` tickers and
+    `max_call_rows` rows. Every call also refetches the last OVERLAP_BARS stored bars, which are compared
+    with the stored ones to detect splits and dividends (see corporate_actions.py). Every item carries
+    the watermarks of its tickers that will receive overlap bars, so those rows can be dropped before ingest.
+    """
+    env_call_cost, env_max_call_rows = get_plan_settings()
+    call_cost = env_call_cost if call_cost is None else call_cost
+    max_call_rows = max_call_rows or env_max_call_rows
+    chunk_size = chunk_size or get_download_settings()[1]
+    if last_session is None:
+        last_session = sessions.last_completed_session()
+    last_pos = int(np.searchsorted(sessions.sessions, np.datetime64(last_session, 'D'), side='right'))
+
+    if latest.empty:
+        return []
+    watermarks = latest.values.astype('datetime64[D]')
+    existing = ~np.isnat(watermarks)
+    watermarks = np.where(existing, watermarks, np.datetime64(beginning_date, 'D'))
+    starts = np.searchsorted(sessions.sessions, watermarks, side='right')  # Position of the next session
+    tickers = latest.index.to_numpy()
+
+    def capacity(start_pos):
+        spans = max(1, last_pos - start_pos)
+        return max(1, min(chunk_size, max_call_rows // spans))
+
+    def calls(n, start_pos):
+        return math.ceil(n / capacity(start_pos))
+
+    # One group per start session, earliest first.
+    unique_starts, inverse = np.unique(starts, return_inverse=True)
+    counts = np.bincount(inverse)
+    groups = []
+    for i, start_pos in enumerate(unique_starts):
+        if start_pos >= last_pos:
+            continue
+        n = int(counts[i])
+        if groups:
+            acc = groups[-1]
+            extra_rows = n * (start_pos - acc['start'])
+            saved = calls(acc['n'], acc['start']) + calls(n, start_pos) - calls(acc['n'] + n, acc['start'])
+            if saved > 0 and extra_rows <= call_cost * saved:
+                acc['n'] += n
+                acc['members'].append(i)
+                continue
+        groups.append({'start': int(start_pos), 'n': n, 'members': [i]})
+
+    plan = []
+    for group in groups:
+        mask = np.isin(inverse, group['members'])
+        group_tickers = tickers[mask]
+        group_watermarks = watermarks[mask]
+        overlap = existing[mask]
+        n_chunks = calls(len(group_tickers), group['start'])
+        call_start = max(0, group['start'] - OVERLAP_BARS)
+        start_date = str(sessions.sessions[call_start])
+        spans = last_pos - call_start
+        for idx in np.array_split(np.arange(len(group_tickers)), n_chunks):
+            item = {"date": start_date, "tickers": group_tickers[idx].tolist(), "rows": int(len(idx) * spans)}
+            trimmed = idx[overlap[idx]]
+            if len(trimmed):
+                item["watermarks"] = dict(zip(group_tickers[trimmed].tolist(), group_watermarks[trimmed].astype(str).tolist()))
+            plan.append(item)
+    return plan
+
+
+def describe_plan(plan: List[Dict]) -> str:
+    """
+    Returns a human readable summary of a download plan with estimated request and row counts.
+    """
+    if not plan:
+        return 'Nothing to download. The database is up-to-date.'
+    lines = [f"{'start':<12}{'end':<12}{'tickers':>8}{'est. rows':>12}{'overlap':>9}"]
+    for item in plan:
+        lines.append(f"{item['date']:<12}{item.get('end', 'latest'):<12}{len(item['tickers']):>8}{item.get('rows', 0):>12,}"
+                     f"{len(item.get('watermarks', {})):>9}")
+    tickers = sum(len(item['tickers']) for item in plan)
+    rows = sum(item.get('rows', 0) for item in plan)
+    lines.append(f"{len(plan)} requests, {tickers} tickers, about {rows:,} rows.")
+    return '\n'.join(lines)
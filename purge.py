@@ -0,0 +1,118 @@
+from typing import Iterable, List
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from timescale import refresh_aggregates
+from watermarks import get_watermarks
+
+# Excluded tickers whose data has already been deleted, so later runs have nothing to do for them.
+PURGED_TICKERS_DDL = """
+    CREATE TABLE IF NOT EXISTS purged_tickers (
+        ticker TEXT PRIMARY KEY,
+        rows_deleted BIGINT NOT NULL,
+        purged_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+
+def get_purged_tickers(conn) -> List[str]:
+    """
+    Returns the tickers recorded as purged.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT ticker FROM purged_tickers;")
+        return [row[0] for row in cur.fetchall()]
+
+
+def _chunks_between(cur, first_ts, last_ts) -> List[tuple]:
+    """
+    Returns the (schema, chunk name, range start, range end) of the stock_data chunks overlapping
+    the two dates, oldest first.
+    """
+    cur.execute("""
+        SELECT chunk_schema, chunk_name, range_start::date, range_end::date
+        FROM timescaledb_information.chunks
+        WHERE hypertable_name = 'stock_data' AND
+              range_end::date > %s AND range_start::date <= %s
+        ORDER BY range_start;
+    """, (first_ts, last_ts))
+    return cur.fetchall()
+
+
+def purge_tickers(conn, excluded: Iterable[str], dry_run: bool = False) -> List[str]:
+    """
+    Deletes all data of the excluded tickers. Tickers already recorded in purged_tickers are skipped
+    without touching stock_data, and which of the others have data, and over what dates, comes from
+    the watermarks, so an exclusion list where everything is already purged costs one small read.
+    The deletes run one chunk at a time, only on the chunks that overlap the date range of the
+    tickers being purged, and each chunk is committed on its own: an interrupted purge resumes
+    where it stopped. Compressed chunks (TimescaleDB 2.11 or later, see timescale.configure_timescale)
+    have the excluded tickers' segments decompressed to delete them; the rest of the chunk stays compressed.
+    With dry_run=True nothing is deleted; the work that would be done is printed instead.
+    Returns the excluded tickers.
+    """
+    excluded = sorted(set(excluded))
+    purged = set(get_purged_tickers(conn))
+    pending = [t for t in excluded if t not in purged]
+    if not pending and purged <= set(excluded):
+        return excluded
+    watermarks = get_watermarks(conn, pending)
+    if watermarks.empty:
+        if not dry_run:
+            _record_purged(conn, excluded, pending, {})
+        return excluded
+
+    total_rows = int(watermarks['row_count'].sum())
+    with conn.cursor() as cur:
+        chunks = _chunks_between(cur, watermarks['first_ts'].min(), watermarks['last_ts'].max())
+    print(f"{'Would purge' if dry_run else 'Purging'} {len(watermarks)} excluded tickers "
+          f"({total_rows} rows in {len(chunks)} chunks): {', '.join(watermarks.index)}")
+    if dry_run:
+        return excluded
+
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        deleted = 0
+        with conn.cursor() as cur:
+            for i, (schema, name, start, end) in enumerate(chunks, 1):
+                in_chunk = watermarks[(watermarks['first_ts'] < end) & (watermarks['last_ts'] >= start)]
+                cur.execute(sql.SQL("DELETE FROM {} WHERE ticker = ANY(%s);").format(sql.Identifier(schema, name)),
+                            (list(in_chunk.index),))
+                deleted += cur.rowcount
+                print(f"  chunk {i}/{len(chunks)} ({start} to {end}): {cur.rowcount} rows deleted, "
+                      f"{deleted}/{total_rows} so far")
+        _record_purged(conn, excluded, pending, watermarks['row_count'].to_dict())
+        refresh_aggregates(conn, watermarks['first_ts'].min(), watermarks['last_ts'].max())
+    finally:
+        conn.autocommit = autocommit
+    print(f"Purge complete: {deleted} rows deleted.")
+    return excluded
+
+
+def _record_purged(conn, excluded: List[str], pending: List[str], rows_deleted: dict):
+    """
+    Drops the watermarks of the purged tickers and records them, in one transaction. Records of
+    tickers that are no longer excluded are forgotten, so excluding them again purges them again.
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM ticker_watermarks WHERE ticker = ANY(%s);", (list(rows_deleted),))
+            cur.execute("DELETE FROM purged_tickers WHERE NOT ticker = ANY(%s);", (excluded,))
+            if pending:
+                execute_values(cur, """
+                    INSERT INTO purged_tickers (ticker, rows_deleted)
+                    VALUES %s
+                    ON CONFLICT (ticker) DO UPDATE SET
+                        rows_deleted = EXCLUDED.rows_deleted,
+                        purged_at = CURRENT_TIMESTAMP;
+                """, [(ticker, int(rows_deleted.get(ticker, 0))) for ticker in pending])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = autocommit
@@ -0,0 +1,126 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from pandas import DataFrame
+
+# Constants
+DEFAULT_CHUNK_DAYS = 365        # Date span of every frame yielded when iterating by date
+DEFAULT_TICKERS_PER_CHUNK = 100 # Tickers in every frame yielded when iterating by ticker
+PIPE_READ_BYTES = 1 << 16       # Reads used to drain a COPY stream the caller stopped reading
+STOCK_DATA_TYPES = {
+    'timestamp': pa.date32(),
+    'ticker': pa.string(),
+    'open': pa.float64(),
+    'high': pa.float64(),
+    'low': pa.float64(),
+    'close': pa.float64(),
+    'volume': pa.int64(),
+}
+
+
+@contextmanager
+def _copy_stream(conn, query: str, params=None):
+    """
+    Runs `query` through COPY ... TO STDOUT (as CSV with a header) in a background thread and yields
+    the read end of the pipe the rows stream through, so they never pile up in memory. Whatever the
+    caller leaves unread is drained, so the COPY finishes and the connection stays usable, and an
+    error of the COPY is raised once the caller is done.
+    """
+    with conn.cursor() as cur:
+        select = cur.mogrify(query, params).decode('utf-8').rstrip().rstrip(';')
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def produce():
+            try:
+                with open(write_fd, 'wb') as sink:
+                    cur.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER true)", sink)
+            except Exception as e:
+                errors.append(e)
+
+        producer = threading.Thread(target=produce, name='copy-to-arrow', daemon=True)
+        with open(read_fd, 'rb') as stream:
+            producer.start()
+            try:
+                yield stream
+            finally:
+                while stream.read(PIPE_READ_BYTES):
+                    pass
+                producer.join()
+                if errors:
+                    raise errors[0]
+
+
+def copy_to_arrow(conn, query: str, params=None, column_types=None) -> pa.Table:
+    """
+    Runs `query` through COPY ... TO STDOUT and parses the CSV stream with Arrow's streaming reader
+    block by block as it arrives, so rows never become Python objects and the CSV text is never
+    held in full. Give the types of every column: the streaming reader infers the others from the
+    first block only.
+    """
+    with _copy_stream(conn, query, params) as stream:
+        return pacsv.open_csv(stream, convert_options=pacsv.ConvertOptions(column_types=column_types or {})).read_all()
+
+
+def read_stock_data_arrow(conn, tickers: List[str], initial_date, end_date) -> pa.Table:
+    """
+    Returns the OHLCV rows of `tickers` between the two dates (inclusive) as an Arrow table,
+    ordered by timestamp and ticker.
+    """
+    return copy_to_arrow(conn, """
+        SELECT timestamp, ticker, open, high, low, close, volume
+        FROM stock_data
+        WHERE ticker = ANY(%s) AND
+              timestamp BETWEEN %s AND %s
+        ORDER BY timestamp, ticker
+    """, (list(tickers), initial_date, end_date), STOCK_DATA_TYPES)
+
+
+def arrow_to_frame(table: pa.Table) -> DataFrame:
+    """
+    Converts an Arrow table of stock_data rows into the (timestamp, ticker) MultiIndex dataframe
+    returned by get_stocks_from_db.
+    """
+    df = table.to_pandas(date_as_object=False)
+    df['timestamp'] = df['timestamp'].astype('datetime64[ns]')
+    return df.set_index(['timestamp', 'ticker'])
+
+
+def read_stock_data(conn, tickers: List[str], initial_date, end_date) -> DataFrame:
+    """
+    Columnar equivalent of get_stocks_from_db on a DBAPI (psycopg2) connection.
+    """
+    return arrow_to_frame(read_stock_data_arrow(conn, tickers, initial_date, end_date))
+
+
+def iter_stock_data(conn, tickers: List[str], initial_date, end_date, by: str = 'date',
+                    chunk_days: Optional[int] = None, tickers_per_chunk: Optional[int] = None,
+                    as_arrow: bool = False) -> Iterator:
+    """
+    Yields the same data as read_stock_data in bounded pieces, so datasets larger than RAM can be
+    processed one piece at a time. With by='date' every piece covers `chunk_days` calendar days of
+    all tickers; with by='ticker' it covers the whole date range of `tickers_per_chunk` tickers.
+    """
+    tickers = list(tickers)
+    if by == 'date':
+        step = pd.Timedelta(days=chunk_days or DEFAULT_CHUNK_DAYS)
+        start, end = pd.Timestamp(initial_date), pd.Timestamp(end_date)
+        windows = []
+        while start <= end:
+            windows.append((tickers, start.date(), min(start + step - pd.Timedelta(days=1), end).date()))
+            start += step
+    elif by == 'ticker':
+        size = tickers_per_chunk or DEFAULT_TICKERS_PER_CHUNK
+        windows = [(tickers[i:i + size], initial_date, end_date) for i in range(0, len(tickers), size)]
+    else:
+        raise ValueError(f"Unknown chunking '{by}'. Use 'date' or 'ticker'.")
+
+    for chunk_tickers, start, end in windows:
+        table = read_stock_data_arrow(conn, chunk_tickers, start, end)
+        if table.num_rows:
+            yield table if as_arrow else arrow_to_frame(table)
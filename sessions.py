@@ -0,0 +1,140 @@
+import glob
+import os
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Constants
+DEFAULT_CACHE_DIR = './.cache'
+
+_indexes = {}  # In-process memo: (calendar name, start, year) -> SessionIndex
+
+
+class SessionIndex:
+    """
+    Sorted arrays with every session of an exchange calendar and its open/close times in UTC.
+    All lookups are vectorized `searchsorted` calls, so they accept a single date or an array of them.
+    """
+    __slots__ = ('sessions', 'opens', 'closes')
+
+    def __init__(self, sessions: np.ndarray, opens: np.ndarray, closes: np.ndarray):
+        self.sessions = sessions.astype('datetime64[D]')
+        self.opens = opens.astype('datetime64[ns]')
+        self.closes = closes.astype('datetime64[ns]')
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @staticmethod
+    def _dates(dates):
+        return np.asarray(dates, dtype='datetime64[D]')
+
+    @staticmethod
+    def _now(now):
+        ts = pd.Timestamp(datetime.utcnow() if now is None else now)
+        if ts.tz is not None:
+            ts = ts.tz_convert('UTC').tz_localize(None)
+        return np.datetime64(ts, 'ns')
+
+    def _take(self, positions):
+        positions = np.asarray(positions)
+        valid = (positions >= 0) & (positions < len(self.sessions))
+        result = np.full(positions.shape, np.datetime64('NaT'), dtype='datetime64[D]')
+        result[valid] = self.sessions[positions[valid]]
+        return result if result.ndim else result[()]
+
+    def next_session(self, dates):
+        """
+        First session strictly after each date (NaT past the end of the index).
+        """
+        return self._take(np.searchsorted(self.sessions, self._dates(dates), side='right'))
+
+    def previous_session(self, dates):
+        """
+        Last session strictly before each date (NaT before the start of the index).
+        """
+        return self._take(np.searchsorted(self.sessions, self._dates(dates), side='left') - 1)
+
+    def sessions_between(self, start, end):
+        """
+        Sessions in the closed interval [start, end].
+        """
+        lo = np.searchsorted(self.sessions, np.datetime64(start, 'D'), side='left')
+        hi = np.searchsorted(self.sessions, np.datetime64(end, 'D'), side='right')
+        return self.sessions[lo:hi]
+
+    def last_completed(self, now=None) -> int:
+        """
+        Position of the last session whose market close is not after `now` (UTC, defaults to the current time).
+        """
+        return int(np.searchsorted(self.closes, self._now(now), side='right')) - 1
+
+    def last_completed_session(self, now=None):
+        """
+        Date of the last completed session.
+        """
+        return self.sessions[self.last_completed(now)]
+
+    def last_completed_close(self, now=None) -> pd.Timestamp:
+        """
+        Market close of the last completed session as a UTC timestamp.
+        """
+        return pd.Timestamp(self.closes[self.last_completed(now)], tz='UTC')
+
+    def is_open(self, now=None) -> bool:
+        """
+        True if the market is open at `now` (UTC, defaults to the current time).
+        """
+        now = self._now(now)
+        pos = int(np.searchsorted(self.opens, now, side='right')) - 1
+        return pos >= 0 and now < self.closes[pos]
+
+    def next_close(self, now=None) -> pd.Timestamp:
+        """
+        The first market close after `now` as a UTC timestamp.
+        """
+        pos = int(np.searchsorted(self.closes, self._now(now), side='right'))
+        return pd.Timestamp(self.closes[min(pos, len(self.closes) - 1)], tz='UTC')
+
+
+def build_session_index(calendar, start: str, end: str) -> SessionIndex:
+    """
+    Queries the calendar once for the full [start, end] schedule.
+    """
+    schedule = calendar.schedule(start_date=start, end_date=end)
+    return SessionIndex(schedule.index.values,
+                        schedule['market_open'].dt.tz_convert('UTC').dt.tz_localize(None).values,
+                        schedule['market_close'].dt.tz_convert('UTC').dt.tz_localize(None).values)
+
+
+def get_session_index(calendar, start: str, cache_dir: Optional[str] = None) -> SessionIndex:
+    """
+    Returns the session index of `calendar` from `start` to the end of next year.
+    It is built once, memoized in-process and cached on disk. The cache is keyed by the current
+    year, so it is rebuilt (and stale files removed) the first time the program runs in a new year.
+    """
+    year = datetime.utcnow().year
+    key = (calendar.name, start, year)
+    if key in _indexes:
+        return _indexes[key]
+
+    cache_dir = cache_dir or os.environ.get('CACHE_DIR', DEFAULT_CACHE_DIR)
+    prefix = os.path.join(cache_dir, f"{calendar.name}_sessions_{start}_")
+    path = f"{prefix}{year}.npz"
+    try:
+        with np.load(path) as cached:
+            index = SessionIndex(cached['sessions'], cached['opens'], cached['closes'])
+    except (FileNotFoundError, KeyError, ValueError):
+        index = build_session_index(calendar, start, f"{year + 1}-12-31")
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for stale in glob.glob(f"{prefix}*.npz"):
+                os.remove(stale)
+            np.savez(path, sessions=index.sessions, opens=index.opens, closes=index.closes)
+        except OSError as e:
+            print(f"Could not cache the session index in {cache_dir}: {e}")
+
+    _indexes[key] = index
+    return index
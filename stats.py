@@ -7,6 +7,10 @@ def main():
     df = get_stock_counts(conn)
     print('Dates and counts for stocks entered in the system via the mypicks.csv file:')
     print(df)
+    actions = get_action_counts_by_ticker(conn)
+    if actions is not None and not actions.empty:
+        print('Times each stock was added to and removed from the mypicks.csv file:')
+        print(actions.sort_values(['Added', 'Removed'], ascending=False).to_string())
     close_db(conn, engine)
 
 # Program Main
@@ -0,0 +1,480 @@
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+from close_matrix import update_close_matrix
+from constituents import INDEXES, get_constituent_settings, get_universe, refresh_constituents
+from ingest import ENCODERS, _wide_arrays, copy_payloads, summarize_batch, trim_overlap
+from locks import file_lock
+from picks import read_picks, sync_picks
+from purge import purge_tickers
+from reader import STOCK_DATA_TYPES, read_stock_data_arrow
+from watermarks import get_known_tickers, get_watermarks, upsert_watermarks
+
+# Constants
+DEFAULT_BACKEND = 'postgres'
+DEFAULT_STORAGE_DIR = './store'
+BACKENDS = ('postgres', 'parquet')
+LOCK_FILE = 'writer.lock'
+MANIFEST = 'manifest.json'
+MAX_FILES_PER_YEAR = 16  # Appended files in a year partition before they are compacted into one
+READ_ATTEMPTS = 3  # Scans of a read whose files were compacted away by another process meanwhile
+STOCK_DATA_SCHEMA = pa.schema(list(STOCK_DATA_TYPES.items()))
+PICKS_COLUMNS = ['ticker', 'date_added', 'date_removed']
+HISTORY_COLUMNS = ['ticker', 'action', 'date']
+
+
+def get_storage_settings():
+    """
+    Returns the (backend, directory) tuple from the environment, falling back to the defaults.
+    STORAGE_BACKEND is 'postgres' (the TimescaleDB server in .env) or 'parquet' (an embedded store in STORAGE_DIR).
+    """
+    backend = os.environ.get('STORAGE_BACKEND', DEFAULT_BACKEND).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{backend}'. Use one of: {', '.join(BACKENDS)}.")
+    return backend, os.environ.get('STORAGE_DIR', DEFAULT_STORAGE_DIR)
+
+
+class StorageBackend:
+    """
+    The storage operations of the downloader and the analytics helpers: watermarks, bulk ingest,
+    range reads, the close matrix, purges and the picks history. Implement it to plug in another store.
+    """
+    def get_watermarks(self, tickers: Optional[List[str]] = None) -> DataFrame:
+        """
+        Same result as watermarks.get_watermarks.
+        """
+        raise NotImplementedError
+
+    def known_tickers(self) -> List[str]:
+        return list(self.get_watermarks().index)
+
+    def write_batch(self, data: DataFrame, tickers: List[str]) -> int:
+        """
+        Stores the bars of a yf.download-shaped frame newer than each ticker's watermark and
+        updates the watermarks. Returns the number of rows written.
+        """
+        raise NotImplementedError
+
+    def read_arrow(self, tickers: List[str], initial_date, end_date, columns: Optional[List[str]] = None) -> pa.Table:
+        """
+        Same result as reader.read_stock_data_arrow, optionally restricted to some columns.
+        """
+        raise NotImplementedError
+
+    def update_close_matrix(self, sessions, directory: Optional[str] = None):
+        """
+        Brings the close matrix up to date (see close_matrix.update_close_matrix).
+        """
+        raise NotImplementedError
+
+    def purge(self, excluded: List[str], dry_run: bool = False) -> List[str]:
+        """
+        Deletes all data of the excluded tickers (see purge.purge_tickers). Returns the excluded tickers.
+        """
+        raise NotImplementedError
+
+    def universe(self) -> List[str]:
+        """
+        Returns the current constituents of all indexes.
+        """
+        raise NotImplementedError
+
+    def sync_picks(self, path: str):
+        """
+        Keeps the picks and their history in line with the picks file (see picks.sync_picks).
+        """
+        raise NotImplementedError
+
+    def picks(self) -> DataFrame:
+        """
+        Returns the mypicks rows: ticker, date_added and date_removed.
+        """
+        raise NotImplementedError
+
+    def picks_history(self) -> DataFrame:
+        """
+        Returns the mypicks_history rows: ticker, action and date.
+        """
+        raise NotImplementedError
+
+
+class PostgresStorage(StorageBackend):
+    """
+    The TimescaleDB database of `conn`, as set up by assets_db.init_db.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __str__(self):
+        return 'the database'
+
+    def get_watermarks(self, tickers=None):
+        return get_watermarks(self.conn, tickers)
+
+    def known_tickers(self):
+        return get_known_tickers(self.conn)
+
+    def write_batch(self, data, tickers):
+        watermarks = self.get_watermarks(tickers)
+        data = trim_overlap(data, tickers, {t: str(wm) for t, wm in watermarks['last_ts'].items()})
+        payload, rows = ENCODERS['binary'](data, tickers)
+        if rows:
+            with self.conn.cursor() as cur:
+                copy_payloads(cur, [payload], 'binary')
+                upsert_watermarks(cur, [(t,) + s for t, s in summarize_batch(data, tickers).items()])
+            if not self.conn.autocommit:
+                self.conn.commit()
+        return rows
+
+    def read_arrow(self, tickers, initial_date, end_date, columns=None):
+        table = read_stock_data_arrow(self.conn, tickers, initial_date, end_date)
+        return table.select(columns) if columns else table
+
+    def update_close_matrix(self, sessions, directory=None):
+        update_close_matrix(self.conn, sessions, directory)
+
+    def purge(self, excluded, dry_run=False):
+        return purge_tickers(self.conn, excluded, dry_run=dry_run)
+
+    def universe(self):
+        universe = get_universe(self.conn)
+        if not universe:
+            refresh_constituents(self.conn)
+            universe = get_universe(self.conn)
+        return universe
+
+    def sync_picks(self, path):
+        sync_picks(self.conn, path)
+
+    def picks(self):
+        return pd.read_sql_query("SELECT ticker, date_added, date_removed FROM mypicks;", self.conn)
+
+    def picks_history(self):
+        return pd.read_sql_query("SELECT ticker, action, date FROM mypicks_history;", self.conn)
+
+
+class ParquetStorage(StorageBackend):
+    """
+    Embedded store in a directory of Parquet files, for single-machine analytics without a database
+    server. Bars live under `stock_data/year=<year>/`, one file per ingested batch until a year has
+    more than MAX_FILES_PER_YEAR of them and is compacted into a single file sorted by ticker. Reads
+    are vectorized Arrow dataset scans that only open the years in range and push the ticker and
+    date filters (and the column selection) down to the Parquet row groups.
+
+    manifest.json lists the committed files along with the watermarks, the picks sync state and
+    the index constituents, and it is replaced atomically after the files are written. Writes hold
+    an exclusive lock file, so one process writes at a time, and files left by an interrupted write
+    (not in the manifest) are removed by the next writer. Readers never lock or remove anything:
+    they reload the manifest whenever another process has replaced it, and retry a scan whose files
+    were compacted away in the meantime.
+    """
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or get_storage_settings()[1]
+        self._lock = threading.Lock()
+        self._loaded = None
+        os.makedirs(os.path.join(self.directory, 'stock_data'), exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    def __str__(self):
+        return f'the Parquet store in {self.directory}'
+
+    # Manifest: {"files": {year: [path, ...]}, "watermarks": {ticker: [first_ts, last_ts, row_count, revision]},
+    #            "sync_state": {name: content hash}, "universe": {"fetched": iso time, "indexes": {index: [ticker, ...]}}}
+    def _stat(self):
+        try:
+            st = os.stat(os.path.join(self.directory, MANIFEST))
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        except FileNotFoundError:
+            return None
+
+    def _load_manifest(self) -> Dict:
+        self._loaded = self._stat()
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'files': {}, 'watermarks': {}, 'sync_state': {}, 'universe': None}
+
+    def _commit(self):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(path + '.tmp', path)
+        self._loaded = self._stat()
+
+    def _refresh(self):
+        """
+        Reloads the manifest if another process (or instance) has committed since it was loaded.
+        Call it holding self._lock.
+        """
+        if self._stat() != self._loaded:
+            self.manifest = self._load_manifest()
+
+    @contextmanager
+    def _writing(self):
+        """
+        Holds the writer lock (across threads and processes) and starts from the latest committed
+        manifest. Nobody else can be halfway through a write then, so files missing from the
+        manifest are leftovers of an interrupted one and are removed.
+        """
+        with self._lock, file_lock(os.path.join(self.directory, LOCK_FILE)) as locked:
+            self.manifest = self._load_manifest()
+            if locked:
+                self._remove_orphans()
+            yield
+
+    def _remove_orphans(self):
+        committed = {path for paths in self.manifest['files'].values() for path in paths}
+        root = os.path.join(self.directory, 'stock_data')
+        for partition in os.listdir(root):
+            for name in os.listdir(os.path.join(root, partition)):
+                path = f'stock_data/{partition}/{name}'
+                if path not in committed:
+                    os.remove(os.path.join(self.directory, path))
+
+    def _write_file(self, year: int, table: pa.Table) -> str:
+        path = f'stock_data/year={year}/part-{uuid.uuid4().hex}.parquet'
+        os.makedirs(os.path.join(self.directory, os.path.dirname(path)), exist_ok=True)
+        pq.write_table(table, os.path.join(self.directory, path))
+        return path
+
+    def _delete_files(self, paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(os.path.join(self.directory, path))
+            except FileNotFoundError:
+                pass
+
+    def _read_files(self, paths: List[str], columns=None, filter=None) -> pa.Table:
+        if not paths:
+            return STOCK_DATA_SCHEMA.empty_table().select(columns or STOCK_DATA_SCHEMA.names)
+        dataset = ds.dataset([os.path.join(self.directory, p) for p in paths], schema=STOCK_DATA_SCHEMA, format='parquet')
+        return dataset.to_table(columns=columns, filter=filter)
+
+    def get_watermarks(self, tickers=None):
+        with self._lock:
+            self._refresh()
+            watermarks = self.manifest['watermarks']
+            names = list(watermarks) if tickers is None else [t for t in dict.fromkeys(tickers) if t in watermarks]
+            rows = [(t, date.fromisoformat(watermarks[t][0]), date.fromisoformat(watermarks[t][1]),
+                     watermarks[t][2], watermarks[t][3]) for t in names]
+        df = pd.DataFrame(rows, columns=['ticker', 'first_ts', 'last_ts', 'row_count', 'revision'])
+        return df.set_index('ticker')
+
+    def known_tickers(self):
+        with self._lock:
+            self._refresh()
+            return list(self.manifest['watermarks'])
+
+    def write_batch(self, data, tickers):
+        with self._writing():
+            watermarks = self.manifest['watermarks']
+            data = trim_overlap(data, tickers, {t: wm[1] for t, wm in watermarks.items()})
+            dates, names, fields = _wide_arrays(data, tickers)
+            valid = np.ones(fields['Close'].shape, dtype=bool)
+            for values in fields.values():
+                valid &= ~np.isnan(values)
+            col_idx, date_idx = np.nonzero(valid.T)  # Row order: by ticker, then timestamp.
+            if not len(date_idx):
+                return 0
+            table = pa.table({
+                'timestamp': pa.array(dates[date_idx], pa.date32()),
+                'ticker': pa.array(np.asarray(names, dtype=object)[col_idx], pa.string()),
+                **{f.lower(): pa.array(fields[f][date_idx, col_idx].astype('int64' if f == 'Volume' else 'float64'))
+                   for f in fields},
+            }, schema=STOCK_DATA_SCHEMA)
+            years = pc.year(table['timestamp'])
+            touched = pc.unique(years).to_pylist()
+            for year in touched:
+                path = self._write_file(year, table.filter(pc.equal(years, year)))
+                self.manifest['files'].setdefault(str(year), []).append(path)
+            for ticker, (first, last, count) in summarize_batch(data, tickers).items():
+                previous = watermarks.get(ticker)
+                if previous:
+                    watermarks[ticker] = [min(previous[0], str(first)), max(previous[1], str(last)),
+                                          previous[2] + count, previous[3]]
+                else:
+                    watermarks[ticker] = [str(first), str(last), count, 0]
+            self._commit()
+            for year in touched:
+                if len(self.manifest['files'][str(year)]) > MAX_FILES_PER_YEAR:
+                    self._rewrite_year(str(year))
+        return table.num_rows
+
+    def _rewrite_year(self, year: str, drop: Optional[List[str]] = None):
+        """
+        Rewrites the files of a year partition as a single file sorted by ticker and timestamp,
+        without the rows of the `drop` tickers.
+        """
+        old = self.manifest['files'][year]
+        table = self._read_files(old, filter=~ds.field('ticker').isin(drop) if drop else None)
+        new = [self._write_file(int(year), table.sort_by([('ticker', 'ascending'), ('timestamp', 'ascending')]))] \
+            if table.num_rows else []
+        self.manifest['files'][year] = new
+        self._commit()
+        self._delete_files(old)
+
+    def read_arrow(self, tickers, initial_date, end_date, columns=None):
+        start, end = pd.Timestamp(initial_date), pd.Timestamp(end_date)
+        condition = ds.field('ticker').isin(list(tickers)) & \
+            (ds.field('timestamp') >= start.date()) & (ds.field('timestamp') <= end.date())
+        with self._lock:
+            for attempt in range(READ_ATTEMPTS):
+                self._refresh()
+                paths = [p for year in range(start.year, end.year + 1) for p in self.manifest['files'].get(str(year), [])]
+                try:
+                    table = self._read_files(paths, filter=condition)
+                    break
+                except FileNotFoundError:
+                    # A writer compacted the year after the manifest was read. Its new manifest
+                    # is already committed, since files are only deleted after that.
+                    if attempt == READ_ATTEMPTS - 1:
+                        raise
+        table = table.sort_by([('timestamp', 'ascending'), ('ticker', 'ascending')])
+        return table.select(columns) if columns else table
+
+    def _read_closes(self, tickers, start, end) -> pa.Table:
+        return self.read_arrow(tickers, start, end, columns=['timestamp', 'ticker', 'close'])
+
+    def update_close_matrix(self, sessions, directory=None):
+        update_close_matrix(None, sessions, directory, watermarks=self.get_watermarks(), read_closes=self._read_closes)
+
+    def purge(self, excluded, dry_run=False):
+        excluded = sorted(set(excluded))
+        with self._writing():
+            watermarks = self.manifest['watermarks']
+            pending = [t for t in excluded if t in watermarks]
+            if not pending:
+                return excluded
+            years = {str(y) for t in pending for y in range(int(watermarks[t][0][:4]), int(watermarks[t][1][:4]) + 1)}
+            years &= set(self.manifest['files'])
+            rows = sum(watermarks[t][2] for t in pending)
+            print(f"{'Would purge' if dry_run else 'Purging'} {len(pending)} excluded tickers "
+                  f"({rows} rows in {len(years)} yearly partitions): {', '.join(pending)}")
+            if dry_run:
+                return excluded
+            for year in sorted(years):
+                self._rewrite_year(year, drop=pending)
+            for ticker in pending:
+                del watermarks[ticker]
+            self._commit()
+        print(f"Purge complete: {rows} rows deleted.")
+        return excluded
+
+    def universe(self):
+        """
+        Returns the constituents of all indexes, fetched again from the constituents source (see
+        constituents.get_constituent_settings) once they are older than its TTL. An index that
+        can't be fetched keeps its previous constituents.
+        """
+        source, ttl = get_constituent_settings()
+
+        def stale(cached):
+            return cached['fetched'] is None or datetime.now() - datetime.fromisoformat(cached['fetched']) > ttl
+
+        with self._lock:
+            self._refresh()
+            cached = self.manifest.get('universe') or {'fetched': None, 'indexes': {}}
+            if not stale(cached):
+                return sorted({t for tickers in cached['indexes'].values() for t in tickers})
+        with self._writing():
+            cached = self.manifest.get('universe') or {'fetched': None, 'indexes': {}}
+            if stale(cached):
+                for index in INDEXES:
+                    try:
+                        cached['indexes'][index] = source.fetch(index)
+                    except Exception as e:
+                        print(f"Could not refresh the {index} constituents: {e}")
+                cached['fetched'] = datetime.now().isoformat()
+                self.manifest['universe'] = cached
+                self._commit()
+            return sorted({t for tickers in cached['indexes'].values() for t in tickers})
+
+    def _read_table(self, name: str, columns: List[str]) -> DataFrame:
+        try:
+            return pq.read_table(os.path.join(self.directory, f'{name}.parquet')).to_pandas()
+        except FileNotFoundError:
+            return pd.DataFrame(columns=columns)
+
+    def _write_table(self, name: str, df: DataFrame):
+        path = os.path.join(self.directory, f'{name}.parquet')
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def picks(self):
+        return self._read_table('mypicks', PICKS_COLUMNS)
+
+    def picks_history(self):
+        return self._read_table('mypicks_history', HISTORY_COLUMNS)
+
+    def sync_picks(self, path):
+        parsed = read_picks(path)
+        if parsed is None:
+            print(f"The file {path} does not exist. Skipping the picks sync.")
+            return
+        tickers, content_hash, file_time = parsed
+        name = os.path.basename(path)
+        with self._writing():
+            if self.manifest['sync_state'].get(name) == content_hash:
+                return
+            picks = self.picks().set_index('ticker')
+            picks['date_added'] = pd.to_datetime(picks['date_added'])
+            picks['date_removed'] = pd.to_datetime(picks['date_removed'])
+            is_current = picks['date_removed'].isna() | (picks['date_added'] > picks['date_removed'])
+            current, listed = set(picks.index[is_current]), set(tickers)
+            added, removed = sorted(listed - current), sorted(current - listed)
+            if added or removed:
+                stamp = pd.Timestamp(file_time)
+                picks = picks.reindex(picks.index.union(added))
+                picks.loc[added, 'date_added'] = stamp
+                picks.loc[added, 'date_removed'] = pd.NaT
+                picks.loc[removed, 'date_removed'] = stamp
+                history = pd.DataFrame([(t, 'Added', stamp) for t in added] + [(t, 'Removed', stamp) for t in removed],
+                                       columns=HISTORY_COLUMNS)
+                self._write_table('mypicks', picks.rename_axis('ticker').reset_index()[PICKS_COLUMNS])
+                self._write_table('mypicks_history', pd.concat([self.picks_history(), history], ignore_index=True))
+            self.manifest['sync_state'][name] = content_hash
+            self._commit()
+        if added or removed:
+            print(f"Picks synced from {name}: {len(added)} added, {len(removed)} removed.")
+
+
+def open_storage(conn=None) -> StorageBackend:
+    """
+    Returns the storage backend selected in .env (see get_storage_settings). The postgres backend
+    works on `conn`, a connection from assets_db.init_db.
+    """
+    backend, directory = get_storage_settings()
+    if backend == 'parquet':
+        return ParquetStorage(directory)
+    if conn is None:
+        raise ValueError('The postgres storage backend needs a database connection.')
+    return PostgresStorage(conn)
+
+
+def count_picks(history: DataFrame) -> DataFrame:
+    """
+    Number of picks held at the end of every day between the first and last change of the picks
+    history, like assets_db.get_stock_counts: the running sum of +1 for every Added and -1 for
+    every Removed, in one vectorized pass.
+    """
+    if history.empty:
+        return pd.DataFrame(columns=['stock_count'], index=pd.DatetimeIndex([], name='date'))
+    days = pd.to_datetime(history['date']).dt.normalize()
+    deltas = np.where(history['action'] == 'Added', 1, -1)
+    daily = pd.Series(deltas, index=days).groupby(level=0).sum()
+    daily = daily.reindex(pd.date_range(daily.index[0], daily.index[-1], freq='D', name='date'), fill_value=0)
+    return daily.cumsum().to_frame('stock_count')
@@ -0,0 +1,141 @@
+import os
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import constituents
+from constituents import ConstituentRefresher, HTMLFileSource, refresh_constituents
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'constituents')
+
+
+class FakeDB:
+    """
+    In-memory stand-in for the index_snapshots, index_members and index_changes tables, answering
+    the statements constituents.py runs. CURRENT_DATE is `today`.
+    """
+    def __init__(self):
+        self.today = date(2024, 1, 2)
+        self.snapshots = {}  # (index, date) -> [tickers, fetched_at]
+        self.members = {}    # (index, ticker) -> since
+        self.changes = {}    # (index, date, ticker) -> action
+        self.autocommit = True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def age(self, days: int):
+        for snapshot in self.snapshots.values():
+            snapshot[1] -= timedelta(days=days)
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        db = self.db
+        if 'MAX(fetched_at)' in query:
+            latest = {}
+            for (index, _), (_, fetched_at) in db.snapshots.items():
+                latest[index] = max(latest.get(index, fetched_at), fetched_at)
+            self.rows = list(latest.items())
+        elif query.startswith('SELECT DISTINCT ticker FROM index_members'):
+            self.rows = sorted({(ticker,) for _, ticker in db.members})
+        elif query.lstrip().startswith('SELECT ticker FROM index_members'):
+            self.rows = [(ticker,) for index, ticker in db.members if index == params[0]]
+        elif 'UPDATE index_snapshots' in query:
+            last = max(d for index, d in db.snapshots if index == params[0])
+            db.snapshots[(params[0], last)][1] = datetime.now()
+        elif 'INSERT INTO index_snapshots' in query:
+            db.snapshots[(params[0], db.today)] = [list(params[1]), datetime.now()]
+        elif 'DELETE FROM index_members' in query:
+            for ticker in params[1]:
+                db.members.pop((params[0], ticker), None)
+        else:
+            raise AssertionError(f'Unexpected statement: {query}')
+
+    def fetchall(self):
+        return self.rows
+
+
+def fake_execute_values(cur, query, rows, template=None):
+    db = cur.db
+    if 'INSERT INTO index_members' in query:
+        for index, ticker in rows:
+            db.members.setdefault((index, ticker), db.today)
+    elif 'INSERT INTO index_changes' in query:
+        for index, ticker, action in rows:
+            db.changes[(index, db.today, ticker)] = action
+    else:
+        raise AssertionError(f'Unexpected statement: {query}')
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(constituents, 'execute_values', fake_execute_values)
+    constituents._invalidate_universe()
+    yield FakeDB()
+    constituents._invalidate_universe()
+
+
+def members(db, index):
+    return sorted(ticker for name, ticker in db.members if name == index)
+
+
+def test_fixture_pages():
+    source = HTMLFileSource(os.path.join(FIXTURES, '2024-01-02'))
+    assert source.fetch('DJI') == ['AAPL', 'JPM', 'KO', 'MSFT']
+    assert source.fetch('NASDAQ_100') == ['AAPL', 'AMZN', 'MSFT', 'NVDA']
+    assert 'BRK-B' in source.fetch('Russell_1000')
+
+
+def test_two_snapshots(db):
+    first = HTMLFileSource(os.path.join(FIXTURES, '2024-01-02'))
+    assert refresh_constituents(db, first, ttl=timedelta(days=7)) == {}
+    assert db.changes == {}  # The first snapshot is a baseline.
+    assert members(db, 'DJI') == ['AAPL', 'JPM', 'KO', 'MSFT']
+    assert members(db, 'Russell_1000') == ['AAPL', 'AMZN', 'BRK-B', 'JPM', 'KO', 'MSFT', 'NVDA', 'XOM']
+    assert 'XOM' in constituents.get_universe(db)
+
+    # Fresh snapshots are not fetched again.
+    assert refresh_constituents(db, HTMLFileSource(os.path.join(FIXTURES, 'missing')), ttl=timedelta(days=7)) == {}
+
+    db.age(days=90)
+    db.today = date(2024, 4, 1)
+    refresher = ConstituentRefresher(lambda: db, HTMLFileSource(os.path.join(FIXTURES, '2024-04-01')))
+    refresher.start()
+    refresher.join()
+
+    second = date(2024, 4, 1)
+    assert db.changes == {
+        ('DJI', second, 'NVDA'): 'add',
+        ('DJI', second, 'KO'): 'remove',
+        ('Russell_1000', second, 'PLTR'): 'add',
+        ('Russell_1000', second, 'XOM'): 'remove',
+    }
+    assert members(db, 'DJI') == ['AAPL', 'JPM', 'MSFT', 'NVDA']
+    assert members(db, 'NASDAQ_100') == ['AAPL', 'AMZN', 'MSFT', 'NVDA']
+    assert members(db, 'Russell_1000') == ['AAPL', 'AMZN', 'BRK-B', 'JPM', 'KO', 'MSFT', 'NVDA', 'PLTR']
+    assert db.members[('Russell_1000', 'PLTR')] == second
+    assert db.members[('Russell_1000', 'AAPL')] == date(2024, 1, 2)
+    # NASDAQ_100 didn't change, so it has no new snapshot.
+    assert ('NASDAQ_100', second) not in db.snapshots and ('DJI', second) in db.snapshots
+    assert refresher.added == ['NVDA', 'PLTR']
+    assert 'XOM' not in constituents.get_universe(db)
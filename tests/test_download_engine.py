@@ -0,0 +1,134 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import download_engine
+from benchmarks.fake_provider import FakeProvider
+from benchmarks.synthetic import make_market
+from download_engine import DownloadReport, download_batches, fetch_isolating_failures, fetch_with_retries
+
+START = '2024-01-02'
+
+
+@pytest.fixture
+def market():
+    data, tickers = make_market(12, pd.bdate_range(START, periods=20), nan_rate=0)
+    return data, tickers
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(download_engine, 'time', SimpleNamespace(sleep=delays.append))
+    return delays
+
+
+class FlakyProvider(FakeProvider):
+    """
+    Fails every call that includes one of the `bad` tickers, and the first `transient` calls.
+    """
+    def __init__(self, market, bad=(), transient=0):
+        super().__init__(market, latency=0)
+        self.bad = set(bad)
+        self.transient = transient
+        self.batches = []
+
+    def fetch(self, tickers, start, end=None):
+        self.batches.append(list(tickers))
+        if self.transient:
+            self.transient -= 1
+            raise ConnectionError('Temporary failure.')
+        if self.bad & set(tickers):
+            raise ConnectionError('Bad symbol.')
+        return super().fetch(tickers, start, end)
+
+
+def test_chunks_every_group(market):
+    data, tickers = market
+    provider = FlakyProvider(data)
+    groups = [{'date': START, 'tickers': tickers[:7]}, {'date': '2024-01-10', 'tickers': tickers[7:], 'end': '2024-01-20'}]
+    results = list(download_batches(groups, fetcher=provider, workers=2, chunk_size=3))
+    assert sorted(len(b) for b in provider.batches) == [1, 2, 3, 3, 3]
+    fetched = sorted(t for chunk, _ in results for t in chunk['tickers'])
+    assert fetched == sorted(tickers)
+    for chunk, frame in results:
+        assert set(frame['Close'].columns) == set(chunk['tickers'])
+        if 'end' in chunk:
+            assert frame.index.max() < pd.Timestamp(chunk['end'])
+        assert frame.index.min() >= pd.Timestamp(chunk['date'])
+
+
+def test_bounds_chunks_in_flight(market):
+    data, tickers = market
+
+    class CountingProvider(FakeProvider):
+        active = peak = 0
+        lock = threading.Lock()
+
+        def fetch(self, tickers, start, end=None):
+            with self.lock:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+            time.sleep(0.01)
+            with self.lock:
+                self.active -= 1
+            return super().fetch(tickers, start, end)
+
+    provider = CountingProvider(data, latency=0)
+    workers = 2
+    consumed = 0
+    for _ in download_batches([{'date': START, 'tickers': tickers}], fetcher=provider, workers=workers, chunk_size=1):
+        consumed += 1
+        # Nothing new is requested while the consumer is busy with a chunk.
+        assert provider.calls <= consumed - 1 + workers
+        time.sleep(0.02)
+    assert consumed == len(tickers)
+    assert provider.peak <= workers
+
+
+def test_retries_with_backoff(market, sleeps):
+    data, tickers = market
+    provider = FlakyProvider(data, transient=2)
+    report = DownloadReport()
+    frame = fetch_with_retries(provider, tickers[:3], START, report=report)
+    assert frame is not None
+    assert len(provider.batches) == 3
+    assert report.retries == 2
+    assert len(sleeps) == 2
+    for attempt, delay in enumerate(sleeps):
+        assert 0 <= delay <= download_engine.RETRY_BASE_DELAY * 2 ** attempt
+
+
+def test_gives_up_after_max_retries(market, sleeps):
+    data, tickers = market
+    provider = FlakyProvider(data, bad=tickers[:1])
+    assert fetch_with_retries(provider, tickers[:1], START) is None
+    assert len(provider.batches) == download_engine.MAX_RETRIES
+    assert len(sleeps) == download_engine.MAX_RETRIES - 1
+
+
+def test_bisection_isolates_failing_and_empty_tickers(market, sleeps):
+    data, tickers = market
+    batch = tickers[:6] + ['MISSING']
+    provider = FlakyProvider(data, bad=[tickers[4]])
+    report = DownloadReport()
+    frame = fetch_isolating_failures(provider, batch, START, report=report)
+    assert report.failed == {tickers[4]: 'error', 'MISSING': 'empty'}
+    assert report.succeeded == set(tickers[:6]) - {tickers[4]}
+    assert set(frame['Close'].columns[frame['Close'].notna().any()]) == report.succeeded
+    # The bad symbol ends up alone in its calls.
+    assert [tickers[4]] in provider.batches
+
+
+def test_download_batches_reports_failures(market, sleeps):
+    data, tickers = market
+    provider = FlakyProvider(data, bad=[tickers[1]])
+    report = DownloadReport()
+    results = list(download_batches([{'date': START, 'tickers': tickers}], fetcher=provider, workers=3, chunk_size=4,
+                                    report=report))
+    assert report.failed == {tickers[1]: 'error'}
+    assert report.succeeded == set(tickers) - {tickers[1]}
+    assert sum(len(chunk['tickers']) for chunk, _ in results) == len(tickers)
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import pandas as pd
+import pyarrow as pa
+
+import gaps
+from gaps import GAP_COLUMNS, find_gaps
+
+DAYS = pd.bdate_range('2024-01-02', periods=30)
+SESSIONS = SimpleNamespace(sessions=DAYS.values.astype('datetime64[D]'))
+
+
+def day(i):
+    return str(DAYS[i].date())
+
+
+def history(monkeypatch, stored):
+    """
+    Serves the watermarks and stored dates of `stored` ({ticker: [dates]}) to find_gaps, and
+    records the tickers whose dates were read.
+    """
+    watermarks = pd.DataFrame([(t, min(d).date(), max(d).date(), len(d), 0) for t, d in stored.items()],
+                              columns=['ticker', 'first_ts', 'last_ts', 'row_count', 'revision']).set_index('ticker')
+    read = []
+
+    def copy_to_arrow(conn, query, params, types):
+        read.extend(params[0])
+        rows = [(t, d.date()) for t in params[0] for d in stored[t]]
+        return pa.table({'ticker': pa.array([r[0] for r in rows], pa.string()),
+                         'timestamp': pa.array([r[1] for r in rows], pa.date32())})
+
+    monkeypatch.setattr(gaps, 'get_watermarks', lambda conn, tickers=None: watermarks)
+    monkeypatch.setattr(gaps, 'copy_to_arrow', copy_to_arrow)
+    return read
+
+
+def test_minimal_missing_ranges(monkeypatch):
+    read = history(monkeypatch, {
+        'FULL': DAYS[3:20],
+        'ONE': DAYS.delete(10),
+        'RUNS': DAYS[2:].delete([5, 6, 7, 20]),        # Sessions 7-9 and 22 are missing
+        'EDGE': DAYS[:15].delete([1, 13]),
+    })
+    found = find_gaps(None, SESSIONS)
+    assert list(found.columns) == GAP_COLUMNS
+    assert sorted(read) == ['EDGE', 'ONE', 'RUNS']  # Complete histories are never read.
+    got = sorted((t, str(s.date()), str(e.date()), n) for t, s, e, n in found.itertuples(index=False))
+    assert got == [
+        ('EDGE', day(1), day(1), 1),
+        ('EDGE', day(13), day(13), 1),
+        ('ONE', day(10), day(10), 1),
+        ('RUNS', day(7), day(9), 3),
+        ('RUNS', day(22), day(22), 1),
+    ]
+
+
+def test_complete_histories(monkeypatch):
+    read = history(monkeypatch, {'A': DAYS, 'B': DAYS[5:10]})
+    assert find_gaps(None, SESSIONS).empty
+    assert read == []
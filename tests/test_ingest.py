@@ -0,0 +1,98 @@
+import io
+import struct
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import make_market
+from ingest import BINARY_HEADER, BINARY_TRAILER, OHLCV_FIELDS, copy_payloads, encode_binary, encode_csv, to_long_format
+
+COLUMNS = ['timestamp', 'ticker'] + OHLCV_FIELDS
+
+
+def decode_binary(payload: bytes) -> pd.DataFrame:
+    """
+    Reads binary COPY tuples of stock_data field by field, independently of the encoder's record layout.
+    """
+    rows, pos = [], 0
+    while pos < len(payload):
+        (nfields,), pos = struct.unpack_from('>h', payload, pos), pos + 2
+        assert nfields == len(COLUMNS)
+        row = []
+        for i in range(nfields):
+            (size,), pos = struct.unpack_from('>i', payload, pos), pos + 4
+            raw, pos = payload[pos:pos + size], pos + size
+            if i == 0:
+                assert size == 4
+                row.append(str(date(2000, 1, 1) + timedelta(days=struct.unpack('>i', raw)[0])))
+            elif i == 1:
+                row.append(raw.decode('utf-8'))
+            elif i == nfields - 1:
+                assert size == 8
+                row.append(struct.unpack('>q', raw)[0])
+            else:
+                assert size == 8
+                row.append(struct.unpack('>d', raw)[0])
+        rows.append(row)
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def canonical(df: pd.DataFrame) -> pd.DataFrame:
+    return df[COLUMNS].sort_values(['timestamp', 'ticker']).reset_index(drop=True)
+
+
+@pytest.fixture
+def market():
+    data, tickers = make_market(6, pd.bdate_range('2024-01-02', periods=30), nan_rate=0.05)
+    # Tickers of several lengths are encoded in separate passes.
+    names = {t: n for t, n in zip(tickers, ['A', 'BRK-B', 'MSFT', 'GOOGL', 'X', 'ÅB'])}
+    return data.rename(columns=names, level=1), list(names.values())
+
+
+def test_binary_matches_long_format(market):
+    data, tickers = market
+    payload, rows = encode_binary(data, tickers)
+    decoded = canonical(decode_binary(payload))
+    expected = canonical(to_long_format(data, tickers))
+    assert rows == len(decoded) == len(expected)
+    # Bars with a NaN close are dropped.
+    assert rows == int(data['Close'].notna().sum().sum()) < data['Close'].size
+    pd.testing.assert_frame_equal(decoded, expected, check_dtype=False)
+
+
+def test_binary_matches_csv(market):
+    data, tickers = market
+    text, csv_rows = encode_csv(data, tickers)
+    from_csv = pd.read_csv(io.StringIO(text), names=COLUMNS, dtype={'timestamp': str})
+    payload, rows = encode_binary(data, tickers)
+    assert rows == csv_rows
+    pd.testing.assert_frame_equal(canonical(decode_binary(payload)), canonical(from_csv), check_dtype=False)
+
+
+def test_binary_single_ticker(market):
+    data, tickers = market
+    flat = data.xs('MSFT', axis=1, level=1).copy()  # yf.download of a single ticker has flat columns
+    flat.iloc[3, flat.columns.get_loc('Open')] = np.nan
+    payload, rows = encode_binary(flat, ['MSFT'])
+    decoded = decode_binary(payload)
+    assert set(decoded['ticker']) == {'MSFT'}
+    assert rows == len(flat.dropna())
+    pd.testing.assert_frame_equal(canonical(decoded), canonical(to_long_format(flat, ['MSFT'])), check_dtype=False)
+
+
+def test_copy_payload_framing(market):
+    data, tickers = market
+
+    class Cursor:
+        def copy_expert(self, statement, buffer):
+            self.statement, self.data = statement, buffer.read()
+
+    cur = Cursor()
+    parts = [encode_binary(data, tickers)[0], encode_binary(data.iloc[:2], tickers)[0]]
+    copy_payloads(cur, parts, 'binary')
+    assert 'FORMAT binary' in cur.statement
+    assert cur.data.startswith(BINARY_HEADER) and cur.data.endswith(BINARY_TRAILER)
+    decoded = decode_binary(cur.data[len(BINARY_HEADER):-len(BINARY_TRAILER)])
+    assert len(decoded) == encode_binary(data, tickers)[1] + encode_binary(data.iloc[:2], tickers)[1]
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from corporate_actions import OVERLAP_BARS
+from planner import plan_downloads
+
+DAYS = pd.bdate_range('2024-01-02', periods=60)
+SESSIONS = SimpleNamespace(sessions=DAYS.values.astype('datetime64[D]'))
+LAST = DAYS[-1]
+BEGINNING = '2023-12-29'
+
+
+def latest(**watermarks):
+    return pd.Series({t: pd.Timestamp(d) if d else pd.NaT for t, d in watermarks.items()}, dtype='datetime64[ns]')
+
+
+def plan(series, **kwargs):
+    kwargs.setdefault('chunk_size', 100)
+    return plan_downloads(series, SESSIONS, BEGINNING, last_session=LAST, **kwargs)
+
+
+def session(i):
+    return str(DAYS[i].date())
+
+
+def test_skips_up_to_date_tickers():
+    assert plan(latest(A=session(-1), B=session(-1))) == []
+    assert plan(pd.Series([], dtype='datetime64[ns]')) == []
+
+
+def test_coalesces_neighbouring_groups():
+    series = latest(A=session(50), B=session(51), C=session(52))
+    items = plan(series, call_cost=1000)
+    assert len(items) == 1
+    item = items[0]
+    # The call starts at the earliest group, minus the overlap bars refetched for corporate actions.
+    assert item['date'] == session(51 - OVERLAP_BARS)
+    assert sorted(item['tickers']) == ['A', 'B', 'C']
+    assert item['watermarks'] == {'A': session(50), 'B': session(51), 'C': session(52)}
+    assert item['rows'] == 3 * (len(DAYS) - (51 - OVERLAP_BARS))
+
+
+def test_keeps_groups_apart_when_overlap_costs_more():
+    series = latest(A=session(10), B=session(50))
+    items = plan(series, call_cost=0)
+    assert [(i['date'], i['tickers']) for i in items] == [(session(11 - OVERLAP_BARS), ['A']),
+                                                          (session(51 - OVERLAP_BARS), ['B'])]
+    # Merging them refetches 40 sessions of B, worth it only if a call costs more than that.
+    assert len(plan(series, call_cost=10)) == 2
+    assert len(plan(series, call_cost=1000)) == 1
+
+
+def test_new_tickers_start_from_the_beginning():
+    items = plan(latest(NEW=None, OLD=session(58)), call_cost=0)
+    first = items[0]
+    assert first['tickers'] == ['NEW'] and first['date'] == session(0)
+    assert 'watermarks' not in first
+    assert items[1]['watermarks'] == {'OLD': session(58)}
+
+
+def test_splits_calls_by_tickers_and_rows():
+    series = latest(**{f'T{i}': session(40) for i in range(10)})
+    items = plan(series, chunk_size=4)
+    assert [len(i['tickers']) for i in items] == [4, 3, 3]
+    spans = len(DAYS) - (41 - OVERLAP_BARS)
+    items = plan(series, max_call_rows=2 * spans)
+    assert all(len(i['tickers']) <= 2 for i in items)
+    assert sorted(t for i in items for t in i['tickers']) == sorted(series.index)
+    assert sum(i['rows'] for i in items) == 10 * spans
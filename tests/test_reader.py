@@ -0,0 +1,62 @@
+import pyarrow as pa
+import pytest
+
+from reader import STOCK_DATA_TYPES, copy_to_arrow, read_stock_data_arrow
+
+
+class CopyCursor:
+    """
+    Answers COPY ... TO STDOUT with `rows` stock_data rows, written in small pieces like psycopg2
+    does, and optionally fails after `fail_after` of them.
+    """
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+        self.statements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def mogrify(self, query, params=None):
+        return query.encode('utf-8')
+
+    def copy_expert(self, statement, file):
+        self.statements.append(statement)
+        file.write(b'timestamp,ticker,open,high,low,close,volume\n')
+        for i in range(self.rows):
+            if i == self.fail_after:
+                raise RuntimeError('connection lost')
+            file.write(f'2024-01-{i % 28 + 1:02d},T{i % 50},{i}.5,{i}.75,{i}.25,{i}.5,{i * 10}\n'.encode())
+
+
+class Conn:
+    def __init__(self, cur):
+        self.cur = cur
+
+    def cursor(self):
+        return self.cur
+
+
+def test_streams_large_results():
+    # Several MB of CSV: far more than a pipe holds, so the COPY and the parser run side by side.
+    cur = CopyCursor(100000)
+    table = read_stock_data_arrow(Conn(cur), ['T1'], '2024-01-01', '2024-01-31')
+    assert cur.statements[0].startswith('COPY (') and 'FORMAT csv, HEADER true' in cur.statements[0]
+    assert table.schema == pa.schema(list(STOCK_DATA_TYPES.items()))
+    assert table.num_rows == 100000
+    assert table['volume'][99999].as_py() == 999990
+    assert table['ticker'][51].as_py() == 'T1'
+
+
+def test_empty_result():
+    table = copy_to_arrow(Conn(CopyCursor(0)), 'SELECT 1', None, STOCK_DATA_TYPES)
+    assert table.num_rows == 0
+    assert table.schema == pa.schema(list(STOCK_DATA_TYPES.items()))
+
+
+def test_copy_errors_are_raised():
+    with pytest.raises(RuntimeError, match='connection lost'):
+        copy_to_arrow(Conn(CopyCursor(100000, fail_after=50000)), 'SELECT 1', None, STOCK_DATA_TYPES)
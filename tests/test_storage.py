@@ -0,0 +1,24 @@
+import pandas as pd
+
+import storage
+from benchmarks.synthetic import make_market
+from storage import ParquetStorage
+
+
+def test_reader_sees_compacted_year(tmp_path):
+    data, tickers = make_market(4, pd.bdate_range('2015-01-02', periods=storage.MAX_FILES_PER_YEAR + 1), nan_rate=0)
+    writer = ParquetStorage(str(tmp_path))
+    writer.write_batch(data.iloc[:1], tickers)
+    # Opened before the year is compacted, and has already read its first file.
+    reader = ParquetStorage(str(tmp_path))
+    assert reader.read_arrow(tickers, '2015-01-01', '2015-12-31').num_rows == len(tickers)
+
+    for day in range(1, len(data)):
+        writer.write_batch(data.iloc[day:day + 1], tickers)
+    assert len(writer.manifest['files']['2015']) == 1
+
+    table = reader.read_arrow(tickers, '2015-01-01', '2015-12-31')
+    assert table.num_rows == len(data) * len(tickers)
+    assert table.equals(writer.read_arrow(tickers, '2015-01-01', '2015-12-31'))
+    assert reader.get_watermarks()['row_count'].to_dict() == {t: len(data) for t in tickers}
+    assert reader.known_tickers() == writer.known_tickers()
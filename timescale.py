@@ -0,0 +1,179 @@
+import os
+from typing import List
+
+import pyarrow as pa
+
+from reader import STOCK_DATA_TYPES, copy_to_arrow
+
+# Constants
+DEFAULT_CHUNK_INTERVAL = '3 months'   # About 65 sessions x universe size rows per chunk
+DEFAULT_COMPRESS_AFTER = '180 days'   # Chunks older than this get compressed
+MIN_COMPRESSION_VERSION = (2, 11)     # First TimescaleDB release that can UPDATE and DELETE compressed rows
+
+# name: (view, bucket width, refresh window start offset). The window must span at least two buckets.
+AGGREGATES = {
+    'weekly': ('stock_data_weekly', '1 week', '2 months'),
+    'monthly': ('stock_data_monthly', '1 month', '4 months'),
+}
+
+
+def get_timescale_settings():
+    """
+    Returns the (chunk_interval, compress_after) tuple from the environment, falling back to the defaults.
+    """
+    return (os.environ.get('TIMESCALE_CHUNK_INTERVAL', DEFAULT_CHUNK_INTERVAL),
+            os.environ.get('TIMESCALE_COMPRESS_AFTER', DEFAULT_COMPRESS_AFTER))
+
+
+def timescale_version(conn) -> tuple:
+    """
+    Returns the installed TimescaleDB version as a tuple of ints, e.g. (2, 14, 2).
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'timescaledb';")
+        row = cursor.fetchone()
+    return tuple(int(part) for part in row[0].split('-')[0].split('.')) if row else ()
+
+
+def _compression_enabled(conn):
+    """
+    Whether compression is enabled on stock_data, or None if it isn't a hypertable.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT compression_enabled
+            FROM timescaledb_information.hypertables
+            WHERE hypertable_name = 'stock_data';
+        """)
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _disable_compression(conn, run):
+    """
+    Decompresses every compressed stock_data chunk and turns compression off, for servers where
+    compressed rows can't be updated or deleted.
+    """
+    if not _compression_enabled(conn):
+        return
+    print("Decompressing stock_data so corporate action repairs and purges keep working...")
+    run('remove the compression policy', ("SELECT remove_compression_policy('stock_data', if_exists => true);", None))
+    if run('decompress stock_data', ("""
+            SELECT decompress_chunk(c, if_compressed => true) FROM show_chunks('stock_data') c;
+        """, None)) and run('disable compression', ("ALTER TABLE stock_data SET (timescaledb.compress = false);", None)):
+        print("Compression disabled on stock_data.")
+
+
+def configure_timescale(conn):
+    """
+    Idempotently configures the stock_data hypertable: the chunk interval for daily bars, native
+    compression segmented by ticker with a policy for older chunks, and the weekly and monthly
+    continuous aggregates with their refresh policies. `conn` must be in autocommit mode.
+    Every step is optional: if the TimescaleDB edition or version doesn't support it, a warning
+    is printed and the rest keeps working on the plain hypertable.
+    Compression is only enabled on TimescaleDB MIN_COMPRESSION_VERSION or later, because split and
+    dividend repairs (see corporate_actions.py) and purges rewrite old rows in place, which older
+    versions refuse on compressed chunks. On those versions compression enabled earlier is undone.
+    """
+    chunk_interval, compress_after = get_timescale_settings()
+
+    def run(description, *statements):
+        try:
+            with conn.cursor() as cursor:
+                for statement, params in statements:
+                    cursor.execute(statement, params)
+            return True
+        except Exception as e:
+            print(f"Warning: could not {description}: {str(e).strip()}")
+            return False
+
+    run('set the chunk interval',
+        ("SELECT set_chunk_time_interval('stock_data', %s::interval);", (chunk_interval,)))
+
+    version = timescale_version(conn)
+    if version and version < MIN_COMPRESSION_VERSION:
+        print(f"Warning: TimescaleDB {'.'.join(map(str, version))} can't modify compressed rows, "
+              f"compression needs {'.'.join(map(str, MIN_COMPRESSION_VERSION))} or later.")
+        _disable_compression(conn, run)
+    else:
+        if _compression_enabled(conn) is False:
+            if run('enable compression', ("""
+                    ALTER TABLE stock_data SET (
+                        timescaledb.compress,
+                        timescaledb.compress_segmentby = 'ticker',
+                        timescaledb.compress_orderby = 'timestamp DESC'
+                    );
+                """, None)):
+                print("Compression enabled on stock_data.")
+        run('add the compression policy',
+            ("SELECT add_compression_policy('stock_data', %s::interval, if_not_exists => true);", (compress_after,)))
+
+    for view, bucket, start_offset in AGGREGATES.values():
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT 1 FROM timescaledb_information.continuous_aggregates WHERE view_name = %s;
+            """, (view,))
+            exists = cursor.fetchone()
+        if not exists:
+            created = run(f'create the {view} continuous aggregate', (f"""
+                CREATE MATERIALIZED VIEW {view}
+                WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+                SELECT time_bucket(INTERVAL '{bucket}', timestamp) AS bucket,
+                       ticker,
+                       first(open, timestamp) AS open,
+                       max(high) AS high,
+                       min(low) AS low,
+                       last(close, timestamp) AS close,
+                       sum(volume) AS volume
+                FROM stock_data
+                GROUP BY bucket, ticker
+                WITH NO DATA;
+            """, None))
+            if not created:
+                continue
+            print(f"Continuous aggregate {view} created. Materializing the existing history...")
+            run(f'materialize {view}', ("CALL refresh_continuous_aggregate(%s, NULL, NULL);", (view,)))
+        run(f'add the refresh policy of {view}', ("""
+            SELECT add_continuous_aggregate_policy(%s,
+                start_offset => %s::interval,
+                end_offset => INTERVAL '1 day',
+                schedule_interval => INTERVAL '1 day',
+                if_not_exists => true);
+        """, (view, start_offset)))
+
+
+def refresh_aggregates(conn, start=None, end=None):
+    """
+    Re-materializes the continuous aggregates between two dates (the whole history if None).
+    The refresh policies only look at recent buckets, so call this after rewriting older history.
+    `conn` must be in autocommit mode (refreshes can't run inside a transaction).
+    """
+    for view, bucket, _ in AGGREGATES.values():
+        try:
+            with conn.cursor() as cursor:
+                # Widened to whole buckets, since windows smaller than one bucket are rejected.
+                cursor.execute(f"""
+                    CALL refresh_continuous_aggregate(%s,
+                        time_bucket(INTERVAL '{bucket}', %s::date),
+                        (time_bucket(INTERVAL '{bucket}', %s::date) + INTERVAL '{bucket}')::date);
+                """, (view, start, end))
+        except Exception as e:
+            print(f"Warning: could not refresh {view}: {str(e).strip()}")
+
+
+def read_resampled_arrow(conn, tickers: List[str], initial_date, end_date, timeframe: str = 'weekly') -> pa.Table:
+    """
+    Returns weekly or monthly OHLCV bars of `tickers` from the continuous aggregates as an Arrow
+    table, with the same columns as reader.read_stock_data_arrow. The timestamp is the first day
+    of the bucket (Monday for weeks), and buckets overlapping the date range are included whole.
+    """
+    if timeframe not in AGGREGATES:
+        raise ValueError(f"Unknown timeframe '{timeframe}'. Use one of: {', '.join(AGGREGATES)}.")
+    view, bucket, _ = AGGREGATES[timeframe]
+    return copy_to_arrow(conn, f"""
+        SELECT bucket AS timestamp, ticker, open, high, low, close, volume
+        FROM {view}
+        WHERE ticker = ANY(%s) AND
+              bucket BETWEEN time_bucket(INTERVAL '{bucket}', %s::date) AND %s::date
+        ORDER BY bucket, ticker
+    """, (list(tickers), initial_date, end_date), STOCK_DATA_TYPES)
@@ -0,0 +1,122 @@
+from typing import Iterable, List, Optional
+
+import pandas as pd
+from pandas import DataFrame
+from psycopg2.extras import execute_values
+
+# Per-ticker summary of stock_data, maintained by the ingest writer in the same transaction as the rows.
+# revision is bumped whenever stored bars are rewritten in place (see corporate_actions.py).
+WATERMARKS_DDL = """
+    CREATE TABLE IF NOT EXISTS ticker_watermarks (
+        ticker TEXT PRIMARY KEY,
+        first_ts DATE NOT NULL,
+        last_ts DATE NOT NULL,
+        row_count BIGINT NOT NULL,
+        revision INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE ticker_watermarks ADD COLUMN IF NOT EXISTS revision INTEGER NOT NULL DEFAULT 0;
+"""
+
+_UPSERT_CONFLICT = """
+    ON CONFLICT (ticker) DO UPDATE SET
+        first_ts = LEAST(ticker_watermarks.first_ts, EXCLUDED.first_ts),
+        last_ts = GREATEST(ticker_watermarks.last_ts, EXCLUDED.last_ts),
+        row_count = ticker_watermarks.row_count + EXCLUDED.row_count,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+
+def upsert_watermarks(cur, summaries: List[tuple]):
+    """
+    Merges (ticker, first_ts, last_ts, new_rows) summaries of freshly inserted rows into the watermarks.
+    """
+    if not summaries:
+        return
+    execute_values(cur, f"""
+        INSERT INTO ticker_watermarks (ticker, first_ts, last_ts, row_count)
+        VALUES %s
+        {_UPSERT_CONFLICT};
+    """, summaries)
+
+
+def upsert_watermarks_from_staging(cur, staging_table: str):
+    """
+    Merges the rows of a staging table into the watermarks, counting only rows not yet in stock_data.
+    Must run before the staging table is merged into stock_data.
+    """
+    cur.execute(f"""
+        INSERT INTO ticker_watermarks (ticker, first_ts, last_ts, row_count)
+        SELECT s.ticker, MIN(s.timestamp), MAX(s.timestamp), COUNT(*) FILTER (WHERE d.ticker IS NULL)
+        FROM (SELECT DISTINCT timestamp, ticker FROM {staging_table}) s
+        LEFT JOIN stock_data d ON d.ticker = s.ticker AND d.timestamp = s.timestamp
+        GROUP BY s.ticker
+        {_UPSERT_CONFLICT};
+    """)
+
+
+def refresh_watermarks(cur, tickers: Optional[Iterable[str]] = None):
+    """
+    Recomputes the watermarks from stock_data for the given tickers (all of them if None).
+    Tickers without any rows left lose their watermark.
+    """
+    if tickers is None:
+        cur.execute("TRUNCATE ticker_watermarks;")
+        cur.execute("""
+            INSERT INTO ticker_watermarks (ticker, first_ts, last_ts, row_count)
+            SELECT ticker, MIN(timestamp), MAX(timestamp), COUNT(*)
+            FROM stock_data
+            GROUP BY ticker;
+        """)
+        return
+
+    tickers = list(tickers)
+    if not tickers:
+        return
+    cur.execute("DELETE FROM ticker_watermarks WHERE ticker = ANY(%s);", (tickers,))
+    cur.execute("""
+        INSERT INTO ticker_watermarks (ticker, first_ts, last_ts, row_count)
+        SELECT ticker, MIN(timestamp), MAX(timestamp), COUNT(*)
+        FROM stock_data
+        WHERE ticker = ANY(%s)
+        GROUP BY ticker;
+    """, (tickers,))
+
+
+def bootstrap_watermarks(conn):
+    """
+    Builds the watermarks from stock_data the first time, for databases created before they existed.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM ticker_watermarks), EXISTS (SELECT 1 FROM stock_data);")
+        has_watermarks, has_data = cur.fetchone()
+        if has_data and not has_watermarks:
+            print("Building ticker watermarks from stock_data (one-time operation).")
+            refresh_watermarks(cur)
+
+
+def get_watermarks(conn, tickers: Optional[List[str]] = None) -> DataFrame:
+    """
+    Returns the watermarks as a dataframe indexed by ticker with first_ts, last_ts, row_count and revision.
+    """
+    with conn.cursor() as cur:
+        if tickers is None:
+            cur.execute("SELECT ticker, first_ts, last_ts, row_count, revision FROM ticker_watermarks;")
+        else:
+            cur.execute("""
+                SELECT ticker, first_ts, last_ts, row_count, revision
+                FROM ticker_watermarks
+                WHERE ticker = ANY(%s);
+            """, (list(tickers),))
+        rows = cur.fetchall()
+    df = pd.DataFrame(rows, columns=['ticker', 'first_ts', 'last_ts', 'row_count', 'revision'])
+    return df.set_index('ticker')
+
+
+def get_known_tickers(conn) -> List[str]:
+    """
+    Returns every ticker with data in stock_data.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT ticker FROM ticker_watermarks;")
+        return [row[0] for row in cur.fetchall()]